@@ -0,0 +1,569 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Journaled deletes and hard links.
+
+A plan is a list of Actions: delete a path, or replace it by a hard link
+to a target. Each action keeps the size and modification time its path
+had when it was scanned, and optionally its digest: the path, and the
+target of a link, are checked against them just before acting, and the
+action is skipped if they changed.
+
+Nothing is lost until the plan is committed. A deleted path is renamed
+to a held name in its folder; a linked path is first linked to a held
+name, then atomically replaced by a temporary link to the target. Held
+and temporary names only depend on the journal id and the action number,
+so the state of an interrupted action is found on disk: the journal only
+records the finished ones, synced by batches, to skip them when resuming.
+Rolling back renames the held files over their paths, committing removes
+them.
+
+Actions on different devices run in parallel, with a few workers per
+device.
+
+A plan file is a JSON object: {"version": 1, "actions": [{"action":
+"delete" or "link", "path": ..., "target": ..., "size": ..., "mtime":
+nanoseconds, "digest": ...}, ...]}, paths which are not valid UTF-8
+being given as base64 in path_b64 and target_b64 instead.
+"""
+
+import os
+import json
+import stat
+import time
+import errno
+import base64
+import random
+import threading
+import Queue
+from collections import namedtuple
+
+from walker import mtime_ns
+from mounts import same_device
+from finder import get_file_hash
+
+VERSION = 1
+
+DELETE, LINK = 'delete', 'link'
+
+# an action of a plan, target being None for a delete.
+Action = namedtuple('Action', 'kind path target size mtime digest')
+
+# workers per device, renames and links are mostly metadata writes.
+DEVICE_WORKERS = 2
+
+# finished actions journaled at once, and longest time between two syncs
+# and progress reports.
+BATCH_SIZE = 1000
+BATCH_TIME = 0.5
+
+
+def default_journal_path():
+    """
+    Return the path of the journal of the GUI, in the user's cache folder.
+    """
+    folder = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(folder, 'jankis', 'apply.journal')
+
+
+class Skipped(Exception):
+    """
+    An action not done, because its files changed since the plan.
+    """
+    pass
+
+
+def scanned_digest(digest):
+    """
+    Return the digest of a match to check before acting, or None if its
+    files were not fully hashed.
+    """
+    if digest in ('skipped', 'NONE', 'ABORT'):
+        return None
+    return digest
+
+
+def oldest(match):
+    """
+    Return the item of a match with the oldest file.
+    """
+    return min(match, key=lambda item: (item[4], min(item[0])))
+
+
+def shortest_path(match):
+    """
+    Return the item of a match with the shortest path.
+    """
+    return min(match, key=lambda item: min((len(path), path)
+                                           for path in item[0]))
+
+
+KEEP = {'oldest': oldest, 'shortest': shortest_path}
+
+
+def match_actions(match, kind, keep=oldest):
+    """
+    Return the Actions deleting, or replacing by a link to the original,
+    the files of a match but the original, the shortest path of the item
+    given by keep(match). Files on another device than the original are
+    left as they are by links. The actions check what was scanned.
+    """
+    original = keep(match)
+    target = min(original[0], key=lambda path: (len(path), path))
+    plan = []
+    for filenames, size, digest, inode, mtime in match:
+        if inode == original[3]:
+            continue
+        if kind == LINK and not same_device(inode, original[3]):
+            continue
+        for path in sorted(filenames):
+            plan.append(Action(kind, path, target if kind == LINK else None,
+                               size, mtime, scanned_digest(digest)))
+    return plan
+
+
+def _encode(obj, name, path):
+    """
+    Add a path to a JSON object, as base64 if not valid UTF-8.
+    """
+    try:
+        obj[name] = path.decode('utf-8')
+    except UnicodeDecodeError:
+        obj[name + '_b64'] = base64.b64encode(path)
+
+
+def _decode(obj, name):
+    """
+    Return a path of a JSON object, or None.
+    """
+    if name + '_b64' in obj:
+        return base64.b64decode(obj[name + '_b64'])
+    if obj.get(name) is None:
+        return None
+    return obj[name].encode('utf-8')
+
+
+def action_object(action):
+    """
+    Return the JSON object of an Action.
+    """
+    obj = dict(action=action.kind, size=action.size, mtime=action.mtime)
+    _encode(obj, 'path', action.path)
+    if action.target is not None:
+        _encode(obj, 'target', action.target)
+    if action.digest is not None:
+        obj['digest'] = action.digest
+    return obj
+
+
+def parse_action(obj):
+    """
+    Return the Action of a JSON object.
+    Raise ValueError if it is not valid.
+    """
+    kind = obj.get('action')
+    path = _decode(obj, 'path')
+    target = _decode(obj, 'target')
+    if kind not in (DELETE, LINK) or path is None or (
+            kind == LINK and target is None):
+        raise ValueError('invalid action: %r' % obj)
+    return Action(kind, path, target, obj.get('size'), obj.get('mtime'),
+                  obj.get('digest'))
+
+
+def save_plan(path, actions):
+    """
+    Write a list of Actions to a plan file.
+    """
+    f = open(path, 'w')
+    json.dump(dict(version=VERSION,
+                   actions=[action_object(action) for action in actions]),
+              f, indent=1, sort_keys=True)
+    f.close()
+
+
+def load_plan(path):
+    """
+    Return the list of Actions of a plan file.
+    Raise ValueError if it is not valid.
+    """
+    f = open(path)
+    try:
+        plan = json.load(f)
+    finally:
+        f.close()
+    if plan.get('version') != VERSION:
+        raise ValueError('unknown plan version: %r' % plan.get('version'))
+    return [parse_action(obj) for obj in plan['actions']]
+
+
+def _sync(f):
+    """
+    Write a file to disk.
+    """
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class Journal(object):
+    """
+    The actions of a plan being applied, and which ones are finished.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.id = None
+        self.actions = []
+        # action numbers done, and skipped with their reason
+        self.done = set()
+        self.skipped = {}
+        self.file = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def create(self, actions):
+        """
+        Start a new journal of the given Actions.
+        """
+        self.id = '%08x' % random.getrandbits(32)
+        self.actions = list(actions)
+        self.done = set()
+        self.skipped = {}
+        self.file = open(self.path, 'w')
+        self.file.write(json.dumps(dict(version=VERSION, id=self.id,
+                actions=[action_object(action) for action in self.actions]))
+                + '\n')
+        _sync(self.file)
+
+    def load(self):
+        """
+        Read an existing journal, to be continued.
+        Raise ValueError if it is not valid.
+        """
+        f = open(self.path)
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            f.close()
+            # cut before its header was synced, nothing was done
+            raise ValueError('invalid journal %s, no action was applied: '
+                             'remove it' % self.path)
+        if header.get('version') != VERSION:
+            raise ValueError('unknown journal version: %r'
+                             % header.get('version'))
+        self.id = str(header['id'])
+        self.actions = [parse_action(obj) for obj in header['actions']]
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line, cut by a crash
+                break
+            self.done.update(record.get('done', ()))
+            for n, reason in record.get('skipped', ()):
+                self.skipped[n] = reason
+        f.close()
+        self.file = open(self.path, 'a')
+
+    def record(self, done, skipped):
+        """
+        Write finished actions, done and (number, reason) skipped.
+        """
+        self.done.update(done)
+        self.skipped.update(skipped)
+        self.file.write(json.dumps(dict(done=done, skipped=skipped)) + '\n')
+        _sync(self.file)
+
+    def held(self, n):
+        """
+        Return the held name of the path of an action.
+        """
+        folder = os.path.dirname(self.actions[n].path)
+        return os.path.join(folder, '.jankis-%s-%d.held' % (self.id, n))
+
+    def temporary(self, n):
+        """
+        Return the temporary name of the new link of an action.
+        """
+        folder = os.path.dirname(self.actions[n].path)
+        return os.path.join(folder, '.jankis-%s-%d.tmp' % (self.id, n))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+def _remove(path):
+    """
+    Remove a file if it exists.
+    """
+    try:
+        os.remove(path)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def _check(path, size, mtime, digest, verify_digest):
+    """
+    Return the stat of a regular file, raising Skipped if it differs from
+    the given size, mtime and digest, when known.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError, err:
+        raise Skipped('%s: %s' % (path, err.strerror))
+    if not stat.S_ISREG(st.st_mode):
+        raise Skipped('%s: not a regular file' % path)
+    if size is not None and st.st_size != size:
+        raise Skipped('%s: size changed' % path)
+    if mtime is not None and mtime_ns(st) != mtime:
+        raise Skipped('%s: modified' % path)
+    if verify_digest and digest is not None:
+        algorithm, sep, hexdigest = digest.partition(':')
+        if get_file_hash(path, algorithm=algorithm if sep else 'md5') != digest:
+            raise Skipped('%s: content changed' % path)
+    return st
+
+
+def _same_file(path1, path2):
+    """
+    Return True if two paths are links of the same inode.
+    """
+    try:
+        st1 = os.lstat(path1)
+        st2 = os.lstat(path2)
+    except OSError:
+        return False
+    return (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino)
+
+
+class ActionEngine(object):
+    """
+    Apply the Actions of a Journal, resume or roll them back.
+    """
+
+    def __init__(self, journal, verify_digest=False, workers=DEVICE_WORKERS,
+                 progress=None):
+        """
+        verify_digest: also compare the digest of the files with the plan.
+        workers: threads per device.
+        progress(done, skipped, total): called at most every BATCH_TIME.
+        """
+        self.journal = journal
+        self.verify_digest = verify_digest
+        self.workers = workers
+        self.progress = progress
+        self.stopped = False
+
+    def stop(self):
+        """
+        Stop applying, the journal is left to be resumed.
+        """
+        self.stopped = True
+
+    def run_action(self, n):
+        """
+        Do an action, or finish it if interrupted.
+        Raise Skipped if its files changed, OSError if it failed.
+        """
+        action = self.journal.actions[n]
+        held = self.journal.held(n)
+        if action.kind == DELETE:
+            if os.path.lexists(held) and not os.path.lexists(action.path):
+                return
+            _check(action.path, action.size, action.mtime, action.digest,
+                   self.verify_digest)
+            os.rename(action.path, held)
+            return
+
+        temporary = self.journal.temporary(n)
+        if os.path.lexists(held) and _same_file(action.path, action.target):
+            _remove(temporary)
+            return
+        st = _check(action.path, action.size, action.mtime, action.digest,
+                    self.verify_digest)
+        target = _check(action.target, action.size, None, action.digest,
+                        self.verify_digest)
+        if (st.st_dev, st.st_ino) == (target.st_dev, target.st_ino):
+            raise Skipped('%s: already a link of %s' % (action.path,
+                                                        action.target))
+        if st.st_dev != target.st_dev:
+            raise Skipped('%s: not on the device of %s' % (action.path,
+                                                           action.target))
+        if not os.path.lexists(held):
+            os.link(action.path, held)
+        _remove(temporary)
+        os.link(action.target, temporary)
+        os.rename(temporary, action.path)
+
+    def pending(self):
+        """
+        Return the numbers of the actions not finished yet, by device.
+        """
+        devices = {}
+        folders = {}
+        for n in xrange(len(self.journal.actions)):
+            if n in self.journal.done or n in self.journal.skipped:
+                continue
+            folder = os.path.dirname(self.journal.actions[n].path)
+            device = folders.get(folder)
+            if device is None:
+                try:
+                    device = os.lstat(folder or '.').st_dev
+                except OSError:
+                    device = -1
+                folders[folder] = device
+            devices.setdefault(device, []).append(n)
+        return devices
+
+    def apply(self):
+        """
+        Do the actions not finished yet, with self.workers threads per
+        device. Return False if stopped before the end.
+        """
+        total = len(self.journal.actions)
+        tasks = {}
+        for device, numbers in self.pending().iteritems():
+            tasks[device] = Queue.Queue()
+            for n in numbers:
+                tasks[device].put(n)
+        results = Queue.Queue()
+
+        def worker(queue):
+            while not self.stopped:
+                try:
+                    n = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.run_action(n)
+                    results.put((n, None))
+                except (Skipped, EnvironmentError), err:
+                    results.put((n, str(err)))
+
+        threads = []
+        for queue in tasks.itervalues():
+            for i in range(min(self.workers, queue.qsize())):
+                thread = threading.Thread(target=worker, args=(queue,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        done = []
+        skipped = []
+        last = time.time()
+        try:
+            while any(thread.is_alive() for thread in threads) or \
+                    not results.empty():
+                try:
+                    n, error = results.get(timeout=0.1)
+                    if error is None:
+                        done.append(n)
+                    else:
+                        skipped.append((n, error))
+                except Queue.Empty:
+                    pass
+                if len(done) + len(skipped) >= BATCH_SIZE or \
+                        time.time() - last > BATCH_TIME:
+                    if done or skipped:
+                        self.journal.record(done, skipped)
+                        done, skipped = [], []
+                    last = time.time()
+                    if self.progress:
+                        self.progress(len(self.journal.done),
+                                      len(self.journal.skipped), total)
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in threads:
+                thread.join()
+            while not results.empty():
+                n, error = results.get()
+                if error is None:
+                    done.append(n)
+                else:
+                    skipped.append((n, error))
+            raise
+        finally:
+            if done or skipped:
+                self.journal.record(done, skipped)
+            if self.progress:
+                self.progress(len(self.journal.done),
+                              len(self.journal.skipped), total)
+        return not self.stopped
+
+    def commit(self):
+        """
+        Remove the held files, freeing their space, and the journal.
+        """
+        for n in xrange(len(self.journal.actions)):
+            _remove(self.journal.held(n))
+            _remove(self.journal.temporary(n))
+        self.journal.remove()
+
+    def rollback(self):
+        """
+        Put back the original files, and remove the journal.
+        Return the list of the paths which could not be restored.
+        """
+        failed = []
+        for n, action in enumerate(self.journal.actions):
+            held = self.journal.held(n)
+            try:
+                _remove(self.journal.temporary(n))
+                if not os.path.lexists(held):
+                    continue
+                if action.kind == DELETE and os.path.lexists(action.path):
+                    # replaced since, keep both
+                    failed.append(action.path)
+                    continue
+                os.rename(held, action.path)
+            except OSError:
+                failed.append(action.path)
+        if not failed:
+            self.journal.remove()
+        return failed
+
+
+def apply_plan(actions, journal_path, verify_digest=False,
+               workers=DEVICE_WORKERS, progress=None, commit=True):
+    """
+    Apply a list of Actions, journaled in journal_path, or resume the plan
+    of an existing journal there, actions being None or the same.
+    Return the ActionEngine, with the actions done and skipped in its
+    journal, or raise KeyboardInterrupt leaving the journal to be resumed.
+    Raise ValueError if the journal holds another plan.
+    """
+    journal = Journal(journal_path)
+    if journal.exists():
+        journal.load()
+        if actions is not None and list(actions) != journal.actions:
+            journal.close()
+            raise ValueError('%s holds another plan, resume or roll it back '
+                             'first' % journal_path)
+    else:
+        journal.create(actions)
+    engine = ActionEngine(journal, verify_digest, workers, progress)
+    if engine.apply() and commit:
+        engine.commit()
+    else:
+        journal.close()
+    return engine
+
+
+def rollback_plan(journal_path):
+    """
+    Roll back the plan of a journal.
+    Return the list of the paths which could not be restored.
+    """
+    journal = Journal(journal_path)
+    journal.load()
+    return ActionEngine(journal).rollback()
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+#
+
+"""
+Benchmarks of Jankis.
+
+treegen writes reproducible trees of duplicates, and run times each phase
+of a scan on them, writing the results as JSON to compare commits:
+
+    python -m benchmarks.run /tmp/tree -o before.json
+    python -m benchmarks.run /tmp/tree -o after.json
+    python -m benchmarks.run --compare before.json after.json
+
+The other scripts measure a single aspect, see their own usage.
+"""
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Measure the time saved by reading files in physical order.
+
+Files are written in a shuffled order across many folders, so that the
+walk order does not match their location on disk, then all of them are
+hashed once with each I/O order. The page cache is dropped before each run
+when possible (as root), otherwise the results are meaningless.
+
+usage: bench_ioorder.py FOLDER [FILES [SIZE]]
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import finder
+from walker import walk_records
+from ioorder import IOScheduler
+
+
+def make_tree(folder, files, size, seed=42):
+    """
+    Write files of given size in folder, in a shuffled order.
+    """
+    rand = random.Random(seed)
+    names = [os.path.join(folder, 'd%03d' % (i % 97), 'f%06d' % i)
+             for i in range(files)]
+    rand.shuffle(names)
+    for name in names:
+        if not os.path.isdir(os.path.dirname(name)):
+            os.makedirs(os.path.dirname(name))
+        f = open(name, 'wb')
+        f.write(os.urandom(size))
+        f.close()
+
+
+def drop_caches():
+    """
+    Empty the page cache, return False if not allowed.
+    """
+    try:
+        os.system('sync')
+        open('/proc/sys/vm/drop_caches', 'w').write('3\n')
+        return True
+    except IOError:
+        return False
+
+
+def main(folder, files=2000, size=256*1024):
+    if not os.path.isdir(folder) or not os.listdir(folder):
+        print 'creating %d files of %d bytes...' % (files, size)
+        make_tree(folder, files, size)
+    records = []
+    for root, found in walk_records(folder):
+        records.extend(found)
+    print '%d files' % len(records)
+
+    results = {}
+    for policy in ('none', 'inode', 'fiemap'):
+        if not drop_caches():
+            print 'warning: cannot drop the page cache, run as root'
+        scheduler = IOScheduler(policy)
+        start = time.time()
+        for record in scheduler.order(records):
+            finder.get_file_hash(record.path)
+        results[policy] = time.time() - start
+        print '%8s: %.3fs' % (policy, results[policy])
+    for policy in ('inode', 'fiemap'):
+        print '%8s saves %.1f%%' % (policy,
+                100 * (1 - results[policy] / max(results['none'], 1e-9)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    main(sys.argv[1], *[int(arg) for arg in sys.argv[2:]])
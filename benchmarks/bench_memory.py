@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Measure the memory used to index walked files.
+
+Synthetic records spread over nested folders are indexed once by the
+DuplicateFinder, and once by the previous layout (a dict per size of
+[FileRecord, [path]] items by inode), each in its own forked process.
+The memory is the growth of the resident size, as tracemalloc is not
+available everywhere.
+
+usage: bench_memory.py [FILES]
+"""
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import finder
+from walker import FileRecord
+
+
+def records(files, seed=42):
+    """
+    Return an iterator of synthetic FileRecords, folder by folder.
+    """
+    rand = random.Random(seed)
+    for i in xrange(files):
+        folder = '/home/user/projects/p%03d/src/module%02d/data' % (
+                i // 10000, i // 100 % 100)
+        yield FileRecord('%s/file-%08d.dat' % (folder, i),
+                         int(rand.expovariate(1.0 / 1000000)),
+                         1000000 + i, 2049, 1300000000000000000 + i)
+
+
+def resident():
+    """
+    Return the resident size of this process, in bytes.
+    """
+    pages = int(open('/proc/self/statm').read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def index_table(files):
+    dupfinder = finder.DuplicateFinder()
+    for record in records(files):
+        dupfinder.add_record(record)
+    return dupfinder
+
+
+def index_dicts(files):
+    sizelist = {}
+    for record in records(files):
+        inodes = sizelist.setdefault(record.size, {})
+        inodes[(record.device, record.inode)] = [record, [record.path]]
+    return sizelist
+
+
+def measure(index, files):
+    """
+    Return the memory used by index(files), measured in a child process.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = resident()
+        kept = index(files)
+        os.write(write, str(resident() - before))
+        os._exit(0)
+    os.close(write)
+    used = int(os.read(read, 64))
+    os.close(read)
+    os.waitpid(pid, 0)
+    return used
+
+
+def main(files=1000000):
+    for name, index in (('dicts', index_dicts), ('table', index_table)):
+        used = measure(index, files)
+        print '%6s %8.1fMB %6.1f bytes/file' % (
+                name, used / 1048576.0, float(used) / files)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
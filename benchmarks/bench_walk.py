@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Measure the parallel walk on a simulated high latency file system.
+
+The folder listing of the walker is wrapped to wait a fixed delay per
+listing and per stat-ed file, like a network file system round trip, then
+a generated tree is walked with an increasing number of threads, checking
+the ordered results are the same as a single thread walk.
+
+usage: bench_walk.py FOLDER [FILES [LATENCY_MS]]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import walker
+from benchmarks import treegen
+
+
+def slow_list_dir(list_dir, latency):
+    """
+    Return list_dir waiting latency seconds per listing and per file.
+    """
+    def list_slowly(folder):
+        entries = list_dir(folder)
+        time.sleep(latency * (1 + sum(1 for name, kind, st in entries
+                                      if kind == walker.FILE)))
+        return entries
+    return list_slowly
+
+
+def walk(folder, threads):
+    return [(root, sorted(records)) for root, records in
+            walker.walk_records(folder, threads=threads)]
+
+
+def main(folder, files=2000, latency_ms=1):
+    if treegen.load_manifest(folder) is None:
+        print 'generating %d files in %s...' % (files, folder)
+        treegen.make_tree(folder, files=files, median_size=1024)
+    walker._list_dir = slow_list_dir(walker._list_dir, latency_ms / 1000.0)
+
+    reference = None
+    for threads in (1, 2, 4, 8, 16, 32):
+        start = time.time()
+        result = walk(folder, threads)
+        duration = time.time() - start
+        if reference is None:
+            reference = result, duration
+        print '%2d thread(s): %8.3fs  x%5.1f  %s' % (threads, duration,
+                reference[1] / duration,
+                'same order' if result == reference[0] else 'DIFFERENT')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    main(sys.argv[1], *[int(arg) for arg in sys.argv[2:]])
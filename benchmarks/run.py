@@ -0,0 +1,247 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Time each phase of a scan on a generated tree.
+
+Each scenario is run a few times on the same tree, with its input prepared
+beforehand and untimed. The wall time, the bytes read and the number of
+read and write syscalls of the whole process are measured, the latter from
+/proc/self/io. The hash cache is never used.
+
+usage: python -m benchmarks.run [options] FOLDER
+       python -m benchmarks.run --compare OLD.json NEW.json
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import finder
+import pipeline
+from benchmarks import treegen
+
+VERSION = 1
+
+# partial stages, run before the full one.
+PARTIAL_STAGES = [stage for stage in finder.STAGES if stage != 'full']
+
+
+def read_io():
+    """
+    Return the I/O counters of this process, or an empty dict.
+    """
+    counters = {}
+    try:
+        f = open('/proc/self/io')
+    except IOError:
+        return counters
+    for line in f:
+        name, value = line.split(':')
+        counters[name] = int(value)
+    f.close()
+    return counters
+
+
+def drop_caches():
+    """
+    Empty the page cache, return False if not allowed.
+    """
+    try:
+        os.system('sync')
+        open('/proc/sys/vm/drop_caches', 'w').write('3\n')
+        return True
+    except IOError:
+        return False
+
+
+def walked(folder):
+    """
+    Return the FileRecords of the tree, without the manifest.
+    """
+    return [record for record in finder.walk([folder], 0)
+            if os.path.basename(record.path) != treegen.MANIFEST]
+
+
+def size_grouped(folder):
+    """
+    Return the size groups of the tree.
+    """
+    dupfinder = finder.DuplicateFinder()
+    for record in walked(folder):
+        dupfinder.add_record(record)
+    return dupfinder.size_groups()
+
+
+def partial_hashed(folder):
+    """
+    Return the groups of the tree left by the partial stages.
+    """
+    groups = size_grouped(folder)
+    dupfinder = finder.DuplicateFinder()
+    for stage in PARTIAL_STAGES:
+        groups = dupfinder.split_groups(groups, stage)
+    return groups
+
+
+def run_walk(folder, records):
+    return len(walked(folder))
+
+
+def run_size_groups(folder, records):
+    dupfinder = finder.DuplicateFinder()
+    for record in records:
+        dupfinder.add_record(record)
+    return len(dupfinder.size_groups())
+
+
+def run_partial(folder, groups):
+    dupfinder = finder.DuplicateFinder()
+    for stage in PARTIAL_STAGES:
+        groups = dupfinder.split_groups(groups, stage)
+    return len(groups)
+
+
+def run_full_compare(folder, groups):
+    return len(finder.DuplicateFinder().split_groups(groups, 'full'))
+
+
+def run_full_hash(folder, groups):
+    dupfinder = finder.DuplicateFinder(compare=False)
+    return len(dupfinder.split_groups(groups, 'full'))
+
+
+def run_scan(folder, state):
+    return len(finder.scan([folder], 0, False))
+
+
+def run_streaming_scan(folder, state):
+    return len(pipeline.scan([folder], 0, False))
+
+
+# name: (prepare(folder), run(folder, prepared))
+SCENARIOS = [
+    ('walk', (None, run_walk)),
+    ('size_groups', (walked, run_size_groups)),
+    ('partial', (size_grouped, run_partial)),
+    ('full_compare', (partial_hashed, run_full_compare)),
+    ('full_hash', (partial_hashed, run_full_hash)),
+    ('scan', (None, run_scan)),
+    ('streaming_scan', (None, run_streaming_scan)),
+]
+
+
+def measure(folder, prepare, run, repeat, cold):
+    """
+    Run a scenario repeat times, returning its measures.
+    """
+    prepared = prepare(folder) if prepare else None
+    runs = []
+    for i in range(repeat):
+        if cold and not drop_caches():
+            print 'warning: cannot drop the page cache, run as root'
+            cold = False
+        before = read_io()
+        start = time.time()
+        result = run(folder, prepared)
+        wall = time.time() - start
+        after = read_io()
+        measures = dict(wall=wall, result=result)
+        for name in ('rchar', 'read_bytes', 'syscr', 'syscw'):
+            if name in after:
+                measures[name] = after[name] - before[name]
+        runs.append(measures)
+    best = min(runs, key=lambda measures: measures['wall'])
+    return dict(best, runs=[measures['wall'] for measures in runs])
+
+
+def commit():
+    """
+    Return the current git commit of the sources, or None.
+    """
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.PIPE,
+                stderr=open(os.devnull, 'w')).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def compare(old_path, new_path):
+    """
+    Print the wall time changes between two result files.
+    """
+    old = json.load(open(old_path))['results']
+    new = json.load(open(new_path))['results']
+    for name, scenario in SCENARIOS:
+        if name in old and name in new:
+            before, after = old[name]['wall'], new[name]['wall']
+            print '%16s %9.3fs %9.3fs %+7.1f%%' % (name, before, after,
+                    100 * (after - before) / max(before, 1e-9))
+
+
+def main():
+    parser = OptionParser(usage=__doc__.strip().split('usage: ')[-1])
+    parser.add_option('-o', '--output', dest='output',
+                      help='Write the results as JSON to this file.')
+    parser.add_option('-s', '--scenario', dest='scenarios', action='append',
+                      choices=[name for name, scenario in SCENARIOS],
+                      help='Only run this scenario, can be given several times.')
+    parser.add_option('-n', '--repeat', dest='repeat', type='int', default=3,
+                      help='Number of runs of each scenario (default: %default).')
+    parser.add_option('--files', dest='files', type='int',
+                      default=treegen.DEFAULTS['files'],
+                      help='Number of files of a new tree (default: %default).')
+    parser.add_option('--seed', dest='seed', type='int',
+                      default=treegen.DEFAULTS['seed'],
+                      help='Seed of a new tree (default: %default).')
+    parser.add_option('--cold', dest='cold', action='store_true',
+                      help='Drop the page cache before each run (as root).')
+    parser.add_option('--compare', dest='compare', action='store_true',
+                      help='Compare two result files.')
+    options, args = parser.parse_args()
+    if options.compare:
+        if len(args) != 2:
+            parser.error('--compare needs two result files')
+        compare(*args)
+        return
+    if len(args) != 1:
+        parser.error('incorrect number of arguments')
+
+    folder = args[0]
+    manifest = treegen.load_manifest(folder)
+    if manifest is None:
+        print 'generating %d files in %s...' % (options.files, folder)
+        manifest = treegen.make_tree(folder, files=options.files,
+                                     seed=options.seed)
+
+    results = {}
+    for name, (prepare, run) in SCENARIOS:
+        if options.scenarios and name not in options.scenarios:
+            continue
+        results[name] = measure(folder, prepare, run, options.repeat,
+                                options.cold)
+        print '%16s %9.3fs %12d bytes read %8d reads' % (name,
+                results[name]['wall'], results[name].get('rchar', 0),
+                results[name].get('syscr', 0))
+
+    report = dict(version=VERSION, commit=commit(), python=sys.version,
+                  platform=platform.platform(), tree=manifest,
+                  repeat=options.repeat, cold=bool(options.cold),
+                  results=results)
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(report, f, indent=1, sort_keys=True)
+        f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Deterministic generator of trees with duplicates.
+
+The same parameters and seed always give the same paths and contents:
+unique files, exact copies, near-duplicates sharing their size, head and
+tail with another file but differing by their middle byte, and hard links,
+in folders nested down to a given depth.
+
+usage: python -m benchmarks.treegen [options] FOLDER
+"""
+
+import os
+import json
+import struct
+import random
+from optparse import OptionParser
+
+# parameters of a tree, with their default values.
+DEFAULTS = dict(
+    files=2000,
+    # sizes follow a lognormal distribution around median_size
+    median_size=64*1024,
+    sigma=1.5,
+    min_size=1,
+    max_size=64*1024*1024,
+    # fraction of the files which are copies, near-duplicates or links
+    duplicates=0.2,
+    near_duplicates=0.05,
+    hard_links=0.02,
+    depth=6,
+    fanout=4,
+    seed=42,
+)
+
+# content of all files is taken from this block, at an offset per file.
+BLOCK_SIZE = 1024*1024
+
+MANIFEST = 'jankis-tree.json'
+
+
+def make_block(seed):
+    """
+    Return a pseudo random block, the same for a given seed.
+    """
+    rand = random.Random(seed)
+    return struct.pack('<%dQ' % (BLOCK_SIZE // 8),
+                       *[rand.getrandbits(64) for i in xrange(BLOCK_SIZE // 8)])
+
+
+def write_content(path, size, offset, block, flip=None):
+    """
+    Write size bytes of block from offset, wrapping around, with the byte
+    at position flip changed.
+    """
+    f = open(path, 'wb')
+    written = 0
+    while written < size:
+        start = (offset + written) % BLOCK_SIZE
+        data = block[start:start + min(size - written, BLOCK_SIZE - start)]
+        if flip is not None and written <= flip < written + len(data):
+            i = flip - written
+            data = data[:i] + chr(ord(data[i]) ^ 0xff) + data[i + 1:]
+        f.write(data)
+        written += len(data)
+    f.close()
+
+
+def make_tree(folder, **params):
+    """
+    Write a tree in folder, returning the manifest of its parameters and
+    contents, also written in folder.
+    """
+    for key in params:
+        if key not in DEFAULTS:
+            raise ValueError('unknown tree parameter: %s' % key)
+    spec = dict(DEFAULTS)
+    spec.update(params)
+    rand = random.Random(spec['seed'])
+    block = make_block(spec['seed'])
+
+    counts = dict(unique=0, duplicates=0, near_duplicates=0, hard_links=0,
+                  bytes=0)
+    written = []
+    for i in xrange(spec['files']):
+        # a random folder, at a random depth
+        parts = [('d%d' % rand.randrange(spec['fanout']))
+                 for level in range(rand.randint(0, spec['depth']))]
+        path = os.path.join(folder, *(parts + ['f%07d' % i]))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        kind = rand.random()
+        original = written and written[rand.randrange(len(written))]
+        if original and kind < spec['hard_links']:
+            os.link(original[0], path)
+            counts['hard_links'] += 1
+            continue
+        kind -= spec['hard_links']
+        if original and kind < spec['duplicates']:
+            opath, size, offset = original
+            write_content(path, size, offset, block)
+            counts['duplicates'] += 1
+        elif original and kind < spec['duplicates'] + spec['near_duplicates'] \
+                and original[1] > 2:
+            opath, size, offset = original
+            # same head and tail, the middle byte differs
+            write_content(path, size, offset, block, flip=size // 2)
+            counts['near_duplicates'] += 1
+        else:
+            size = int(rand.lognormvariate(0, spec['sigma']) * spec['median_size'])
+            size = max(spec['min_size'], min(spec['max_size'], size))
+            offset = rand.randrange(BLOCK_SIZE)
+            write_content(path, size, offset, block)
+            written.append((path, size, offset))
+            counts['unique'] += 1
+        counts['bytes'] += size
+
+    manifest = dict(spec=spec, counts=counts)
+    f = open(os.path.join(folder, MANIFEST), 'w')
+    json.dump(manifest, f, indent=1, sort_keys=True)
+    f.close()
+    return manifest
+
+
+def load_manifest(folder):
+    """
+    Return the manifest of a generated tree, or None.
+    """
+    try:
+        f = open(os.path.join(folder, MANIFEST))
+    except IOError:
+        return None
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def main():
+    parser = OptionParser(usage=__doc__.strip().split('usage: ')[-1])
+    parser.add_option('--files', dest='files', type='int',
+                      default=DEFAULTS['files'],
+                      help='Number of files (default: %default).')
+    parser.add_option('--median-size', dest='median_size', type='int',
+                      default=DEFAULTS['median_size'],
+                      help='Median size of the files, in bytes'
+                      ' (default: %default).')
+    parser.add_option('--depth', dest='depth', type='int',
+                      default=DEFAULTS['depth'],
+                      help='Maximal depth of the folders (default: %default).')
+    parser.add_option('--seed', dest='seed', type='int',
+                      default=DEFAULTS['seed'],
+                      help='Seed of the tree (default: %default).')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('incorrect number of arguments')
+    folder = args[0]
+    if os.path.isdir(folder) and os.listdir(folder):
+        parser.error('%s is not empty' % folder)
+    manifest = make_tree(folder, files=options.files,
+                         median_size=options.median_size, depth=options.depth,
+                         seed=options.seed)
+    print json.dumps(manifest, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Compact storage of walked files.
+
+Millions of FileRecord tuples and full path strings take gigabytes, mostly
+for the same folder prefixes repeated over and over. A FileTable stores
+each folder path once, and each file as a row of array columns: folder id,
+name offset in a single byte buffer, size, inode, device and modification
+time, about 50 bytes per file plus its name. Full paths and records are
+only built back when needed.
+"""
+
+import os
+from array import array
+
+from walker import FileRecord
+
+
+class FileTable(object):
+    """
+    Append-only table of FileRecord rows, indexed by row number.
+    """
+
+    def __init__(self):
+        """
+        Create an empty table.
+        """
+        # interned folder paths, and their ids
+        self.dirs = []
+        self.dir_ids = {}
+        # names of all files, one after the other
+        self.names = bytearray()
+        self.name_ends = array('L')
+        self.dir = array('l')
+        self.size = array('L')
+        self.inode = array('L')
+        self.device = array('L')
+        self.mtime = array('l')
+        self.last_dir = None
+        self.last_id = None
+        self.dirs_size = 0
+
+    def __len__(self):
+        return len(self.dir)
+
+    def intern(self, folder):
+        """
+        Return the id of a folder path, storing it once.
+        """
+        if folder == self.last_dir:
+            # files are walked folder by folder
+            return self.last_id
+        dir_id = self.dir_ids.get(folder)
+        if dir_id is None:
+            dir_id = self.dir_ids[folder] = len(self.dirs)
+            self.dirs.append(folder)
+            self.dirs_size += len(folder)
+        self.last_dir = folder
+        self.last_id = dir_id
+        return dir_id
+
+    def memory(self):
+        """
+        Return an estimate of the memory used by the table, in bytes.
+        """
+        # 44 bytes of columns per row, and about 100 bytes per interned folder
+        return len(self.dir) * 44 + len(self.names) + \
+               len(self.dirs) * 100 + self.dirs_size
+
+    def append(self, record):
+        """
+        Store a FileRecord, returning its row number.
+        """
+        folder, name = os.path.split(record.path)
+        self.dir.append(self.intern(folder))
+        self.names.extend(name)
+        self.name_ends.append(len(self.names))
+        self.size.append(record.size)
+        self.inode.append(record.inode)
+        self.device.append(record.device)
+        self.mtime.append(record.mtime)
+        return len(self.dir) - 1
+
+    def name(self, row):
+        """
+        Return the file name of a row.
+        """
+        start = self.name_ends[row - 1] if row else 0
+        return str(self.names[start:self.name_ends[row]])
+
+    def path(self, row):
+        """
+        Return the full path of a row.
+        """
+        return os.path.join(self.dirs[self.dir[row]], self.name(row))
+
+    def record(self, row):
+        """
+        Return the FileRecord of a row.
+        """
+        return FileRecord(self.path(row), self.size[row], self.inode[row],
+                          self.device[row], self.mtime[row])
+
+    def subset(self, rows):
+        """
+        Return a new table of the given rows, in that order, to drop the
+        rows no longer used.
+        """
+        table = FileTable()
+        for row in rows:
+            table.append(self.record(row))
+        return table
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Include and exclude rules of a walk.
+
+All the glob and regular expression rules of a PathFilter are compiled
+together, in one regular expression for names and one for paths, so a
+walked entry is tested once whatever the number of rules. The walker asks
+it about each folder before listing it, so an excluded folder costs a
+single test, and about each file with its stat data, for the size,
+modification time and extension rules.
+"""
+
+import re
+import fnmatch
+
+# folders never walked, unless told otherwise.
+DEFAULT_EXCLUDE_DIRS = ['.gvfs']
+
+# version control, caches and build outputs, see --exclude-common.
+COMMON_EXCLUDE_DIRS = ['.git', '.hg', '.svn', '.bzr', '_darcs', 'CVS',
+                       '.cache', '.ccache', '.thumbnails', '.Trash-*',
+                       '__pycache__', '.tox', '.venv', '*.egg-info',
+                       'node_modules']
+COMMON_EXCLUDE = ['*.pyc', '*.pyo', '*.o', '*.swp', '*~']
+
+
+def _translate(pattern):
+    """
+    Return the regular expression of a glob pattern, without its end anchor
+    and flags.
+    """
+    regex = fnmatch.translate(pattern)
+    if regex.endswith('\\Z(?ms)'):
+        regex = regex[:-len('\\Z(?ms)')]
+    return regex
+
+
+def compile_rules(globs=(), regexes=()):
+    """
+    Return (names, paths) compiled regular expressions matching the given
+    globs and regexes, either None if nothing is to be matched.
+    Globs without a slash match an entry name, the others the end of a
+    path, on whole components. Regexes are searched anywhere in the path.
+    """
+    names = []
+    paths = []
+    for pattern in globs:
+        if '/' in pattern:
+            paths.append('(?:.*/)?%s\\Z' % _translate(pattern.rstrip('/')))
+        else:
+            names.append(_translate(pattern))
+    for regex in regexes:
+        paths.append('.*?(?:%s)' % regex)
+    if names:
+        names = re.compile('(?:%s)\\Z' % '|'.join(names), re.S)
+    else:
+        names = None
+    if paths:
+        paths = re.compile('|'.join(paths), re.S)
+    else:
+        paths = None
+    return names, paths
+
+
+def _extensions(extensions):
+    """
+    Return the set of lower case extensions, without their dots.
+    """
+    return frozenset(extension.lower().lstrip('.') for extension in extensions)
+
+
+class PathFilter(object):
+    """
+    Compiled include and exclude rules for the folders and files of a walk.
+    """
+
+    def __init__(self, exclude=(), include=(), exclude_dirs=DEFAULT_EXCLUDE_DIRS,
+                 exclude_regex=(), extensions=(), exclude_extensions=(),
+                 min_size=None, max_size=None, newer=None, older=None):
+        """
+        exclude: globs of the folders and files not walked.
+        include: globs of the files walked, all if empty.
+        exclude_dirs: globs of the folders not walked.
+        exclude_regex: regular expressions of the paths not walked.
+        extensions, exclude_extensions: file extensions walked, all if
+        empty, and not walked.
+        min_size, max_size: bounds of the size of the files walked.
+        newer, older: bounds of the modification time of the files walked,
+        in seconds since the epoch.
+        """
+        self.dir_names, self.dir_paths = compile_rules(
+                list(exclude) + list(exclude_dirs), exclude_regex)
+        self.names, self.paths = compile_rules(exclude, exclude_regex)
+        self.include_names, self.include_paths = compile_rules(include)
+        self.include = bool(include)
+        self.extensions = _extensions(extensions)
+        self.exclude_extensions = _extensions(exclude_extensions)
+        self.min_size = min_size
+        self.max_size = max_size
+        # file mtimes are in nanoseconds
+        self.newer = None if newer is None else int(newer * 1000000000)
+        self.older = None if older is None else int(older * 1000000000)
+
+    def prune(self, path, name):
+        """
+        Return True if the folder at path, named name, is not to be walked.
+        """
+        if self.dir_names is not None and self.dir_names.match(name):
+            return True
+        if self.dir_paths is not None and self.dir_paths.match(path):
+            return True
+        return False
+
+    def accept(self, path, name, size, mtime):
+        """
+        Return True if the file at path, named name, is to be walked,
+        mtime being in nanoseconds.
+        """
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        if self.newer is not None and mtime < self.newer:
+            return False
+        if self.older is not None and mtime >= self.older:
+            return False
+        if self.extensions or self.exclude_extensions:
+            extension = name.rpartition('.')[2].lower() if '.' in name else ''
+            if self.extensions and extension not in self.extensions:
+                return False
+            if extension in self.exclude_extensions:
+                return False
+        if self.names is not None and self.names.match(name):
+            return False
+        if self.paths is not None and self.paths.match(path):
+            return False
+        if self.include and not (
+                self.include_names is not None and self.include_names.match(name)
+                or self.include_paths is not None and self.include_paths.match(path)):
+            return False
+        return True
+
+    def accept_record(self, record):
+        """
+        Return True if a FileRecord is to be walked.
+        """
+        return self.accept(record.path, record.path.rpartition('/')[2],
+                           record.size, record.mtime)
+
+
+# the filter of a walk without rules.
+DEFAULT_FILTER = PathFilter()
@@ -6,182 +6,806 @@
 
 """
 
+import io
 import os
-import hashlib
+import mmap
+import time
+import errno
+import resource
+import threading
+import itertools
+from array import array
 
-from smartpath import _walk
+import hashers
+from hashers import DEFAULT_ALGORITHM, PARTIAL_ALGORITHM
+from walker import FileRecord, walk_records, stat_record
+from filters import PathFilter
+from filetable import FileTable
+from spill import SpilledRuns
+from hashpool import HashExecutor
+from ioorder import IOScheduler
 
 
 # read one CHUNK_SIZE bytes to check duplicates.
 CHUNK_SIZE = 1024
 
-# buffer size when doing whole file md5.
+# bytes read at the end of files by the tail stage.
+TAIL_SIZE = 4*1024
+
+# number of CHUNK_SIZE blocks read across files by the sample stage.
+SAMPLES = 8
+
+# buffer size when doing whole file hash, adapted to the file size up to
+# MAX_BUFFER_SIZE.
 BUFFER_SIZE = 64*1024
+MAX_BUFFER_SIZE = 1024*1024
+
+# files bigger than this are hashed from a memory map.
+MMAP_THRESHOLD = 64*1024*1024
+
+# first block size of lockstep comparisons, doubled after each block up to
+# MAX_BUFFER_SIZE, and memory used by the blocks of a whole group.
+COMPARE_BLOCK_SIZE = 16*1024
+COMPARE_MEMORY = 64*1024*1024
+
+# groups with more files than this are hashed instead of being compared,
+# and files kept for the rest of the process out of the open files limit.
+MAX_OPEN_FILES = 256
+RESERVED_FILES = 64
+
+# initial number of size counting buckets, doubled as files are added.
+SIZE_BUCKETS = 64*1024
+
+# hashing stages, from the cheapest to the most expensive one.
+STAGES = ('head', 'tail', 'sample', 'full')
+
+# read buffers, one per thread.
+_buffers = threading.local()
+
+try:
+    # read-only view on a part of a buffer, accepted by all hashers
+    _view = buffer
+except NameError:
+    def _view(data, offset, length):
+        return memoryview(data)[offset:offset + length]
 
 # this contains the currently processed file.
 current_file = None
 abort = False
 
 def walk(root_folders, minimal_size=-1, follow_links=False,
-            blacklist=None, whitelist=None):
+            blacklist=None, whitelist=None, snapshot=None, metrics=None,
+            threads=1, ordered=True, path_filter=None, mounts=None):
     """
-    Return an iterator with all files present in a list of files/folders
+    Return an iterator with all files present in a list of files/folders,
+    as FileRecord tuples.
+    The folders and files matching the blacklist globs are skipped, and
+    only the files matching the whitelist globs are kept, if given. A
+    PathFilter can be given instead for more rules, and a MountPolicy to
+    skip mount points.
+    A Snapshot can be given to skip listing the unchanged folders, and
+    Metrics to count the walked files. With several threads, folders are
+    listed concurrently, and returned as soon as listed unless ordered.
     """
     global current_file
+    if path_filter is None and (blacklist or whitelist):
+        path_filter = PathFilter(exclude=blacklist or (),
+                                 include=whitelist or ())
     for folder in root_folders:
         #print 'walking:', folder
-        for root, dirs, files in _walk(folder, follow_links=follow_links):
+        for root, records in walk_records(folder, follow_links=follow_links,
+                                          snapshot=snapshot, metrics=metrics,
+                                          threads=threads, ordered=ordered,
+                                          path_filter=path_filter,
+                                          mounts=mounts):
             #print root
             current_file = root
-            for name in files:
-                filename = os.path.join(root, name)
-                try:
-                    filesize = os.path.getsize(filename)
-                except OSError: # invalids files, links, etc...
-                    filesize = 0
-                if filesize > minimal_size:
-                    yield filename
-                if abort:
-                    return
+            for record in records:
+                if record.size > minimal_size:
+                    yield record
+                elif metrics is not None:
+                    metrics.inc('files_skipped', reason='minimal_size')
+            if metrics is not None:
+                metrics.inc('files_seen', len(records))
+            if abort:
+                return
     current_file = None
 
 
-def get_file_hash(filename, limit_size=None, buffer_size=BUFFER_SIZE):
+def get_stage_bytes(size, ranges):
+    """
+    Return the number of bytes read in the given ranges of a file of the
+    given size.
+    """
+    if ranges is None:
+        return size
+    return sum(max(0, min(length, size - offset)) for offset, length in ranges)
+
+
+def get_stage_ranges(stage, size, samples=SAMPLES):
+    """
+    Return the list of (offset, length) ranges read by a hashing stage on a
+    file of the given size, None meaning the whole file, or an empty list
+    when the stage can't tell anything the previous ones did not.
+    """
+    if stage == 'head':
+        return [(0, CHUNK_SIZE)]
+    elif stage == 'tail':
+        if size <= CHUNK_SIZE:
+            return []
+        return [(max(0, size - TAIL_SIZE), TAIL_SIZE)]
+    elif stage == 'sample':
+        if size <= CHUNK_SIZE + TAIL_SIZE:
+            return []
+        step = size // (samples + 1)
+        return [(step * (i + 1), CHUNK_SIZE) for i in range(samples)]
+    elif stage == 'full':
+        return None
+    raise ValueError('unknown hashing stage: %s' % stage)
+
+
+def get_stage_key(stage, algorithm, samples=SAMPLES):
+    """
+    Return the name identifying the digests of a hashing stage, with its
+    algorithm and parameters, as stored in a hash cache.
+    """
+    if stage == 'head':
+        return '%s:head:%d' % (algorithm, CHUNK_SIZE)
+    elif stage == 'tail':
+        return '%s:tail:%d' % (algorithm, TAIL_SIZE)
+    elif stage == 'sample':
+        return '%s:sample:%dx%d' % (algorithm, samples, CHUNK_SIZE)
+    return '%s:%s' % (algorithm, stage)
+
+
+def get_buffer(size):
+    """
+    Return a bytearray of at least size bytes, reused by all the reads of
+    the current thread.
+    """
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = _buffers.buf = bytearray(size)
+    return buf
+
+
+def get_buffer_size(size, blksize):
+    """
+    Return the read buffer size for a file of the given size, a multiple of
+    the preferred block size of its filesystem.
+    """
+    blksize = max(blksize or 4096, 512)
+    buffer_size = min(max(size // 16, BUFFER_SIZE), MAX_BUFFER_SIZE)
+    return max(blksize, buffer_size - buffer_size % blksize)
+
+
+def _read_into(f, view, length):
     """
-    Return the md5 hash of given file as an hexadecimal string.
-    limit_size can be used to read only the first n bytes of file.
+    Fill view with length bytes of file f, return the number of bytes read.
     """
+    done = 0
+    while done < length:
+        n = f.readinto(view[done:length])
+        if not n:
+            break
+        done += n
+    return done
+
+
+def get_file_hash(filename, limit_size=None, buffer_size=None,
+                  ranges=None, algorithm=DEFAULT_ALGORITHM):
+    """
+    Return the hash of given file as an hexadecimal string, tagged with the
+    name of its algorithm.
+    limit_size can be used to read only the first n bytes of file, and
+    ranges to read only a list of (offset, length) blocks.
+    Data is read into a reusable buffer, or hashed straight from a memory
+    map for big files.
+    """
+    if limit_size:
+        ranges = [(0, limit_size)]
+
     # open file
     try:
-        f = file(filename, "rb")
+        f = io.open(filename, "rb", buffering=0)
     except IOError:
         return 'NONE'
 
-    # get md5 hasher
-    hasher = hashlib.md5()
+    hasher = hashers.new(algorithm)
+    try:
+        st = os.fstat(f.fileno())
+        if ranges:
+            # get the hash of some parts of file
+            buf = get_buffer(max(length for offset, length in ranges))
+            view = memoryview(buf)
+            for offset, length in ranges:
+                f.seek(offset)
+                n = _read_into(f, view, length)
+                hasher.update(_view(buf, 0, n))
+        elif st.st_size >= MMAP_THRESHOLD:
+            # get the hash of whole file, without copying it
+            if buffer_size is None:
+                buffer_size = MAX_BUFFER_SIZE
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, len(m), buffer_size):
+                    hasher.update(_view(m, offset, buffer_size))
+                    if abort:
+                        return 'ABORT'
+            finally:
+                m.close()
+        else:
+            # get the hash of whole file
+            if buffer_size is None:
+                buffer_size = get_buffer_size(st.st_size,
+                                              getattr(st, 'st_blksize', None))
+            buf = get_buffer(buffer_size)
+            view = memoryview(buf)
+            n = True
+            while n:
+                n = f.readinto(view[:buffer_size])
+                hasher.update(_view(buf, 0, n))
+                if abort:
+                    return 'ABORT'
+    except (IOError, OSError, mmap.error):
+        return 'NONE'
+    finally:
+        f.close()
+
+    return hashers.tag(algorithm, hasher.hexdigest())
 
-    if limit_size:
-        # get the md5 of beginning of file
-        chunk = f.read(limit_size)
-        hasher.update(chunk)
-    else:
-        # get the md5 of whole file
-        chunk = True
-        while chunk:
-            chunk = f.read(buffer_size)
-            hasher.update(chunk)
-            if abort:
-                return 'ABORT'
 
-    f.close()
-    return hasher.hexdigest()
+def open_files_limit(threads):
+    """
+    Return how many files each of the given number of threads may keep
+    open at once to compare them, within the open files limit.
+    """
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ValueError, resource.error):
+        return MAX_OPEN_FILES
+    if soft == resource.RLIM_INFINITY:
+        return MAX_OPEN_FILES
+    return max(2, min(MAX_OPEN_FILES,
+                      (soft - RESERVED_FILES) // max(threads, 1)))
+
+
+def compare_files(filenames, algorithm=DEFAULT_ALGORITHM, read=None):
+    """
+    Compare files block by block, reading all of them at the same time, and
+    return the (digest, indexes) of each set of identical files, indexes
+    being positions in filenames. Return None if aborted, or if too many
+    files are open to open them all, for them to be hashed instead.
+    After each block, files are split by content, and a file is no longer
+    read as soon as it differs from all the others.
+    The number of bytes read is added to read[0], if given.
+    """
+    files = []
+    try:
+        members = []
+        for i, filename in enumerate(filenames):
+            try:
+                f = io.open(filename, "rb")
+            except IOError, err:
+                if err.errno in (errno.EMFILE, errno.ENFILE):
+                    return
+                # unreadable, would not be hashed either
+                continue
+            files.append(f)
+            members.append((i, f))
+
+        result = []
+        groups = [(hashers.new(algorithm), members)]
+        block_size = COMPARE_BLOCK_SIZE
+        max_block_size = max(COMPARE_BLOCK_SIZE,
+                             min(MAX_BUFFER_SIZE, COMPARE_MEMORY // len(filenames)))
+        while groups:
+            next_groups = []
+            for hasher, members in groups:
+                blocks = {}
+                order = []
+                for i, f in members:
+                    try:
+                        block = f.read(block_size)
+                    except IOError:
+                        continue
+                    if read is not None:
+                        read[0] += len(block)
+                    m = blocks.get(block)
+                    if m is None:
+                        m = blocks[block] = []
+                        order.append(block)
+                    m.append((i, f))
+
+                for block in order:
+                    m = blocks[block]
+                    if len(m) < 2:
+                        # differs from all the others
+                        continue
+                    h = hasher.copy() if len(order) > 1 else hasher
+                    if not block:
+                        # end of files, all identical
+                        result.append((hashers.tag(algorithm, h.hexdigest()),
+                                       [i for i, f in m]))
+                    else:
+                        h.update(block)
+                        next_groups.append((h, m))
+                if abort:
+                    return
+            groups = next_groups
+            block_size = min(block_size * 2, max_block_size)
+        return result
+    finally:
+        for f in files:
+            f.close()
+
+
+def timed_file_hash(*args):
+    """
+    Return the result of get_file_hash(*args) and the time it took.
+    """
+    start = time.time()
+    return get_file_hash(*args), time.time() - start
+
+
+def timed_compare_files(filenames, algorithm=DEFAULT_ALGORITHM):
+    """
+    Return the result of compare_files, the time it took and the number of
+    bytes read.
+    """
+    start = time.time()
+    read = [0]
+    result = compare_files(filenames, algorithm, read)
+    return result, time.time() - start, read[0]
 
 
 class DuplicateFinder:
     """
     """
 
-    def __init__(self):
+    def __init__(self, stages=STAGES, samples=SAMPLES, cache=None,
+                 executor=None, algorithm=DEFAULT_ALGORITHM,
+                 partial_algorithm=PARTIAL_ALGORITHM, compare=True,
+                 scheduler=None, memory_limit=None, metrics=None):
         """
         Create the DuplicateFinder object.
+        stages is the list of hashing stages candidates go through.
+        cache is an optional HashCache, checked before any file is read.
+        executor is the HashExecutor running the hashing tasks.
+        algorithm is used for whole files, and partial_algorithm for the
+        other stages.
+        compare makes the full stage read the files of a group in lockstep,
+        instead of hashing each of them entirely.
+        scheduler is the IOScheduler ordering reads by physical location.
+        memory_limit is the approximate number of bytes the walked files
+        and the candidates may use, the files being spilled to disk when
+        they don't fit.
+        metrics is an optional Metrics object, filled during the scan.
         """
-        # duplicate matches
-        self.hashlist = {}
-        # number of files with same hash
-        self.hashcount = {}
+        self.compare = compare
+        if scheduler is None:
+            scheduler = IOScheduler()
+        self.scheduler = scheduler
+        self.stages = stages
+        self.samples = samples
+        self.algorithm = algorithm
+        self.partial_algorithm = partial_algorithm
+        self.cache = cache
+        if executor is None:
+            executor = HashExecutor()
+        self.executor = executor
+        # all the walked files, and how many times each size was seen,
+        # saturating at 2, in buckets shared by a few sizes. Nothing is read
+        # before a file has a peer.
+        self.files = FileTable()
+        self.size_counts = bytearray(SIZE_BUCKETS)
+        self.memory_limit = memory_limit
+        self.metrics = metrics
+        # sorted runs of files, when over the memory limit
+        self.runs = SpilledRuns()
         self.totalsize = 0
         self.totalfiles = 0
+        self.skippedfiles = 0
+        # paths sharing their inode with a previous one
+        self.linkedfiles = 0
+        # number of candidates removed by each hashing stage
+        self.eliminated = dict((stage, 0) for stage in stages)
         self.dupfiles = 0
         self.dupsize = 0
 
     def add_file(self, filename):
         """
-        Compare the given file to our lists of hashes
+        Stat the given file and store it.
         """
-        # compute md5
-        h = get_file_hash(filename, CHUNK_SIZE)
+        self.add_record(stat_record(filename))
 
-        # increase count
-        count = self.hashcount.get(h, 0) + 1
-        self.hashcount[h] = count
-
-        # store md5 and filename for later use
-        f = self.hashlist.get(h, [])
-        f.append(filename)
-        self.hashlist[h] = f
+    def add_record(self, record):
+        """
+        Store the given FileRecord in the bucket of its size.
+        """
+        self.files.append(record)
+        if self.memory_limit is not None:
+            # sorting the table for a run takes about three times its size
+            if self.files.memory() > self.memory_limit // 4:
+                self.spill()
+            self.totalfiles += 1
+            return
+        self.count_size(record.size)
+        if len(self.files) > len(self.size_counts) // 2:
+            # too many shared buckets, count again in twice as many
+            self.size_counts = bytearray(len(self.size_counts) * 2)
+            for size in self.files.size:
+                self.count_size(size)
 
         # update stats
         self.totalfiles += 1
-        self.totalsize += os.path.getsize(filename)
 
-    def process(self, progress_listener=None, skip_md5=False):
+    def size_bucket(self, size):
         """
-        Check for duplicates.
+        Return the bucket of size in size_counts.
         """
-        matches = []
-        scanned = to_scan = 0
-        for h, f in self.hashlist.iteritems():
-            if self.hashcount[h] < 2:
-                # present only one time, skip
+        return ((size * 2654435761) >> 11) & (len(self.size_counts) - 1)
+
+    def count_size(self, size):
+        """
+        Count a file of the given size.
+        """
+        bucket = self.size_bucket(size)
+        if self.size_counts[bucket] < 2:
+            self.size_counts[bucket] += 1
+
+    def spill(self):
+        """
+        Write the files of the table to a new run sorted by size, and empty
+        the table.
+        """
+        files = self.files
+        rows = sorted(xrange(len(files)), key=lambda row: (
+                files.size[row], files.device[row], files.inode[row]))
+        self.runs.add(files.record(row) for row in rows)
+        self.files = FileTable()
+
+    def group_inodes(self, size, records):
+        """
+        Return the [size, digest, inodes] group of FileRecords sharing their
+        size, inodes being a list of [record, filenames] items. Hard links of
+        an inode are only attached to it.
+        Return None if there is a single inode.
+        """
+        inodes = {}
+        count = 0
+        for record in records:
+            count += 1
+            inode = (record.device, record.inode)
+            f = inodes.get(inode)
+            if f is None:
+                inodes[inode] = [record, [record.path]]
+            else:
+                f[1].append(record.path)
+                self.linkedfiles += 1
+        self.totalsize += size * len(inodes)
+        if len(inodes) < 2:
+            # links of a single inode, or a size sharing its bucket
+            self.skippedfiles += count
+            return None
+        return [size, None, inodes.values()]
+
+    def spilled_size_groups(self):
+        """
+        Return an iterator of the groups of inodes sharing their size, like
+        size_groups, merging the runs spilled to disk one size at a time.
+        """
+        self.spill()
+        for size, records in itertools.groupby(self.runs.merge(),
+                                               lambda record: record.size):
+            group = self.group_inodes(size, records)
+            if group is not None:
+                yield group
+
+    def group_batches(self):
+        """
+        Return an iterator of lists of size groups, each one fitting in half
+        the memory limit.
+        """
+        batch = []
+        used = 0
+        for group in self.spilled_size_groups():
+            batch.append(group)
+            # about 300 bytes per inode, and its paths
+            for record, filenames in group[2]:
+                used += 300 + sum(len(filename) for filename in filenames)
+            if used > self.memory_limit // 2:
+                yield batch
+                batch = []
+                used = 0
+        if batch:
+            yield batch
+
+    def size_groups(self):
+        """
+        Return the [size, digest, inodes] groups of inodes sharing their size,
+        inodes being a list of [record, filenames] items. Hard links of an
+        inode are only attached to it.
+        An inode with an unique size can't have any duplicate, so it is
+        skipped without being opened.
+        """
+        files = self.files
+        # only the rows which may share their size are grouped
+        sizelist = {}
+        for row, size in enumerate(files.size):
+            if self.size_counts[self.size_bucket(size)] < 2:
+                self.skippedfiles += 1
+                self.totalsize += size
+            else:
+                rows = sizelist.get(size)
+                if rows is None:
+                    rows = sizelist[size] = array('L')
+                rows.append(row)
+
+        groups = []
+        for size, rows in sizelist.iteritems():
+            group = self.group_inodes(size, (files.record(row) for row in rows))
+            if group is not None:
+                groups.append(group)
+        self.files = FileTable()
+        self.size_counts = bytearray(SIZE_BUCKETS)
+        return groups
+
+    def stage_algorithm(self, stage):
+        """
+        Return the hash algorithm used by the given stage.
+        """
+        if stage == 'full':
+            return self.algorithm
+        return self.partial_algorithm
+
+    def hash_records(self, stage, tasks, progress_listener=None):
+        """
+        Return the digests of a list of (record, ranges) tasks for the given
+        stage, in the same order, or None if aborted.
+        Digests known by the cache are used, the other ones are computed
+        concurrently by the executor.
+        """
+        algorithm = self.stage_algorithm(stage)
+        key = get_stage_key(stage, algorithm, self.samples)
+        digests = [None] * len(tasks)
+        missing = []
+        for i, (record, ranges) in enumerate(tasks):
+            if self.cache is not None:
+                digests[i] = self.cache.get(record, key)
+            if digests[i] is None:
+                missing.append(i)
+        missing = self.scheduler.order(missing, lambda i: tasks[i][0])
+        metrics = self.metrics
+        if metrics is not None and self.cache is not None:
+            metrics.inc('cache_hits', len(tasks) - len(missing), stage=stage)
+            metrics.inc('cache_misses', len(missing), stage=stage)
+
+        known = len(tasks) - len(missing)
+        def progress(done, total):
+            if progress_listener:
+                progress_listener(known + done, len(tasks))
+
+        results = self.executor.map(
+                get_file_hash if metrics is None else timed_file_hash,
+                [(tasks[i][0].device, (tasks[i][0].path, None, None,
+                  tasks[i][1], algorithm)) for i in missing],
+                progress, lambda: abort)
+        if results is None:
+            return
+        for i, h in zip(missing, results):
+            if metrics is not None:
+                h, seconds = h
+                record, ranges = tasks[i]
+                metrics.observe('hash_seconds', seconds, stage=stage)
+                metrics.inc('open_calls')
+                metrics.inc('bytes_read', get_stage_bytes(record.size, ranges),
+                            stage=stage)
+            digests[i] = h
+            if self.cache is not None and h not in ('NONE', 'ABORT'):
+                self.cache.put(tasks[i][0], key, h)
+        return digests
+
+    def compare_groups(self, groups, progress_listener=None):
+        """
+        Split groups by comparing their inodes in lockstep, and return the
+        groups of identical inodes, and the groups which still need to be
+        hashed: too big ones, and those whose digests are all cached.
+        Return None if aborted.
+        """
+        key = get_stage_key('full', self.algorithm)
+        compared = []
+        remaining = []
+        devices = set(inodes[0][0].device for size, digest, inodes in groups)
+        max_files = open_files_limit(self.executor.threads(devices))
+        for group in groups:
+            size, digest, inodes = group
+            # looked up again, and counted, when hashed
+            cached = self.cache is not None and None not in [
+                    self.cache.peek(record, key) for record, filenames in inodes]
+            if cached or len(inodes) > max_files:
+                remaining.append(group)
+            else:
+                compared.append(group)
+        compared = self.scheduler.order(compared, lambda group: group[2][0][0])
+
+        def progress(done, total):
+            if progress_listener:
+                progress_listener(done, total)
+
+        metrics = self.metrics
+        results = self.executor.map(
+                compare_files if metrics is None else timed_compare_files,
+                [(inodes[0][0].device,
+                  ([record.path for record, filenames in inodes], self.algorithm))
+                  for size, digest, inodes in compared],
+                progress, lambda: abort)
+        if results is None:
+            return
+
+        result = []
+        for group, identical in zip(compared, results):
+            size, digest, inodes = group
+            if metrics is not None:
+                identical, seconds, read = identical
+                metrics.observe('hash_seconds', seconds, stage='compare')
+                metrics.inc('open_calls', len(inodes))
+                metrics.inc('bytes_read', read, stage='full')
+            if identical is None:
+                # out of file descriptors, hash its files one at a time
+                remaining.append(group)
                 continue
-            to_scan += len(f)
+            survivors = 0
+            for h, indexes in identical:
+                f = [inodes[i] for i in indexes]
+                survivors += sum(len(filenames) for record, filenames in f)
+                if self.cache is not None:
+                    for record, filenames in f:
+                        self.cache.put(record, key, h)
+                result.append([size, h, f])
+            self.eliminated['full'] += sum(
+                    len(filenames) for record, filenames in inodes) - survivors
+        return result, remaining
 
-        for h, f in self.hashlist.iteritems():
-            if abort:
+    def split_groups(self, groups, stage, progress_listener=None):
+        """
+        Hash the inodes of each group with the given stage, and split groups
+        by digest. Inodes left alone are dropped.
+        Each inode is read only once, whatever its number of links.
+        """
+        result = []
+        if stage == 'full' and self.compare:
+            compared = self.compare_groups(groups, progress_listener)
+            if compared is None:
                 return
-            if self.hashcount[h] < 2:
-                # present only one time, skip
-                continue
+            result, groups = compared
 
-            # reference file
-            refname = f[0]
-            try:
-                refsize = os.path.getsize(refname)
-            except OSError:
+        tasks = []
+        hashed = []
+        for group in groups:
+            size, digest, inodes = group
+            ranges = get_stage_ranges(stage, size, self.samples)
+            if ranges == []:
+                # nothing new to read, keep the group as is
+                result.append(group)
                 continue
-            refmd5 = get_file_hash(refname) if not skip_md5 else 'skipped'
-            #print '%10d   %s' % (refsize, refname)
-            match = []
-            match.append([refname, refsize, refmd5])
-            scanned += 1
-            if progress_listener:
-                progress_listener(scanned, to_scan)
+            hashed.append((group, ranges))
+            for item in inodes:
+                tasks.append((item[0], ranges))
 
-            for filename in f[1:]:
-                # and its copies
-                try:
-                    size = os.path.getsize(filename)
-                except OSError:
-                    continue
-                md5 = get_file_hash(filename) if not skip_md5 else 'skipped'
+        digests = self.hash_records(stage, tasks, progress_listener)
+        if digests is None:
+            return
 
-                match.append([filename, size, md5])
+        digests = iter(digests)
+        for (size, digest, inodes), ranges in hashed:
+            hashlist = {}
+            order = []
+            for item in inodes:
+                h = digests.next()
+                f = hashlist.get(h)
+                if f is None:
+                    f = hashlist[h] = []
+                    order.append(h)
+                f.append(item)
+
+            for h in order:
+                f = hashlist[h]
+                if len(f) < 2 or h == 'NONE':
+                    # present only one time, or unreadable, skip
+                    self.eliminated[stage] += sum(len(filenames)
+                                                  for record, filenames in f)
+                    continue
+                if ranges is None:
+                    # the whole file was hashed
+                    digest = h
+                result.append([size, digest, f])
+        return result
 
-                status = ' '
-                msg = ''
-                if md5 != refmd5:
-                    status = '!'
-                    msg = ' partial match only!'
+    def process(self, progress_listener=None, skip_md5=False):
+        """
+        Check for duplicates.
+        Candidates go through each hashing stage in turn, every stage
+        splitting groups further, before the next, more expensive one runs.
+        Each match is a list of [filenames, size, digest, inode, mtime]
+        items, one per inode, filenames being all the paths linked to that
+        inode, and mtime its modification time in nanoseconds when walked.
+        With a memory limit, the groups go through all the stages a batch at
+        a time.
+        """
+        if self.memory_limit is None:
+            matches = self.process_groups(self.size_groups(),
+                                          progress_listener, skip_md5)
+        else:
+            matches = []
+            for groups in self.group_batches():
+                result = self.process_groups(groups, progress_listener, skip_md5)
+                if result is None:
+                    self.runs.close()
+                    matches = None
+                    break
+                matches.extend(result)
+        if self.metrics is not None:
+            self.metrics.inc('files_skipped', self.skippedfiles,
+                             reason='unique_size')
+        return matches
 
-                #print '%10d %s %s%s' % (size, status, filename, msg), os.path.samefile(refname, filename)
-                self.dupsize += size
-                scanned += 1
-                if progress_listener:
-                    progress_listener(scanned, to_scan)
+    def process_groups(self, groups, progress_listener=None, skip_md5=False):
+        """
+        Check the given size groups for duplicates, returning the matches.
+        """
+        for stage in self.stages:
+            if skip_md5 and stage == 'full':
+                continue
+            start = time.time()
+            groups = self.split_groups(groups, stage, progress_listener)
+            if self.metrics is not None:
+                self.metrics.inc('stage_seconds', time.time() - start,
+                                 phase=stage)
+            if groups is None:
+                return
 
+        matches = []
+        scanned = to_scan = sum(len(inodes) for size, digest, inodes in groups)
+        for size, digest, inodes in groups:
+            if digest is None:
+                digest = 'skipped'
+            match = [[filenames, size, digest, (record.device, record.inode),
+                      record.mtime] for record, filenames in inodes]
             self.dupfiles += 1
+            # only one copy of each inode is using disk space
+            self.dupsize += size * (len(inodes) - 1)
             matches.append(match)
             if progress_listener:
                 progress_listener(scanned, to_scan, match)
-            #print
         return matches
 
 
 def scan(folders, minimal_size, follow_links,
-        add_file_callback=None, add_match_callback=None):
-    finder = DuplicateFinder()
-    for f in walk(folders, minimal_size, follow_links):
-        finder.add_file(f)
+        add_file_callback=None, add_match_callback=None, finder=None,
+        snapshot=None, walk_threads=1, walk_ordered=True, path_filter=None,
+        mounts=None):
+    """
+    Find the duplicates in the given folders.
+    An existing DuplicateFinder can be given to read its stats afterwards.
+    With a Snapshot, only the new or modified files are examined, and the
+    snapshot is saved again once the scan is complete. It should also be
+    the cache of the given finder.
+    walk_threads, walk_ordered, path_filter and mounts are given to walk().
+    """
+    if finder is None:
+        finder = DuplicateFinder(cache=snapshot)
+    start = time.time()
+    for f in walk(folders, minimal_size, follow_links, snapshot=snapshot,
+                  metrics=finder.metrics, threads=walk_threads,
+                  ordered=walk_ordered, path_filter=path_filter,
+                  mounts=mounts):
+        finder.add_record(f)
         if add_file_callback:
-            add_file_callback(f)
-    return finder.process(add_match_callback)
+            add_file_callback(f.path)
+    if finder.metrics is not None:
+        finder.metrics.inc('stage_seconds', time.time() - start, phase='walk')
+    matches = finder.process(add_match_callback)
+    if snapshot is not None and not abort:
+        snapshot.save()
+    return matches
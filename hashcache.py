@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Persistent cache of file digests.
+
+Digests are stored in a SQLite database, keyed by the (device, inode) of
+the file and the kind of digest (algorithm and hashing stage). An entry
+is only valid while the size and modification time of the file are the
+same, to the nanosecond, as when it was computed.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+from walker import mtime_ns
+
+# maximal number of digests kept, the least recently used are evicted.
+MAX_ENTRIES = 4000000
+
+# number of pending writes before they are commited.
+BATCH_SIZE = 1000
+
+
+def default_cache_path():
+    """
+    Return the path of the cache database, in the user's cache folder.
+    """
+    folder = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(folder, 'jankis', 'hashes.db')
+
+
+class HashCache(object):
+    """
+    Digests of previous scans, stored on disk.
+    """
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES):
+        """
+        Open or create the cache database.
+        """
+        if path is None:
+            path = default_cache_path()
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pending = []
+        self.used = []
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # paths are bytes, stored and read back as they are
+        self.db.text_factory = str
+        self.db.execute('''CREATE TABLE IF NOT EXISTS hashes (
+                device INTEGER, inode INTEGER, key TEXT,
+                size INTEGER, mtime INTEGER, digest TEXT,
+                path TEXT, used INTEGER,
+                PRIMARY KEY (device, inode, key))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)')
+        self.db.commit()
+
+    def get(self, record, key):
+        """
+        Return the cached digest of a FileRecord, or None.
+        """
+        with self.lock:
+            row = self.db.execute('''SELECT size, mtime, digest FROM hashes
+                    WHERE device=? AND inode=? AND key=?''',
+                    (record.device, record.inode, key)).fetchone()
+            if row is None or row[0] != record.size or row[1] != record.mtime:
+                # unknown or modified file
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.used.append((int(time.time()), record.device, record.inode, key))
+            if len(self.used) >= BATCH_SIZE:
+                self._flush()
+            return row[2]
+
+    def peek(self, record, key):
+        """
+        Return the cached digest of a FileRecord, or None, without counting
+        the lookup as a hit or a miss.
+        """
+        with self.lock:
+            row = self.db.execute('''SELECT size, mtime, digest FROM hashes
+                    WHERE device=? AND inode=? AND key=?''',
+                    (record.device, record.inode, key)).fetchone()
+        if row is None or row[0] != record.size or row[1] != record.mtime:
+            return None
+        return row[2]
+
+    def put(self, record, key, digest):
+        """
+        Store the digest of a FileRecord.
+        """
+        with self.lock:
+            self.pending.append((record.device, record.inode, key, record.size,
+                                 record.mtime, digest, record.path,
+                                 int(time.time())))
+            if len(self.pending) >= BATCH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        """
+        Write the pending changes. The lock must be held.
+        """
+        self.db.executemany('INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?,?,?,?)',
+                            self.pending)
+        self.db.executemany('''UPDATE hashes SET used=?
+                WHERE device=? AND inode=? AND key=?''', self.used)
+        self.db.commit()
+        self.pending = []
+        self.used = []
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    def evict(self):
+        """
+        Remove the least recently used digests above max_entries.
+        """
+        with self.lock:
+            self._flush()
+            count = self.db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute('''DELETE FROM hashes WHERE rowid IN (
+                        SELECT rowid FROM hashes ORDER BY used LIMIT ?)''',
+                        (count - self.max_entries,))
+                self.db.commit()
+
+    def prune(self):
+        """
+        Remove the digests of files which were deleted or modified, and
+        evict the least recently used ones. Return the number of removed
+        digests.
+        """
+        with self.lock:
+            self._flush()
+            count = self.db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+            stale = []
+            rows = self.db.execute('''SELECT DISTINCT device, inode, size, mtime,
+                    path FROM hashes''').fetchall()
+            for device, inode, size, mtime, path in rows:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    stale.append((device, inode))
+                    continue
+                if (st.st_dev, st.st_ino, st.st_size) != (device, inode, size) \
+                        or mtime_ns(st) != mtime:
+                    stale.append((device, inode))
+            self.db.executemany('DELETE FROM hashes WHERE device=? AND inode=?',
+                                stale)
+            self.db.commit()
+        self.evict()
+        return count - len(self)
+
+    def clear(self):
+        """
+        Remove all digests.
+        """
+        with self.lock:
+            self.pending = []
+            self.used = []
+            self.db.execute('DELETE FROM hashes')
+            self.db.commit()
+
+    def close(self):
+        """
+        Write the pending changes, enforce the size cap, and close the cache.
+        """
+        self.evict()
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Registry of the hash algorithms used to compare files.
+
+A digest is only a grouping key here, so fast non-cryptographic hashes are
+preferred: CRC32 for the cheap partial stages, and xxHash (when the
+optional xxhash module is installed) or BLAKE2b for whole files.
+Digests are always tagged with their algorithm, as 'name:hexdigest'.
+"""
+
+import os
+import time
+import zlib
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# name -> function returning a new hasher object, with the update(),
+# hexdigest() and copy() methods of hashlib objects.
+ALGORITHMS = {}
+
+
+def register(name, factory):
+    """
+    Make a new hash algorithm available.
+    """
+    ALGORITHMS[name] = factory
+
+
+class CRC32(object):
+    """
+    hashlib-like wrapper around zlib.crc32.
+    """
+
+    def __init__(self, crc=0):
+        self.crc = crc
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+
+    def hexdigest(self):
+        return '%08x' % (self.crc & 0xffffffff)
+
+    def copy(self):
+        return CRC32(self.crc)
+
+
+register('crc32', CRC32)
+register('md5', hashlib.md5)
+register('sha1', hashlib.sha1)
+if hasattr(hashlib, 'blake2b'):
+    register('blake2b', hashlib.blake2b)
+else:
+    try:
+        import pyblake2
+        register('blake2b', pyblake2.blake2b)
+    except ImportError:
+        pass
+if xxhash is not None:
+    register('xxh64', xxhash.xxh64)
+    if hasattr(xxhash, 'xxh3_128'):
+        register('xxh128', xxhash.xxh3_128)
+    elif hasattr(xxhash, 'xxh128'):
+        register('xxh128', xxhash.xxh128)
+
+
+def available():
+    """
+    Return the names of the available algorithms.
+    """
+    return sorted(ALGORITHMS)
+
+
+def _first_available(*names):
+    for name in names:
+        if name in ALGORITHMS:
+            return name
+
+# algorithm of the whole file digests.
+DEFAULT_ALGORITHM = _first_available('xxh128', 'blake2b', 'md5')
+
+# algorithm of the partial stages, only used to split groups.
+PARTIAL_ALGORITHM = 'crc32'
+
+
+def new(name):
+    """
+    Return a new hasher for the given algorithm.
+    """
+    try:
+        return ALGORITHMS[name]()
+    except KeyError:
+        raise ValueError('unknown hash algorithm: %s (available: %s)' % (
+                         name, ', '.join(available())))
+
+
+def tag(name, hexdigest):
+    """
+    Return a digest tagged with its algorithm.
+    """
+    return '%s:%s' % (name, hexdigest)
+
+
+def short_digest(digest, length=6):
+    """
+    Return a tagged digest shortened for display, keeping its tag.
+    """
+    name, sep, hexdigest = digest.partition(':')
+    if not sep:
+        return digest[:length]
+    return '%s:%s' % (name, hexdigest[:length])
+
+
+def benchmark(names=None, size=64*1024*1024, buffer_size=64*1024):
+    """
+    Hash size bytes of random data with each algorithm, and return a list
+    of (name, bytes per second) tuples.
+    """
+    buf = os.urandom(buffer_size)
+    result = []
+    for name in names or available():
+        hasher = new(name)
+        start = time.time()
+        for i in xrange(size // buffer_size):
+            hasher.update(buf)
+        hasher.hexdigest()
+        duration = max(time.time() - start, 1e-9)
+        result.append((name, size / duration))
+    return result
@@ -0,0 +1,401 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Run hashing tasks concurrently, with a bounded number of threads per device.
+
+hashlib releases the GIL while hashing large buffers, so threads are
+enough to keep several reads in flight. A spinning disk only gets a couple
+of workers, as more would just make it seek, while solid state devices get
+many more.
+"""
+
+import os
+import threading
+import Queue
+import multiprocessing
+
+# workers per device, by kind of device.
+ROTATIONAL_WORKERS = 2
+SOLID_STATE_WORKERS = 8
+DEFAULT_WORKERS = 4
+
+
+def is_rotational(device):
+    """
+    Return True if the given st_dev is a spinning disk, False if it is a
+    solid state one, and None if it is unknown (network, virtual...).
+    """
+    sysfs = '/sys/dev/block/%d:%d' % (os.major(device), os.minor(device))
+    if not os.path.exists(sysfs):
+        return None
+    sysfs = os.path.realpath(sysfs)
+    # partitions share the queue of their disk
+    for folder in (sysfs, os.path.dirname(sysfs)):
+        try:
+            return open(os.path.join(folder, 'queue', 'rotational')).read().strip() == '1'
+        except IOError:
+            continue
+    return None
+
+
+def device_workers(device):
+    """
+    Return the number of hashing threads suitable for the given st_dev.
+    """
+    rotational = is_rotational(device)
+    if rotational is None:
+        return DEFAULT_WORKERS
+    return ROTATIONAL_WORKERS if rotational else SOLID_STATE_WORKERS
+
+
+class HashExecutor(object):
+    """
+    Thread pool running tasks with a concurrency limit per device.
+    """
+
+    def __init__(self, workers=None):
+        """
+        workers forces the number of threads of each device, otherwise it
+        depends on the kind of device.
+        """
+        self.workers = workers
+        self.limits = {}
+
+    def device_workers(self, device):
+        """
+        Return the number of threads used for the given st_dev.
+        """
+        if self.workers:
+            return self.workers
+        limit = self.limits.get(device)
+        if limit is None:
+            limit = self.limits[device] = device_workers(device)
+        return limit
+
+    def threads(self, devices):
+        """
+        Return the number of threads running at once for tasks on the
+        given devices.
+        """
+        return sum(self.device_workers(device) for device in devices)
+
+    def map(self, func, tasks, progress=None, aborted=None):
+        """
+        Call func(*args) for all (device, args) tasks, and return the results
+        in the order of tasks, whatever the order of completion.
+        progress(done, total) is called from the calling thread after each
+        task, and aborted() is polled to stop early, returning None.
+        """
+        results = [None] * len(tasks)
+        if not tasks:
+            return results
+
+        queues = {}
+        for i, (device, args) in enumerate(tasks):
+            queue = queues.get(device)
+            if queue is None:
+                queue = queues[device] = Queue.Queue()
+            queue.put((i, args))
+
+        done_queue = Queue.Queue()
+        cancelled = threading.Event()
+
+        def worker(queue):
+            """
+            Run the tasks of one device until the end marker.
+            """
+            while True:
+                task = queue.get()
+                if task is None:
+                    return
+                i, args = task
+                if cancelled.is_set():
+                    continue
+                try:
+                    result = func(*args)
+                except Exception, err:
+                    result = err
+                done_queue.put((i, result))
+
+        threads = []
+        for device, queue in queues.iteritems():
+            count = min(self.device_workers(device), queue.qsize())
+            for n in range(count):
+                queue.put(None)
+                thread = threading.Thread(target=worker, args=(queue,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        done = 0
+        error = None
+        while done < len(tasks):
+            if aborted is not None and aborted():
+                cancelled.set()
+                break
+            try:
+                i, result = done_queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if isinstance(result, Exception):
+                cancelled.set()
+                error = result
+                break
+            results[i] = result
+            done += 1
+            if progress:
+                progress(done, len(tasks))
+
+        for thread in threads:
+            thread.join()
+        if error is not None:
+            raise error
+        if cancelled.is_set():
+            return None
+        return results
+
+    def stream(self, func, maxsize=1000):
+        """
+        Return a TaskStream running func on the tasks submitted to it, with
+        the per-device limits of this executor.
+        """
+        return TaskStream(self, func, maxsize)
+
+    def close(self):
+        """
+        Nothing to release, threads only live during map or stream.
+        """
+        pass
+
+
+class TaskStream(object):
+    """
+    Tasks submitted one at a time to a HashExecutor, as they are found.
+    Each device gets a bounded queue, so submit() blocks when the device
+    can't keep up, and results are read back as (token, result) tuples.
+    """
+
+    def __init__(self, executor, func, maxsize=1000):
+        self.executor = executor
+        self.func = func
+        self.maxsize = maxsize
+        self.queues = {}
+        self.threads = {}
+        self.results = Queue.Queue()
+        self.cancelled = threading.Event()
+        self.pending = 0
+
+    def worker(self, queue):
+        """
+        Run the tasks of one device until the end marker.
+        """
+        while True:
+            task = queue.get()
+            if task is None:
+                return
+            token, args = task
+            if self.cancelled.is_set():
+                continue
+            try:
+                result = self.func(*args)
+            except Exception, err:
+                result = err
+            self.results.put((token, result))
+
+    def submit(self, device, args, token):
+        """
+        Queue func(*args) on the given st_dev, token being returned along
+        with its result.
+        """
+        queue = self.queues.get(device)
+        if queue is None:
+            queue = self.queues[device] = Queue.Queue(self.maxsize)
+            threads = self.threads[device] = []
+            for n in range(self.executor.device_workers(device)):
+                thread = threading.Thread(target=self.worker, args=(queue,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        self.pending += 1
+        queue.put((token, args))
+
+    def get(self, timeout=None):
+        """
+        Return the next (token, result) tuple, raising Queue.Empty after
+        timeout seconds, or at once if timeout is 0.
+        """
+        if timeout == 0:
+            token, result = self.results.get_nowait()
+        else:
+            token, result = self.results.get(timeout=timeout)
+        self.pending -= 1
+        if isinstance(result, Exception):
+            self.cancel()
+            raise result
+        return token, result
+
+    def cancel(self):
+        """
+        Drop the tasks not started yet.
+        """
+        self.cancelled.set()
+        self.close()
+
+    def close(self):
+        """
+        Stop the threads once their queue is empty.
+        """
+        for device, threads in self.threads.iteritems():
+            for thread in threads:
+                self.queues[device].put(None)
+            for thread in threads:
+                thread.join()
+        self.queues = {}
+        self.threads = {}
+
+
+def _call(task):
+    """
+    Run one task of a ProcessHashExecutor, in a worker process.
+    """
+    i, func, args = task
+    return i, func(*args)
+
+
+def _call_safe(task):
+    """
+    Run one task of a ProcessTaskStream, returning the error if it fails.
+    """
+    i, func, args = task
+    try:
+        return i, func(*args)
+    except Exception, err:
+        return i, err
+
+
+class ProcessHashExecutor(object):
+    """
+    Process pool running tasks on all cores, for CPU bound hashing when
+    files are already in the page cache or on fast devices.
+    Only the compact task arguments and the digests go through the pipes.
+    """
+
+    def __init__(self, processes=None):
+        """
+        processes is the size of the pool, the number of cores by default.
+        """
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = None
+
+    def threads(self, devices):
+        """
+        Return the number of tasks running at once in a worker process, the
+        open files of this process being its own.
+        """
+        return 1
+
+    def map(self, func, tasks, progress=None, aborted=None):
+        """
+        Call func(*args) for all (device, args) tasks, and return the results
+        in the order of tasks, like HashExecutor.map.
+        func must be a module level function, to be sent to the workers.
+        """
+        results = [None] * len(tasks)
+        if not tasks:
+            return results
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+
+        # send tasks in chunks to limit the number of round trips
+        chunksize = max(1, len(tasks) // (self.processes * 8))
+        done = 0
+        iterator = self.pool.imap_unordered(_call,
+                ((i, func, args) for i, (device, args) in enumerate(tasks)),
+                chunksize)
+        while done < len(tasks):
+            if aborted is not None and aborted():
+                # workers don't see the abort flag, kill them
+                self.pool.terminate()
+                self.pool = None
+                return
+            try:
+                i, result = iterator.next(timeout=0.1)
+            except multiprocessing.TimeoutError:
+                continue
+            results[i] = result
+            done += 1
+            if progress:
+                progress(done, len(tasks))
+        return results
+
+    def stream(self, func, maxsize=1000):
+        """
+        Return a ProcessTaskStream running func in the worker processes.
+        """
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        return ProcessTaskStream(self, func, maxsize)
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class ProcessTaskStream(object):
+    """
+    TaskStream of a ProcessHashExecutor. submit() blocks when maxsize tasks
+    are already running.
+    """
+
+    def __init__(self, executor, func, maxsize=1000):
+        self.executor = executor
+        self.func = func
+        self.results = Queue.Queue()
+        self.slots = threading.Semaphore(maxsize)
+        self.pending = 0
+
+    def submit(self, device, args, token):
+        """
+        Queue func(*args), token being returned along with its result.
+        """
+        def done(result):
+            self.slots.release()
+            self.results.put((token, result[1]))
+        self.slots.acquire()
+        self.pending += 1
+        self.executor.pool.apply_async(_call_safe, ((0, self.func, args),),
+                                       callback=done)
+
+    def get(self, timeout=None):
+        """
+        Return the next (token, result) tuple, like TaskStream.get.
+        """
+        if timeout == 0:
+            token, result = self.results.get_nowait()
+        else:
+            token, result = self.results.get(timeout=timeout)
+        self.pending -= 1
+        if isinstance(result, Exception):
+            raise result
+        return token, result
+
+    def cancel(self):
+        """
+        Kill the workers, they don't see the abort flag.
+        """
+        if self.executor.pool is not None:
+            self.executor.pool.terminate()
+            self.executor.pool = None
+
+    def close(self):
+        """
+        Nothing to release, the pool belongs to the executor.
+        """
+        pass
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Order the reads by physical location, to limit seeks on spinning disks.
+
+The inode number is a cheap approximation of the location of a file, as
+filesystems tend to allocate data close to the inode. When the filesystem
+supports the FIEMAP ioctl, the physical offset of the first extent of the
+file is used instead.
+"""
+
+import os
+import fcntl
+import struct
+
+from hashpool import is_rotational
+
+# available orders.
+POLICIES = ('auto', 'none', 'inode', 'fiemap')
+
+# _IOWR('f', 11, struct fiemap)
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQLLLL')
+FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+
+
+def first_extent(path):
+    """
+    Return the physical offset of the first extent of a file, or None if
+    it is unknown (no FIEMAP support, empty or inline file).
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        request = FIEMAP_HEADER.pack(0, 0xffffffffffffffff, 0, 0, 1, 0)
+        request += '\0' * FIEMAP_EXTENT.size
+        try:
+            reply = fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+        except IOError:
+            return None
+        mapped = FIEMAP_HEADER.unpack_from(reply)[3]
+        if not mapped:
+            return None
+        return FIEMAP_EXTENT.unpack_from(reply, FIEMAP_HEADER.size)[1]
+    finally:
+        os.close(fd)
+
+
+class IOScheduler(object):
+    """
+    Sort reads by physical location, with an order policy per device.
+    """
+
+    def __init__(self, policy='auto', devices=None):
+        """
+        policy is one of POLICIES, devices an optional dict of st_dev to
+        policy overriding it.
+        'auto' uses FIEMAP on spinning disks, and keeps the order as is on
+        the other devices.
+        """
+        if policy not in POLICIES:
+            raise ValueError('unknown I/O order: %s' % policy)
+        self.policy = policy
+        self.devices = dict(devices or {})
+        # first extent offsets, by (device, inode), as each stage orders
+        # the same files again
+        self.offsets = {}
+
+    def device_policy(self, device):
+        """
+        Return the order policy of the given st_dev.
+        """
+        policy = self.devices.get(device, self.policy)
+        if policy == 'auto':
+            policy = 'fiemap' if is_rotational(device) else 'none'
+            self.devices[device] = policy
+        return policy
+
+    def sort_key(self, record):
+        """
+        Return the sort key of a FileRecord, or None to keep its position.
+        """
+        policy = self.device_policy(record.device)
+        if policy == 'none':
+            return None
+        if policy == 'fiemap':
+            inode = (record.device, record.inode)
+            try:
+                offset = self.offsets[inode]
+            except KeyError:
+                offset = self.offsets[inode] = first_extent(record.path)
+            if offset is not None:
+                return (record.device, offset)
+        return (record.device, record.inode)
+
+    def order(self, items, record=lambda item: item):
+        """
+        Return items sorted by physical location of their record.
+        Items of devices without order keep their relative position.
+        """
+        keyed = []
+        for i, item in enumerate(items):
+            key = self.sort_key(record(item))
+            if key is None:
+                key = (record(item).device, 0)
+            keyed.append((key, i, item))
+        keyed.sort()
+        return [item for key, i, item in keyed]
+
+
+def parse_policies(values):
+    """
+    Return the (policy, devices) of a list of 'POLICY' or 'PATH=POLICY'
+    strings, as given on the command line.
+    """
+    policy = 'auto'
+    devices = {}
+    for value in values or []:
+        path, sep, name = value.rpartition('=')
+        if name not in POLICIES:
+            raise ValueError('unknown I/O order: %s' % name)
+        if sep:
+            devices[os.stat(path).st_dev] = name
+        else:
+            policy = name
+    return policy, devices
@@ -11,17 +11,37 @@ NAME = 'Jankis Duplicate Finder'
 VERSION = '0.1'
 CONFIG_FILE = 'jankis.conf'
 
-print '%s (%s)' % (NAME, VERSION)
-
 import os
+import re
 import sys
+
+# not on stdout, which may be read by another program
+sys.stderr.write('%s (%s)\n' % (NAME, VERSION))
 import time
 from optparse import OptionParser
 
 import finder
+import pipeline
 from finder import scan, current_file
+from hashcache import HashCache, MAX_ENTRIES
+from hashpool import HashExecutor, ProcessHashExecutor
+from snapshot import Snapshot
+import watch
+import hashers
+import ioorder
+import filters
+import actions
+from mounts import MountPolicy, SKIPPED_TYPES
+from metrics import Metrics
+import output
 
 quiet = False
+# matches are printed as soon as they are found
+streaming = False
+# progress and stats go there, matches go to stdout
+info = sys.stdout
+# the machine readable output Writer, if any
+writer = None
 
 
 def expand_size_suffix(size):
@@ -38,6 +58,28 @@ def expand_size_suffix(size):
     return intsize * multiplier 
 
 
+def make_filter(options):
+    """
+    Return the PathFilter of the command line options.
+    """
+    def split(values):
+        return [value for values in values for value in values.split(',')
+                if value]
+    exclude = list(options.exclude)
+    exclude_dirs = list(options.exclude_dirs)
+    if options.exclude_common:
+        exclude += filters.COMMON_EXCLUDE
+        exclude_dirs += filters.COMMON_EXCLUDE_DIRS
+    now = time.time()
+    return filters.PathFilter(exclude=exclude, include=options.include,
+        exclude_dirs=exclude_dirs, exclude_regex=options.exclude_regex,
+        extensions=split(options.extensions),
+        exclude_extensions=split(options.exclude_extensions),
+        max_size=options.maxsize and expand_size_suffix(options.maxsize),
+        newer=options.newer and now - options.newer * 86400,
+        older=options.older and now - options.older * 86400)
+
+
 def humanize_size(size):
     """
     Return the file size as a nice, readable string.
@@ -46,6 +88,7 @@ def humanize_size(size):
         hsize = float(size) / limit
         if hsize > 0.5:
             return '%.1f%s' % (hsize, suffix)
+    return '%dB' % size
 
 
 next_progress = 0
@@ -57,37 +100,112 @@ def added_file(filename):
         if t < next_progress:
             return
         c = ['-','\\','|','/'][int(t)%4]
-        sys.stdout.write('Scanning... %s\r' % c)
-        sys.stdout.flush()
+        info.write('Scanning... %s\r' % c)
+        info.flush()
         next_progress = t + 1
 
 
+def applied_actions(done, skipped, total):
+    """Called when a batch of actions of a plan is done."""
+    if not quiet:
+        info.write('Applying... %d/%d\r' % (done + skipped, total))
+        info.flush()
+
+
+def apply_plan(options):
+    """
+    Apply, resume or roll back the plan of --apply or --rollback.
+    """
+    if options.rollback:
+        failed = actions.rollback_plan(options.rollback + '.journal')
+        for path in failed:
+            print >>info, 'not restored: %s' % path
+        return
+    engine = actions.apply_plan(actions.load_plan(options.apply),
+                                options.apply + '.journal',
+                                verify_digest=options.verify_digest,
+                                progress=applied_actions,
+                                commit=not options.no_commit)
+    journal = engine.journal
+    if not quiet:
+        print >>info
+        for n, reason in sorted(journal.skipped.iteritems()):
+            print >>info, 'skipped: %s' % reason
+        print >>info, '%d action(s) done, %d skipped' % (len(journal.done),
+                                                         len(journal.skipped))
+
+
 def scanned_file(scanned, to_scan, match=None):
     """Called when a file is hashed by matcher."""
     global next_progress
+    if match is not None and writer is not None:
+        writer.match(match)
+    elif match is not None and streaming:
+        print_match(match)
     if not quiet:
         t = (time.time() * 10)
         if t < next_progress:
             return
-        sys.stdout.write('Scanning... %d/%d\r' % (scanned, to_scan))
-        sys.stdout.flush()
+        info.write('Scanning... %d/%d\r' % (scanned, to_scan))
+        info.flush()
         next_progress = t + 1
 
 
+printed_matches = {}
+def print_match(group):
+    """
+    Print a match as soon as it is found, or only its new files when it was
+    already printed.
+    """
+    known = printed_matches.get(id(group))
+    if known is None:
+        known = printed_matches[id(group)] = (len(printed_matches), set())
+        header = '\nGroup #%d' % known[0]
+    else:
+        header = '\nGroup #%d (continued)' % known[0]
+    i, printed = known
+    lines = []
+    for match in group:
+        filenames, size, digest, inode, mtime = match
+        size = humanize_size(size)
+        digest = hashers.short_digest(digest)
+        for n, filename in enumerate(filenames):
+            if filename in printed:
+                continue
+            printed.add(filename)
+            if n == 0:
+                lines.append('%7s %s %s' % (size, digest, filename))
+            else:
+                # hard links of the same inode
+                lines.append('%7s %*s %s' % ('', len(digest), 'link', filename))
+    if lines:
+        print header
+        print '\n'.join(lines)
+    sys.stdout.flush()
+
+
+def removed_file(filename):
+    """Called when a watched file is removed."""
+    if writer is not None:
+        writer.removed(filename)
+        return
+    for i, printed in printed_matches.itervalues():
+        if filename in printed:
+            printed.discard(filename)
+            print '\nremoved %s' % filename
+    sys.stdout.flush()
+
+
 def print_matches(matches):
     """Print the final result list."""
-    for i, group in enumerate(matches):
-        print '\nGroup #%d' % i
-        for match in group:
-            filename, size, md5 = match
-            size = humanize_size(size)
-            print '%7s %s %s' % (size, md5[:6], filename)
+    for group in matches:
+        print_match(group)
 
 
 def tui_main(*args):
 
     # parse arguments
-    usage = "usage: %prog [options] folder"
+    usage = "usage: %prog [options] folder..."
     parser = OptionParser(usage=usage)
     parser.add_option("-s", "--minimal-size", dest="minsize", default='1M',
                       help="Minimal size. (You can use size suffixes"
@@ -96,37 +214,368 @@ def tui_main(*args):
                       dest="follow_links", 
                       action="store_true",
                       help="Follow symbolinc links.")
+    parser.add_option("-x", "--one-file-system", dest="one_file_system",
+                      action="store_true",
+                      help="Do not enter the file systems mounted in the"
+                      " scanned folders.")
+    parser.add_option("--mount", dest="mounts", action="append", default=[],
+                      metavar="PATH",
+                      help="Enter the file system mounted on PATH, even if"
+                      " skipped otherwise. Can be given several times.")
+    parser.add_option("--all-mounts", dest="all_mounts", action="store_true",
+                      help="Also enter the pseudo (proc, sysfs, tmpfs...) and"
+                      " network file systems, skipped by default.")
+    parser.add_option("--exclude", dest="exclude", action="append",
+                      default=[], metavar="GLOB",
+                      help="Skip the files and folders matching GLOB, on their"
+                      " name, or on the end of their path if it has a slash."
+                      " Can be given several times.")
+    parser.add_option("--exclude-dir", dest="exclude_dirs", action="append",
+                      default=list(filters.DEFAULT_EXCLUDE_DIRS), metavar="GLOB",
+                      help="Do not walk the folders matching GLOB."
+                      " Can be given several times.")
+    parser.add_option("--exclude-regex", dest="exclude_regex",
+                      action="append", default=[], metavar="REGEX",
+                      help="Skip the files and folders whose path contains"
+                      " REGEX. Can be given several times.")
+    parser.add_option("--exclude-common", dest="exclude_common",
+                      action="store_true",
+                      help="Skip version control folders, caches and build"
+                      " outputs (%s)." % ' '.join(filters.COMMON_EXCLUDE_DIRS
+                                                  + filters.COMMON_EXCLUDE))
+    parser.add_option("--include", dest="include", action="append",
+                      default=[], metavar="GLOB",
+                      help="Only keep the files matching GLOB."
+                      " Can be given several times.")
+    parser.add_option("--ext", dest="extensions", action="append",
+                      default=[], metavar="EXT[,EXT...]",
+                      help="Only keep the files with one of these extensions.")
+    parser.add_option("--exclude-ext", dest="exclude_extensions",
+                      action="append", default=[], metavar="EXT[,EXT...]",
+                      help="Skip the files with one of these extensions.")
+    parser.add_option("--max-size", dest="maxsize", metavar="SIZE",
+                      help="Skip the files larger than SIZE.")
+    parser.add_option("--newer", dest="newer", type="float", metavar="DAYS",
+                      help="Only keep the files modified in the last DAYS.")
+    parser.add_option("--older", dest="older", type="float", metavar="DAYS",
+                      help="Only keep the files modified more than DAYS ago.")
+    parser.add_option("--stages", dest="stages",
+                      default=','.join(finder.STAGES),
+                      help="Comma separated list of hashing stages"
+                      " (default: %default).")
+    parser.add_option("--samples", dest="samples", type="int",
+                      default=finder.SAMPLES,
+                      help="Number of blocks read by the sample stage"
+                      " (default: %default).")
+    parser.add_option("--hash", dest="algorithm",
+                      default=hashers.DEFAULT_ALGORITHM,
+                      choices=hashers.available(),
+                      help="Hash algorithm of whole files, one of %s"
+                      " (default: %%default)." % ', '.join(hashers.available()))
+    parser.add_option("--partial-hash", dest="partial_algorithm",
+                      default=hashers.PARTIAL_ALGORITHM,
+                      choices=hashers.available(),
+                      help="Hash algorithm of the partial stages"
+                      " (default: %default).")
+    parser.add_option("--benchmark-hashes", dest="benchmark",
+                      action="store_true",
+                      help="Measure the speed of each hash algorithm and exit.")
+    parser.add_option("--batch", dest="batch", action="store_true",
+                      help="Walk everything before hashing, instead of"
+                      " reporting duplicates as soon as they are found."
+                      " Compares whole groups at once, and uses much less"
+                      " memory on huge trees.")
+    parser.add_option("--memory-limit", dest="memory_limit", metavar="SIZE",
+                      help="Approximate memory used for the walked files,"
+                      " spilling them to sorted files in the temporary folder"
+                      " past that size (implies --batch).")
+    parser.add_option("--walk-threads", dest="walk_threads", type="int",
+                      default=1,
+                      help="Number of folders listed at the same time, for"
+                      " network or other high latency file systems"
+                      " (default: %default).")
+    parser.add_option("--unordered", dest="walk_ordered", default=True,
+                      action="store_false",
+                      help="With --walk-threads, handle folders as soon as they"
+                      " are listed, instead of in the same order as a single"
+                      " thread walk.")
+    parser.add_option("--no-compare", dest="compare", default=True,
+                      action="store_false",
+                      help="Hash whole files instead of comparing them"
+                      " block by block.")
+    parser.add_option("--io-order", dest="io_order", action="append",
+                      metavar="[PATH=]ORDER",
+                      help="Order of reads, one of %s (default: auto, by"
+                      " physical location on spinning disks only). Can be"
+                      " given for the device of PATH only, several times."
+                      % ', '.join(ioorder.POLICIES))
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="Number of hashing threads per device (default:"
+                      " depends on the kind of device), or of processes"
+                      " with --processes (default: number of cores).")
+    parser.add_option("--processes", dest="processes", action="store_true",
+                      help="Hash in a pool of processes instead of threads,"
+                      " for files already in memory or on fast devices.")
+    parser.add_option("--no-cache", dest="use_cache", default=True,
+                      action="store_false",
+                      help="Do not use the hash cache.")
+    parser.add_option("--rebuild-cache", dest="rebuild_cache",
+                      action="store_true",
+                      help="Forget all cached hashes before scanning.")
+    parser.add_option("--prune-cache", dest="prune_cache",
+                      action="store_true",
+                      help="Remove the hashes of deleted or modified files"
+                      " from the cache.")
+    parser.add_option("--cache-size", dest="cache_size", type="int",
+                      default=MAX_ENTRIES,
+                      help="Maximal number of cached hashes"
+                      " (default: %default).")
+    parser.add_option("--snapshot", dest="snapshot", metavar="FILE",
+                      help="Save the scanned tree in FILE, and only list the"
+                      " folders changed since the previous scan saved there.")
+    parser.add_option("--trust-snapshot", dest="trust_snapshot",
+                      action="store_true",
+                      help="Do not check the files of the folders unchanged"
+                      " since the snapshot, files rewritten in place are"
+                      " then missed.")
+    parser.add_option("--watch", dest="watch", action="store_true",
+                      help="Keep running after the scan, reporting the new"
+                      " duplicates as soon as they are written.")
+    parser.add_option("--metrics", dest="metrics", metavar="FILE",
+                      help="Write the scan metrics to FILE, in the Prometheus"
+                      " text format if it ends with .prom, as JSON otherwise.")
+    parser.add_option("--metrics-interval", dest="metrics_interval",
+                      type="float", metavar="SECONDS",
+                      help="Also write the metrics every SECONDS during the"
+                      " scan.")
+    parser.add_option("--format", dest="format", default="text",
+                      choices=['text'] + sorted(output.FORMATS),
+                      help="Output format of the matches, one of text, %s"
+                      " (default: %%default). Matches are written as soon as"
+                      " they are found, progress and stats go to stderr."
+                      % ', '.join(sorted(output.FORMATS)))
+    parser.add_option("-0", "--null", dest="null", action="store_true",
+                      help="End csv and jsonl records with NUL instead of"
+                      " a newline.")
+    parser.add_option("--plan", dest="plan", metavar="PLAN",
+                      help="Write to the PLAN json file the actions removing"
+                      " the duplicates found, to be checked then applied"
+                      " with --apply.")
+    parser.add_option("--plan-action", dest="plan_action",
+                      default=actions.DELETE,
+                      choices=[actions.DELETE, actions.LINK],
+                      help="With --plan, delete the duplicates or replace"
+                      " them by hard links to the original, one of delete,"
+                      " link (default: %default).")
+    parser.add_option("--plan-keep", dest="plan_keep", default="oldest",
+                      choices=sorted(actions.KEEP),
+                      help="With --plan, original kept of each match, one of"
+                      " %s (default: %%default)." % ', '.join(sorted(actions.KEEP)))
+    parser.add_option("--apply", dest="apply", metavar="PLAN",
+                      help="Delete and link files as listed in the PLAN json"
+                      " file instead of scanning, journaled in PLAN.journal."
+                      " Run it again to resume after an interruption.")
+    parser.add_option("--verify-digest", dest="verify_digest",
+                      action="store_true",
+                      help="With --apply, also check the digest of the files"
+                      " before acting on them.")
+    parser.add_option("--no-commit", dest="no_commit", action="store_true",
+                      help="With --apply, keep the original files hidden"
+                      " next to them, to be put back with --rollback.")
+    parser.add_option("--rollback", dest="rollback", metavar="PLAN",
+                      help="Put back the files changed by an interrupted or"
+                      " uncommitted --apply PLAN.")
     parser.add_option("-q", "--quiet",
                       dest="quiet", 
                       action="store_true",
                       help="Do not display progress info.")
 
     (options, args) = parser.parse_args()
-    if len(args) != 1:
+    if options.benchmark:
+        for name, speed in hashers.benchmark():
+            print '%8s %10s/s' % (name, humanize_size(speed))
+        return
+    global quiet, streaming, info, writer
+    if options.apply or options.rollback:
+        quiet = options.quiet
+        try:
+            apply_plan(options)
+        except (ValueError, EnvironmentError), err:
+            parser.error(str(err))
+        except KeyboardInterrupt:
+            print >>info, '\ninterrupted, run again to resume'
+        return
+    if not args and not options.prune_cache:
         parser.error("incorrect number of arguments")    
+    if options.plan and options.watch:
+        parser.error("--plan can't be used with --watch")
         
-    folder = args[0]
+    folders = args
     minimal_size = expand_size_suffix(options.minsize)
     follow_links = options.follow_links
     quiet = options.quiet
+    try:
+        path_filter = make_filter(options)
+    except re.error, err:
+        parser.error('invalid --exclude-regex: %s' % err)
+    stages = options.stages.split(',')
+    for stage in stages:
+        if stage not in finder.STAGES:
+            parser.error('unknown stage %r in --stages, use %s'
+                         % (stage, ','.join(finder.STAGES)))
+    mount_policy = MountPolicy(options.one_file_system, options.mounts,
+                               () if options.all_mounts else SKIPPED_TYPES)
+    if options.format != 'text':
+        info = sys.stderr
+        writer = output.FORMATS[options.format](sys.stdout, options.null)
+
+    cache = None
+    if options.use_cache:
+        cache = HashCache(max_entries=options.cache_size)
+        if options.rebuild_cache:
+            cache.clear()
+        if options.prune_cache:
+            removed = cache.prune()
+            if not quiet:
+                print >>info, '%d hash(es) removed from cache' % removed
+        if not folders:
+            cache.close()
+            return
+
+    try:
+        policy, devices = ioorder.parse_policies(options.io_order)
+    except (ValueError, OSError), err:
+        parser.error(str(err))
+
+    if options.processes:
+        executor = ProcessHashExecutor(options.jobs)
+    else:
+        executor = HashExecutor(options.jobs)
+
+    metrics = None
+    if options.metrics:
+        metrics = Metrics()
+        if options.metrics_interval:
+            metrics.start_export(options.metrics, options.metrics_interval)
+
+    snapshot = None
+    hashes = cache
+    if options.snapshot:
+        snapshot = hashes = Snapshot(options.snapshot, cache,
+                                     options.trust_snapshot)
+
+    if options.watch:
+        streaming = True
+        dupfinder = pipeline.StreamingFinder(stages=stages,
+                                             samples=options.samples, cache=hashes,
+                                             executor=executor,
+                                             algorithm=options.algorithm,
+                                             partial_algorithm=options.partial_algorithm,
+                                             compare=options.compare,
+                                             scheduler=ioorder.IOScheduler(policy, devices),
+                                             metrics=metrics)
+        try:
+            watch.watch(folders, minimal_size, follow_links,
+                        add_match_callback=scanned_file,
+                        removed_callback=removed_file,
+                        finder=dupfinder,
+                        path_filter=path_filter,
+                        mounts=mount_policy)
+        except KeyboardInterrupt:
+            pass
+        if writer is not None:
+            writer.close()
+        executor.close()
+        if cache is not None:
+            cache.close()
+        if metrics is not None:
+            metrics.stop_export()
+            metrics.export(options.metrics)
+        return
 
     # scan folder
     start = time.time()
-    matches = scan(folder, minimal_size, follow_links,
+    memory_limit = None
+    if options.memory_limit:
+        memory_limit = expand_size_suffix(options.memory_limit)
+    if options.batch or memory_limit:
+        dupfinder = finder.DuplicateFinder(stages=stages,
+                                           samples=options.samples, cache=hashes,
+                                           executor=executor,
+                                           algorithm=options.algorithm,
+                                           partial_algorithm=options.partial_algorithm,
+                                           compare=options.compare,
+                                           scheduler=ioorder.IOScheduler(policy, devices),
+                                           memory_limit=memory_limit,
+                                           metrics=metrics)
+        scan_folders = scan
+    else:
+        streaming = True
+        dupfinder = pipeline.StreamingFinder(stages=stages,
+                                             samples=options.samples, cache=hashes,
+                                             executor=executor,
+                                             algorithm=options.algorithm,
+                                             partial_algorithm=options.partial_algorithm,
+                                             compare=options.compare,
+                                             scheduler=ioorder.IOScheduler(policy, devices),
+                                             metrics=metrics)
+        scan_folders = pipeline.scan
+    matches = scan_folders(folders, minimal_size, follow_links,
         add_file_callback=added_file,
         add_match_callback=scanned_file,
+        finder=dupfinder,
+        snapshot=snapshot,
+        walk_threads=options.walk_threads,
+        walk_ordered=options.walk_ordered,
+        path_filter=path_filter,
+        mounts=mount_policy,
     )
+    executor.close()
+    if cache is not None:
+        cache.close()
+    if metrics is not None:
+        metrics.stop_export()
+        metrics.export(options.metrics)
     duration = time.time()-start
     if not quiet:
-        print
-        print 'Found %d matche(s) in %.3fs' % (len(matches), duration)
-    print_matches(matches)
+        print >>info
+        print >>info, 'Found %d matche(s) in %.3fs' % (len(matches), duration)
+        print >>info, '%d file(s) with an unique size skipped without reading' % (
+            dupfinder.skippedfiles)
+        print >>info, '%d hard link(s) read only once' % dupfinder.linkedfiles
+        for stage in dupfinder.stages:
+            print >>info, '%d file(s) eliminated by the %s stage' % (
+                dupfinder.eliminated[stage], stage)
+        print >>info, '%s reclaimable' % humanize_size(dupfinder.dupsize)
+        if cache is not None:
+            print >>info, 'cache: %d hit(s), %d miss(es)' % (cache.hits, cache.misses)
+        if snapshot is not None:
+            print >>info, 'snapshot: %d folder(s) unchanged, %d listed, %d hash(es) reused' % (
+                snapshot.reused, snapshot.listed, snapshot.hits)
+    if writer is not None:
+        writer.close()
+    elif not streaming:
+        print_matches(matches)
+    if options.plan:
+        keep = actions.KEEP[options.plan_keep]
+        plan = []
+        for match in matches:
+            plan += actions.match_actions(match, options.plan_action, keep)
+        try:
+            actions.save_plan(options.plan, plan)
+        except EnvironmentError, err:
+            parser.error(str(err))
+        if not quiet:
+            print >>info, '%d action(s) written to %s' % (len(plan), options.plan)
 
 
 try:
     from jankis_gtk import gui_main as main
 except ImportError:
     main = tui_main
+if len(sys.argv) > 1:
+    # command line options are only for the text interface
+    main = tui_main
     
 main(NAME, VERSION, 'ui.glade')
 
@@ -13,6 +13,8 @@ CONFIG_FILE = 'jankis.conf'
 
 import os
 import time
+import threading
+from collections import OrderedDict
 
 import gtk
 import gobject
@@ -20,49 +22,52 @@ gobject.threads_init()
 import pango
 
 import finder
-from finder import walk, scan, current_file
-from ui import GladeWindow, threaded, humanize_size, append_column
+import pipeline
+from hashcache import HashCache
+from metrics import Metrics
+import hashers
+import filters
+import actions
+from mounts import MountPolicy
+import matchmodel
+from matchmodel import MatchModel, MatchFile
+from ui import GladeWindow, threaded, gtk_idle, humanize_size, append_column
 
 
 class MatchList(object):
     """
     Manage the list of matches.
+    Matches can be added from any thread: they are queued, and added to
+    the model by batches when the main loop is idle, a match reported
+    several times in the meantime being added once.
     """
-    HUMAN_FILENAME, FILENAME, HUMAN_SIZE, SIZE, MD5, ORIGINAL, DELETE, DELETABLE, LINK, LINKABLE, VISIBLE, MATCH_ID = range(12)
+    HUMAN_FILENAME, FILENAME, HUMAN_SIZE, SIZE, MD5, ORIGINAL, DELETE, DELETABLE, LINK, LINKABLE, VISIBLE, MATCH_ID, INODE, HUMAN_MD5 = range(14)
+
+    # longest time spent adding matches before handing back to the main loop
+    BATCH_TIME = 0.05
+    # groups are shown expanded until the list has that many rows
+    EXPAND_ROWS = 5000
 
     def __init__(self, treeview):
         """
         Create the model and prepare the treeview.
         """
         self.treeview = treeview
+        self.lock = threading.Lock()
 
-        self.liststore = apply(gtk.ListStore, [
-              gobject.TYPE_STRING,    # human filename
-              gobject.TYPE_STRING,    # filename
-              gobject.TYPE_STRING,    # human size
-              gobject.TYPE_INT,       # size
-              gobject.TYPE_STRING,    # md5
-              gobject.TYPE_BOOLEAN,   # original
-              gobject.TYPE_BOOLEAN,   # delete
-              gobject.TYPE_BOOLEAN,   # deletable
-              gobject.TYPE_BOOLEAN,   # link
-              gobject.TYPE_BOOLEAN,   # linkable
-              gobject.TYPE_BOOLEAN,   # visible
-              gobject.TYPE_INT,       # match id
-        ])
         append_column(self.treeview, 'Keep', gtk.CellRendererToggle,
             renderer_properties=dict(activatable=True, radio=True),
-            signals=dict(toggled=[self.on_original_toggled, self.liststore, self.ORIGINAL]),
+            signals=dict(toggled=[self.on_original_toggled]),
             column_mapping=dict(active=self.ORIGINAL, visible=self.VISIBLE))
 
         append_column(self.treeview, 'Delete', gtk.CellRendererToggle,
             renderer_properties=dict(activatable=True),
-            signals=dict(toggled=[self.on_delete_toggled, self.liststore, self.DELETE]),
+            signals=dict(toggled=[self.on_delete_toggled]),
             column_mapping=dict(active=self.DELETE, visible=self.VISIBLE, sensitive=self.DELETABLE))
 
         append_column(self.treeview, 'Link', gtk.CellRendererToggle,
             renderer_properties=dict(activatable=True),
-            signals=dict(toggled=[self.on_link_toggled, self.liststore, self.LINK]),
+            signals=dict(toggled=[self.on_link_toggled]),
             column_mapping=dict(active=self.LINK, visible=self.VISIBLE, sensitive=self.LINKABLE))
 
         append_column(self.treeview, 'Filename',
@@ -73,128 +78,115 @@ class MatchList(object):
             column_mapping=dict(markup=self.HUMAN_SIZE))
 
         append_column(self.treeview, 'Hash',
-            column_mapping=dict(markup=self.MD5))
+            column_mapping=dict(markup=self.HUMAN_MD5))
 
-        self.treeview.set_model(self.liststore)
         self.clear()
 
     def clear(self):
         """
         Remove all matches.
         """
-        self.liststore.clear()
-        self.nb_matches = 0
+        with self.lock:
+            # matches waiting to be added, by id
+            self.pending = OrderedDict()
+            self.flushing = False
+        # a new model is much faster than removing each row
+        self.model = MatchModel()
+        self.treeview.set_model(self.model)
+
+    @property
+    def nb_matches(self):
+        return len(self.model.groups)
 
     def add(self, match):
         """
-        Add a new match.
-        """
-        size = 0
-        for duplicate in match:
-            size += duplicate[1]
-
-        self.liststore.append(['<i>Group %d</i>' % (self.nb_matches + 1), '',
-                    '<b>%s</b>' % humanize_size(size),
-                    size,
-                    '', False, False, False, False, False, False, -1])
-        for i, duplicate in enumerate(match):
-            filename, size, md5 = duplicate
-            path, filename = os.path.split(filename)
-            self.liststore.append(['<small>%s</small>/%s' % (path, filename),
-                    '%s/%s' % (path, filename),
-                    '%s' % humanize_size(size),
-                    size,
-                    md5[:6],
-                    True if i == 0 else False, False, True, False, True, True, self.nb_matches])
-        self.nb_matches += 1
-        self.validate_model()
-
-    def validate_model(self):
-        """
-        Check the model and desactivate impossible or dangerous actions.
-        TODO: only validate when inserting matches. Also, indicate links and
-              partial matches.
-              The links can be between any of the files.
-        """
-        matches = {}
-        for i, item in enumerate(self.liststore):
-            if item[self.ORIGINAL]:
-                k = item[self.MATCH_ID]
-                matches[k] = item
-
-        for item in self.liststore:
-            if item[self.ORIGINAL]:
-                item[self.DELETE] = False
-                item[self.LINK] = False
-                item[self.DELETABLE] = False
-                item[self.LINKABLE] = False
-            else:
-                item[self.DELETABLE] = True
-                item[self.LINKABLE] = True
-
-            if item[self.MATCH_ID] >= 0:
-                original_md5 = matches[item[self.MATCH_ID]][self.MD5]
-                if item[self.MD5] != original_md5:
-                    item[self.LINKABLE] = False
-                original = matches[item[self.MATCH_ID]][self.FILENAME]
-                if os.path.samefile(original, item[self.FILENAME]):
-                    item[self.LINKABLE] = False
+        Queue a new match, or the new files of an already added one.
+        """
+        with self.lock:
+            self.pending[id(match)] = match
+            if not self.flushing:
+                self.flushing = True
+                gobject.idle_add(self.flush)
+
+    def flush(self):
+        """
+        Add the queued matches to the model, for BATCH_TIME at most.
+        Return True if some are left, to be called again.
+        """
+        deadline = time.time() + self.BATCH_TIME
+        while time.time() < deadline:
+            with self.lock:
+                if not self.pending:
+                    self.flushing = False
+                    return False
+                key, match = self.pending.popitem(last=False)
+            group = self.model.add(match)
+            if self.model.rows < self.EXPAND_ROWS:
+                self.treeview.expand_row((group.index,), False)
+        return True
 
     @property
     def items(self):
         """
-        items getter
-        """
-        matches = {}
-        for i, item in enumerate(self.liststore):
-            if item[self.ORIGINAL]:
-                k = item[self.MATCH_ID]
-                matches[k] = item
-
-        to_delete = []
-        to_link = []
-        to_delete_size = 0
-        to_link_size = 0
-        for item in self.liststore:
-            if item[MatchList.DELETE]:
-                to_delete.append(item[MatchList.FILENAME])
-                to_delete_size += item[MatchList.SIZE]
-            if item[MatchList.LINK]:
-                to_link.append([item[MatchList.FILENAME], matches[item[MatchList.MATCH_ID]][self.FILENAME]])
-                to_link_size += item[MatchList.SIZE]
+        Return the MatchFiles to delete, the (MatchFile, original) to link,
+        and the space freed by each.
+        """
+        to_delete, to_link = self.model.selected()
+        deletes, links, to_delete_size, to_link_size = self.model.totals
         return to_delete, to_link, to_delete_size, to_link_size
 
-    def on_original_toggled(self, cell, path, model, col_num):
+    @property
+    def totals(self):
         """
-        Original checkbox clicked.
+        Return the number of files to delete and to link, and the space
+        freed by each.
         """
-        match_id = model[path][self.MATCH_ID]
-        for item in model:
-            if item[self.MATCH_ID] == match_id:
-                item[self.ORIGINAL] = False
+        return self.model.totals
 
-        iter = model.get_iter(path)
-        model.set_value(iter, col_num, not cell.get_active())
+    def select(self, choose, action=None):
+        """
+        Keep a file of each group, see MatchModel.select.
+        """
+        self.model.select(choose, action)
+        self.treeview.queue_draw()
+        self.changed()
 
-        self.validate_model()
+    def on_original_toggled(self, cell, path):
+        """
+        Original checkbox clicked.
+        """
+        item = self.model.row_at(path)
+        if not isinstance(item, MatchFile) or item.original:
+            return
+        item.group.keep(item.index)
+        self.model.recount(item.group)
+        self.model.changed_group(item.group)
         self.changed()
 
-    def on_delete_toggled(self, cell, path, model, col_num):
+    def on_delete_toggled(self, cell, path):
         """
         Delete checkbox clicked.
         """
-        if not model[path][self.ORIGINAL] and model[path][self.DELETABLE]:
-            iter = model.get_iter(path)
-            model.set_value(iter, col_num, not cell.get_active())
+        item = self.model.row_at(path)
+        if isinstance(item, MatchFile) and item.deletable:
+            item.delete = not item.delete
+            if item.delete:
+                item.link = False
+            self.model.recount(item.group)
+            self.model.changed_file(item)
             self.changed()
 
-    def on_link_toggled(self, cell, path, model, col_num):
+    def on_link_toggled(self, cell, path):
         """
         Link checkbox clicked.
         """
-        if not model[path][self.ORIGINAL] and model[path][self.LINKABLE]:
-            iter = model.get_iter(path)
-            model.set_value(iter, col_num, not cell.get_active())
+        item = self.model.row_at(path)
+        if isinstance(item, MatchFile) and item.linkable:
+            item.link = not item.link
+            if item.link:
+                item.delete = False
+            self.model.recount(item.group)
+            self.model.changed_file(item)
             self.changed()
 
 
@@ -206,6 +198,10 @@ def load_conf(obj):
         'min_file_size': 10,
         'file_size_multiplier': 2,
         'follow_links': True,
+        'use_cache': True,
+        'hash_algorithm': hashers.DEFAULT_ALGORITHM,
+        'exclude': '',
+        'exclude_common': True,
     }
     conf = dict(defaults)
     try:
@@ -222,7 +218,8 @@ def save_conf(obj):
     """
     Save configuration object to disk.
     """
-    items = ['min_file_size', 'file_size_multiplier', 'follow_links']
+    items = ['min_file_size', 'file_size_multiplier', 'follow_links', 'use_cache',
+             'hash_algorithm', 'exclude', 'exclude_common']
     conf = {}
     for i in items:
         conf[i] = getattr(obj, i)
@@ -244,13 +241,46 @@ class JankisWindow(GladeWindow):
         self.mainwindow.show()
         self.scanning = False
         self.files_scanned = 0
+        self.files_walked = 0
         self.files_to_scan = None
+        self.metrics = None
 
         cell = gtk.CellRendererText()
         self.combobox_file_size_multiplier.pack_start(cell, True)
         self.combobox_file_size_multiplier.add_attribute(cell, 'text', 0)
 
+        cell = gtk.CellRendererText()
+        self.combobox_hash_algorithm.pack_start(cell, True)
+        self.combobox_hash_algorithm.add_attribute(cell, 'text', 0)
+        for name in hashers.available():
+            self.liststore_hash_algorithms.append([name])
+
         load_conf(self)
+        if os.path.exists(actions.default_journal_path()):
+            gobject.idle_add(self.ask_interrupted)
+
+    def ask_interrupted(self):
+        """
+        Ask whether to resume or roll back the changes of an interrupted
+        apply, or to leave them for later.
+        """
+        dialog = gtk.MessageDialog(self.mainwindow, gtk.DIALOG_MODAL,
+                                   gtk.MESSAGE_QUESTION, gtk.BUTTONS_NONE,
+                                   'Changes were interrupted')
+        dialog.format_secondary_text('Some of the selected files may already'
+                ' be deleted or linked. Finish the changes, undo them, or'
+                ' decide later: nothing else can be applied until then.')
+        dialog.add_buttons('_Later', gtk.RESPONSE_CANCEL,
+                           '_Roll back', gtk.RESPONSE_REJECT,
+                           '_Resume', gtk.RESPONSE_ACCEPT)
+        dialog.set_default_response(gtk.RESPONSE_CANCEL)
+        response = dialog.run()
+        dialog.destroy()
+        if response == gtk.RESPONSE_ACCEPT:
+            self.resume_changes()
+        elif response == gtk.RESPONSE_REJECT:
+            self.rollback_changes()
+        return False
 
     def clear(self):
         """
@@ -280,6 +310,41 @@ class JankisWindow(GladeWindow):
             folders = self.folderchooserdialog.get_filenames()
             self.scan(folders)
 
+    def on_menu_keep_oldest_activate(self, *args):
+        """
+        Delete all files but the oldest of each group.
+        """
+        self.matchlist.select(matchmodel.oldest, 'delete')
+
+    def on_menu_keep_shortest_activate(self, *args):
+        """
+        Delete all files but the one with the shortest path of each group.
+        """
+        self.matchlist.select(matchmodel.shortest_path, 'delete')
+
+    def on_menu_keep_folder_activate(self, *args):
+        """
+        Display a folder chooser dialog, and delete all files but one in
+        that folder of each group having one there.
+        """
+        response = self.folderchooserdialog.run()
+        self.folderchooserdialog.hide()
+        if response:
+            folder = self.folderchooserdialog.get_filename()
+            self.matchlist.select(matchmodel.in_folder(folder), 'delete')
+
+    def on_menu_link_all_activate(self, *args):
+        """
+        Link all files of each group to the kept one.
+        """
+        self.matchlist.select(matchmodel.current, 'link')
+
+    def on_menu_unselect_all_activate(self, *args):
+        """
+        Unselect all files.
+        """
+        self.matchlist.select(matchmodel.current, 'none')
+
     def on_button_apply_clicked(self, *args):
         """
         Apply change list.
@@ -288,27 +353,87 @@ class JankisWindow(GladeWindow):
 
     @threaded
     def apply_changes(self, deletes, links, deletes_size, links_size):
-        self.mainwindow.set_sensitive(False)
-        self.status('Enlarging your free disk space...')
-        todo = len(deletes) + len(links)
-        done = 0.0
-        for f in deletes:
-            print('delete: %s' % f)
-            os.remove(f)
-            done += 1
-            self.progressbar.set_fraction(done/todo)
-        for d, s in links:
-            print('link: %s -> %s' % (s, d))
-            tmp = d+'-todelete'
-            os.rename(d, tmp)
-            os.link(s, d)
-            os.remove(tmp)
-            done += 1
-            self.progressbar.set_fraction(done/todo)
-        self.progressbar.set_fraction(0)
-        self.status('%d delete(s), %d link(s), freed %s' % (len(deletes), len(links), humanize_size(deletes_size + links_size)))
-        self.mainwindow.set_sensitive(True)
-        self.apply_frame.hide()
+        """
+        Delete and link the selected files, in another thread.
+        """
+        self.applying(True, 'Enlarging your free disk space...')
+        # checked against what was scanned: a file modified since is kept
+        plan = [actions.Action(actions.DELETE, f.path, None, f.size, f.mtime,
+                               actions.scanned_digest(f.digest))
+                for f in deletes]
+        plan += [actions.Action(actions.LINK, d.path, s.path, d.size, d.mtime,
+                                actions.scanned_digest(d.digest))
+                 for d, s in links]
+        status = None
+        try:
+            status = self.run_actions(plan) or '%d delete(s), %d link(s), freed %s' % (len(deletes), len(links), humanize_size(deletes_size + links_size))
+        finally:
+            self.applying(False, status)
+
+    @threaded
+    def resume_changes(self):
+        """
+        Finish the changes interrupted by a crash, in another thread.
+        """
+        self.applying(True, 'Finishing interrupted changes...')
+        status = None
+        try:
+            status = self.run_actions(None)
+        finally:
+            self.applying(False, status)
+
+    @threaded
+    def rollback_changes(self):
+        """
+        Undo the changes interrupted by a crash, in another thread.
+        """
+        self.applying(True, 'Undoing interrupted changes...')
+        status = None
+        try:
+            failed = actions.rollback_plan(actions.default_journal_path())
+            for path in failed:
+                print('not restored: %s' % path)
+            if failed:
+                status = '%d file(s) not restored' % len(failed)
+        except (ValueError, EnvironmentError), err:
+            status = 'Changes not rolled back: %s' % err
+        finally:
+            self.applying(False, status)
+
+    def run_actions(self, plan):
+        """
+        Apply a plan, or resume the journaled one if plan is None.
+        Return why it could not be, or None.
+        """
+        path = actions.default_journal_path()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            engine = actions.apply_plan(plan, path,
+                                        progress=self.applied_actions)
+        except (ValueError, EnvironmentError), err:
+            return 'Changes not applied: %s' % err
+        for n, reason in sorted(engine.journal.skipped.iteritems()):
+            print('skipped: %s' % reason)
+        return None
+
+    @gtk_idle
+    def applied_actions(self, done, skipped, total):
+        """
+        A batch of changes was applied.
+        """
+        self.progressbar.set_fraction(float(done + skipped) / max(total, 1))
+
+    @gtk_idle
+    def applying(self, running, status=None):
+        """
+        Lock the window while changes are applied, or unlock it.
+        """
+        self.mainwindow.set_sensitive(not running)
+        self.status(status)
+        if not running:
+            self.progressbar.set_fraction(0)
+            self.apply_frame.hide()
 
     def sensitive(self):
         widgets = 'button_scan_home button_scan_filesystem button_scan_folder menubar'.split()
@@ -324,20 +449,21 @@ class JankisWindow(GladeWindow):
         self.scanning = True
         gobject.timeout_add(100, self.update_progress)
         minsize = self.get_file_size()
-        self.scan_folders(folders, minsize, self.follow_links)
+        self.scan_folders(folders, minsize, self.follow_links,
+                          self.get_path_filter())
 
     def add_file(self, filename):
         """
         A file matching criteria was just found while walking.
         """
-        self.files_scanned += 1
+        self.files_walked += 1
 
     def scanned_file(self, scanned, to_scan, match=None):
         """
-        A new duplicate file was just found.
-        match contains the info about all duplicates of a group.
+        A file was just hashed, or a new duplicate file was just found.
+        match contains the info about all duplicates of a group, to_scan is
+        an estimate growing while the walk goes on.
         """
-        self.status('Checking matches...')
         self.files_scanned = scanned
         self.files_to_scan = to_scan
         if match:
@@ -347,12 +473,12 @@ class JankisWindow(GladeWindow):
         """
         Update pending actions stats.
         """
-        to_delete, to_link, to_delete_size, to_link_size = self.matchlist.items
+        to_delete, to_link, to_delete_size, to_link_size = self.matchlist.totals
         label = []
         if to_delete:
-            label.append('<b>%d</b> file(s) to delete <i>(%s)</i>' % (len(to_delete), humanize_size(to_delete_size)))
+            label.append('<b>%d</b> file(s) to delete <i>(%s)</i>' % (to_delete, humanize_size(to_delete_size)))
         if to_link:
-            label.append('<b>%d</b> file(s) to hardlink <i>(%s)</i>' % (len(to_link), humanize_size(to_link_size)))
+            label.append('<b>%d</b> file(s) to hardlink <i>(%s)</i>' % (to_link, humanize_size(to_link_size)))
         if label:
             self.label_apply.set_markup('\n'.join(label))
             self.apply_frame.show()
@@ -360,34 +486,63 @@ class JankisWindow(GladeWindow):
             self.apply_frame.hide()
 
     @threaded
-    def scan_folders(self, folders, minimal_size=0, follow_links=False):
+    def scan_folders(self, folders, minimal_size=0, follow_links=False,
+                     path_filter=None):
         """
         Actually do the scanning, in another thread.
         """
         finder.abort = False
         self.sensitive()
-        self.status('Walking...')
-        start = time.time()
-        self.files_scanned = 0
-        files = walk(folders, minimal_size, follow_links)
-        self.files_to_scan = len(list(files))
-        print('walked in %.3ss' % (time.time()-start))
         self.status('Scanning...')
         start = time.time()
-        matches = scan(folders, minimal_size, follow_links,
+        self.files_walked = 0
+        self.files_scanned = 0
+        self.files_to_scan = None
+        cache = HashCache() if self.use_cache else None
+        algorithm = self.hash_algorithm
+        if algorithm not in hashers.ALGORITHMS:
+            algorithm = hashers.DEFAULT_ALGORITHM
+        # kept to be looked at while the scan runs
+        self.metrics = Metrics()
+        dupfinder = pipeline.StreamingFinder(cache=cache, algorithm=algorithm,
+                                             metrics=self.metrics)
+        matches = pipeline.scan(folders, minimal_size, follow_links,
             add_file_callback=self.add_file,
             add_match_callback=self.scanned_file,
+            finder=dupfinder,
+            path_filter=path_filter,
+            mounts=MountPolicy(),
         )
+        if cache is not None:
+            cache.close()
+            print('cache: %d hit(s), %d miss(es)' % (cache.hits, cache.misses))
         if finder.abort:
             print('scanning stopped')
             self.status('Cancelled')
         else:
             duration = time.time()-start
-            print('scanned in %.3fs' % duration)
-            self.status('Found %d matche(s) in %.3fs' % (len(matches), duration))
+            print('scanned %d file(s) in %.3fs' % (self.files_walked, duration))
+            print('%d hard link(s) read only once' % dupfinder.linkedfiles)
+            for stage in dupfinder.stages:
+                print('%s stage eliminated %d file(s), read %s' % (stage,
+                        dupfinder.eliminated[stage],
+                        humanize_size(self.metrics.get('bytes_read', stage=stage))))
+            self.status('Found %d matche(s) in %.3fs, %d unique size(s) skipped' % (
+                len(matches), duration, dupfinder.skippedfiles))
         self.scanning = False
         self.sensitive()
 
+    def get_path_filter(self):
+        """
+        Get the PathFilter of the excluded patterns, separated by spaces.
+        """
+        exclude = self.exclude.split()
+        exclude_dirs = list(filters.DEFAULT_EXCLUDE_DIRS)
+        if self.exclude_common:
+            exclude += filters.COMMON_EXCLUDE
+            exclude_dirs += filters.COMMON_EXCLUDE_DIRS
+        return filters.PathFilter(exclude=exclude, exclude_dirs=exclude_dirs)
+
     def get_file_size(self):
         """
         Get the selected minimal file size based on number and multiplier.
@@ -408,9 +563,9 @@ class JankisWindow(GladeWindow):
             self.progressbar.set_text('%d/%d' % (self.files_scanned, self.files_to_scan))
         else:
             self.progressbar.pulse()
-            if current_file:
+            if finder.current_file:
                 self.progressbar.set_ellipsize(pango.ELLIPSIZE_START)
-                self.progressbar.set_text(current_file)
+                self.progressbar.set_text(finder.current_file)
             else:
                 self.progressbar.set_text('')
 
@@ -429,12 +584,21 @@ class JankisWindow(GladeWindow):
         self.spinbutton_min_file_size.set_value(self.min_file_size)
         self.combobox_file_size_multiplier.set_active(self.file_size_multiplier)
         self.checkbutton_follow_links.set_active(self.follow_links)
+        self.checkbutton_exclude_common.set_active(self.exclude_common)
+        self.entry_exclude.set_text(self.exclude)
+        algorithms = hashers.available()
+        if self.hash_algorithm in algorithms:
+            self.combobox_hash_algorithm.set_active(algorithms.index(self.hash_algorithm))
 
         response = self.dialog_prefs.run()
         if response > 0:
             self.min_file_size = self.spinbutton_min_file_size.get_value_as_int()
             self.file_size_multiplier = self.combobox_file_size_multiplier.get_active()
             self.follow_links = self.checkbutton_follow_links.get_active()
+            self.exclude_common = self.checkbutton_exclude_common.get_active()
+            self.exclude = self.entry_exclude.get_text()
+            if self.combobox_hash_algorithm.get_active() >= 0:
+                self.hash_algorithm = hashers.available()[self.combobox_hash_algorithm.get_active()]
 
             save_conf(self)
 
@@ -0,0 +1,411 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Lazy tree model of the matches, for the GTK match list.
+
+Groups are the parent rows and their files the children. Only the state
+of each file is kept, in small slotted objects: the cell values (markup,
+human sizes, sensitivity of the toggles) are computed when a row is
+drawn, so the cost of a row that is never scrolled to is a few pointers.
+
+What is to be deleted or linked is accounted for per group: a change
+only recounts its group, and the totals of the model are kept up to date
+from the differences. Bulk selections change all the groups in one pass,
+and need a single redraw of the view.
+"""
+
+import os
+
+import gtk
+import gobject
+
+import hashers
+from mounts import same_device
+from ui import humanize_size
+
+(HUMAN_FILENAME, FILENAME, HUMAN_SIZE, SIZE, MD5, ORIGINAL, DELETE, DELETABLE,
+ LINK, LINKABLE, VISIBLE, MATCH_ID, INODE, HUMAN_MD5) = range(14)
+
+
+class MatchFile(object):
+    """
+    A file of a group, and what the user wants done with it.
+    """
+    __slots__ = ('group', 'index', 'path', 'size', 'digest', 'inode',
+                 'mtime', 'delete', 'link')
+
+    def __init__(self, group, index, path, size, digest, inode, mtime):
+        self.group = group
+        self.index = index
+        self.path = path
+        self.size = size
+        self.digest = digest
+        self.inode = inode
+        # in nanoseconds, when walked
+        self.mtime = mtime
+        self.delete = False
+        self.link = False
+
+    @property
+    def original(self):
+        return self.group.original == self.index
+
+    @property
+    def deletable(self):
+        return not self.original
+
+    @property
+    def linkable(self):
+        """
+        True if the file can be replaced by a hard link to the original.
+        """
+        if self.original:
+            return False
+        original = self.group.files[self.group.original]
+        return (self.digest == original.digest and
+                self.inode != original.inode and
+                same_device(self.inode, original.inode))
+
+
+class MatchGroup(object):
+    """
+    A match: its files, and which one is kept.
+    """
+    __slots__ = ('index', 'size', 'files', 'known', 'original', 'totals')
+
+    def __init__(self, index):
+        self.index = index
+        # hard links are only counted once
+        self.size = 0
+        self.files = []
+        self.known = set()
+        self.original = 0
+        # what is accounted for this group in the model totals
+        self.totals = NO_TOTALS
+
+    def count(self):
+        """
+        Return the (deletes, links, delete size, link size) of the group.
+        The size of an inode is only freed once all its paths are deleted
+        or linked, and counted as deleted if one of them is.
+        """
+        deletes = links = 0
+        # inode: [paths, paths done, deleted, size]
+        inodes = {}
+        for item in self.files:
+            state = inodes.get(item.inode)
+            if state is None:
+                state = inodes[item.inode] = [0, 0, False, item.size]
+            state[0] += 1
+            if item.delete:
+                deletes += 1
+                state[1] += 1
+                state[2] = True
+            elif item.link:
+                links += 1
+                state[1] += 1
+        delete_size = link_size = 0
+        for count, done, deleted, size in inodes.itervalues():
+            if done == count:
+                if deleted:
+                    delete_size += size
+                else:
+                    link_size += size
+        return deletes, links, delete_size, link_size
+
+    def keep(self, index, action=None):
+        """
+        Keep the file at index as the original. action is None to only
+        unselect it and the links made impossible, 'delete' or 'link' to
+        select all the other files for it, or 'none' to unselect them.
+        """
+        self.original = index
+        for item in self.files:
+            if item.index == index or action == 'none':
+                item.delete = item.link = False
+            elif action == 'delete':
+                item.delete, item.link = True, False
+            elif action == 'link':
+                item.delete, item.link = False, item.linkable
+            elif item.link and not item.linkable:
+                item.link = False
+
+
+NO_TOTALS = (0, 0, 0, 0)
+
+
+def oldest(group):
+    """
+    Return the index of the oldest file of a group.
+    """
+    return min(group.files, key=lambda item: (item.mtime, item.path)).index
+
+
+def shortest_path(group):
+    """
+    Return the index of the file of a group with the shortest path.
+    """
+    return min(group.files, key=lambda item: (len(item.path), item.path)).index
+
+
+def in_folder(folder):
+    """
+    Return a function giving the index of the first file of a group below
+    folder, or None.
+    """
+    prefix = os.path.join(os.path.abspath(folder), '')
+    def choose(group):
+        for item in group.files:
+            if item.path.startswith(prefix):
+                return item.index
+        return None
+    return choose
+
+
+def current(group):
+    """
+    Return the index of the original of a group.
+    """
+    return group.original
+
+
+class MatchModel(gtk.GenericTreeModel):
+    """
+    Tree model of the MatchGroups, with the columns of the match list.
+    """
+    column_types = (str, str, str, gobject.TYPE_INT64, str, bool, bool, bool,
+                    bool, bool, bool, int, str, str)
+
+    def __init__(self):
+        gtk.GenericTreeModel.__init__(self)
+        # rows are referenced by their MatchGroup and MatchFile objects,
+        # which are kept by self.groups
+        self.set_property('leak-references', False)
+        self.groups = []
+        # MatchGroup of each added match
+        self.matches = {}
+        self.rows = 0
+        # files to delete and to link, and the space it frees
+        self.deletes = self.links = 0
+        self.delete_size = self.link_size = 0
+
+    @property
+    def totals(self):
+        """
+        Return the (deletes, links, delete size, link size) of all groups.
+        """
+        return self.deletes, self.links, self.delete_size, self.link_size
+
+    def recount(self, group):
+        """
+        Update the totals after a change in a group.
+        """
+        totals = group.count()
+        old = group.totals
+        self.deletes += totals[0] - old[0]
+        self.links += totals[1] - old[1]
+        self.delete_size += totals[2] - old[2]
+        self.link_size += totals[3] - old[3]
+        group.totals = totals
+
+    def select(self, choose, action=None):
+        """
+        In one pass, keep the file of each group given by choose(group),
+        a group being left as is if it returns None, and apply the action
+        of MatchGroup.keep to the other files.
+        The rows are not signalled changed, the view has to be redrawn.
+        """
+        for group in self.groups:
+            index = choose(group)
+            if index is not None:
+                group.keep(index, action)
+                self.recount(group)
+
+    def selected(self):
+        """
+        Return the MatchFiles to delete, and the (MatchFile, original) to
+        link.
+        """
+        deletes = []
+        links = []
+        for group in self.groups:
+            if group.totals == NO_TOTALS:
+                continue
+            original = group.files[group.original]
+            for item in group.files:
+                if item.delete:
+                    deletes.append(item)
+                elif item.link:
+                    links.append((item, original))
+        return deletes, links
+
+    def add(self, match):
+        """
+        Add a new match, or the new files of an already added one, known by
+        its identity, signalling the new and changed rows.
+        """
+        key = id(match)
+        group = self.matches.get(key)
+        # the finder may change it in the meantime
+        match = list(match)
+        new = group is None
+        if new:
+            group = MatchGroup(len(self.groups))
+            self.groups.append(group)
+            self.matches[key] = group
+            self.rows += 1
+            self.row_inserted((group.index,), self.get_iter((group.index,)))
+
+        group.size = sum(duplicate[1] for duplicate in match)
+        if not new:
+            self.row_changed((group.index,), self.get_iter((group.index,)))
+        first = len(group.files)
+        for filenames, size, digest, inode, mtime in match:
+            for filename in filenames:
+                if filename in group.known:
+                    continue
+                group.known.add(filename)
+                group.files.append(MatchFile(group, len(group.files),
+                                             filename, size, digest, inode,
+                                             mtime))
+        for index in range(first, len(group.files)):
+            path = (group.index, index)
+            self.row_inserted(path, self.get_iter(path))
+        if first == 0 and group.files:
+            self.row_has_child_toggled((group.index,),
+                                       self.get_iter((group.index,)))
+        self.rows += len(group.files) - first
+        if group.totals != NO_TOTALS:
+            # new links of a selected inode
+            self.recount(group)
+        return group
+
+    def row_at(self, path):
+        """
+        Return the MatchGroup or MatchFile of a path, given as a string or
+        a tuple.
+        """
+        if isinstance(path, basestring):
+            path = tuple(int(i) for i in path.split(':'))
+        return self.on_get_iter(path)
+
+    def changed_group(self, group):
+        """
+        Signal that the files of a group changed.
+        """
+        for index in range(len(group.files)):
+            path = (group.index, index)
+            self.row_changed(path, self.get_iter(path))
+
+    def changed_file(self, item):
+        """
+        Signal that a file changed.
+        """
+        path = (item.group.index, item.index)
+        self.row_changed(path, self.get_iter(path))
+
+    def on_get_flags(self):
+        return 0
+
+    def on_get_n_columns(self):
+        return len(self.column_types)
+
+    def on_get_column_type(self, n):
+        return self.column_types[n]
+
+    def on_get_iter(self, path):
+        try:
+            group = self.groups[path[0]]
+            if len(path) == 1:
+                return group
+            return group.files[path[1]]
+        except IndexError:
+            return None
+
+    def on_get_path(self, rowref):
+        if isinstance(rowref, MatchGroup):
+            return (rowref.index,)
+        return (rowref.group.index, rowref.index)
+
+    def on_get_value(self, rowref, column):
+        if isinstance(rowref, MatchGroup):
+            if column == HUMAN_FILENAME:
+                return '<i>Group %d</i>' % (rowref.index + 1)
+            if column == HUMAN_SIZE:
+                return '<b>%s</b>' % humanize_size(rowref.size)
+            if column == SIZE:
+                return rowref.size
+            if column == MATCH_ID:
+                return -1
+            if column in (ORIGINAL, DELETE, DELETABLE, LINK, LINKABLE, VISIBLE):
+                return False
+            return ''
+        if column == HUMAN_FILENAME:
+            path, filename = os.path.split(rowref.path)
+            return '<small>%s</small>/%s' % (path, filename)
+        if column == FILENAME:
+            return rowref.path
+        if column == HUMAN_SIZE:
+            return humanize_size(rowref.size)
+        if column == SIZE:
+            return rowref.size
+        if column == MD5:
+            return rowref.digest
+        if column == ORIGINAL:
+            return rowref.original
+        if column == DELETE:
+            return rowref.delete
+        if column == DELETABLE:
+            return rowref.deletable
+        if column == LINK:
+            return rowref.link
+        if column == LINKABLE:
+            return rowref.linkable
+        if column == VISIBLE:
+            return True
+        if column == MATCH_ID:
+            return rowref.group.index
+        if column == INODE:
+            return '%d:%d' % rowref.inode
+        if column == HUMAN_MD5:
+            return hashers.short_digest(rowref.digest)
+
+    def on_iter_next(self, rowref):
+        if isinstance(rowref, MatchGroup):
+            siblings = self.groups
+        else:
+            siblings = rowref.group.files
+        if rowref.index + 1 < len(siblings):
+            return siblings[rowref.index + 1]
+        return None
+
+    def on_iter_children(self, rowref):
+        return self.on_iter_nth_child(rowref, 0)
+
+    def on_iter_has_child(self, rowref):
+        return isinstance(rowref, MatchGroup) and bool(rowref.files)
+
+    def on_iter_n_children(self, rowref):
+        if rowref is None:
+            return len(self.groups)
+        if isinstance(rowref, MatchGroup):
+            return len(rowref.files)
+        return 0
+
+    def on_iter_nth_child(self, rowref, n):
+        if rowref is None:
+            children = self.groups
+        elif isinstance(rowref, MatchGroup):
+            children = rowref.files
+        else:
+            return None
+        if 0 <= n < len(children):
+            return children[n]
+        return None
+
+    def on_iter_parent(self, rowref):
+        if isinstance(rowref, MatchFile):
+            return rowref.group
+        return None
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Counters and histograms of a scan.
+
+A Metrics object is filled by the walker and the finders while they run,
+and can be read at any time, or exported as JSON or in the Prometheus
+text format, at the end of a scan or periodically to a file.
+"""
+
+import os
+import json
+import time
+import threading
+
+# upper bounds of the latency histograms, in seconds.
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                   1, 5, 10, 60)
+
+# name: (kind, help) of the metrics filled by Jankis.
+METRICS = {
+    'dirs_listed': ('counter', 'Folders listed.'),
+    'dirs_pruned': ('counter', 'Folders never listed, by reason.'),
+    'stat_calls': ('counter', 'stat and lstat calls of the walk.'),
+    'files_seen': ('counter', 'Regular files walked.'),
+    'files_skipped': ('counter', 'Files skipped without being read, by reason.'),
+    'open_calls': ('counter', 'Files opened for hashing or comparing.'),
+    'bytes_read': ('counter', 'Bytes read, by hashing stage.'),
+    'cache_hits': ('counter', 'Digests found in the cache, by stage.'),
+    'cache_misses': ('counter', 'Digests missing from the cache, by stage.'),
+    'hash_seconds': ('histogram', 'Time spent hashing a file, by stage.'),
+    'stage_seconds': ('counter', 'Wall time of each scan phase.'),
+}
+
+
+def _labels(labels):
+    """
+    Return the sorted (name, value) tuples of a labels dict.
+    """
+    return tuple(sorted(labels.iteritems()))
+
+
+class Metrics(object):
+    """
+    Thread safe set of counters and histograms, with optional labels.
+    """
+
+    def __init__(self, prefix='jankis_'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # name: {labels: value}
+        self.counters = {}
+        # name: {labels: [bucket counts..., count, sum]}
+        self.histograms = {}
+        self.started = time.time()
+        self.exporter = None
+
+    def inc(self, name, value=1, **labels):
+        """
+        Add value to a counter.
+        """
+        key = _labels(labels)
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value to a histogram.
+        """
+        key = _labels(labels)
+        with self.lock:
+            values = self.histograms.setdefault(name, {})
+            counts = values.get(key)
+            if counts is None:
+                counts = values[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += 1
+            counts[-1] += value
+
+    def get(self, name, **labels):
+        """
+        Return the value of a counter, or the count of a histogram.
+        """
+        key = _labels(labels)
+        with self.lock:
+            if name in self.histograms:
+                return self.histograms[name].get(key, [0, 0])[-2]
+            return self.counters.get(name, {}).get(key, 0)
+
+    def to_dict(self):
+        """
+        Return all the metrics as a JSON compatible dict.
+        """
+        result = dict(elapsed=time.time() - self.started)
+        with self.lock:
+            for name, values in self.counters.iteritems():
+                result[name] = [dict(labels=dict(key), value=value)
+                                for key, value in sorted(values.iteritems())]
+            for name, values in self.histograms.iteritems():
+                result[name] = [dict(labels=dict(key), count=counts[-2],
+                                     sum=counts[-1],
+                                     buckets=dict(zip(LATENCY_BUCKETS,
+                                                      _cumulate(counts))))
+                                for key, counts in sorted(values.iteritems())]
+        return result
+
+    def to_json(self):
+        """
+        Return all the metrics as a JSON string.
+        """
+        return json.dumps(self.to_dict(), indent=1, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        Return all the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for name in sorted(set(self.counters) | set(self.histograms)):
+                kind, help = METRICS.get(name, ('counter', name))
+                full = self.prefix + name
+                if kind == 'counter' and not full.endswith('_total'):
+                    full += '_total'
+                lines.append('# HELP %s %s' % (full, help))
+                lines.append('# TYPE %s %s' % (full, kind))
+                if name in self.histograms:
+                    for key, counts in sorted(self.histograms[name].iteritems()):
+                        for bound, count in zip(LATENCY_BUCKETS, _cumulate(counts)):
+                            lines.append('%s_bucket%s %d' % (full,
+                                    _format_labels(key + (('le', repr(bound)),)),
+                                    count))
+                        lines.append('%s_bucket%s %d' % (full,
+                                _format_labels(key + (('le', '+Inf'),)), counts[-2]))
+                        lines.append('%s_count%s %d' % (full, _format_labels(key),
+                                                        counts[-2]))
+                        lines.append('%s_sum%s %r' % (full, _format_labels(key),
+                                                      counts[-1]))
+                else:
+                    for key, value in sorted(self.counters[name].iteritems()):
+                        lines.append('%s%s %r' % (full, _format_labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """
+        Write the metrics to path, as Prometheus text if its extension is
+        .prom, as JSON otherwise. The file is replaced at once.
+        """
+        if path.endswith('.prom'):
+            data = self.to_prometheus()
+        else:
+            data = self.to_json()
+        temp = path + '.tmp'
+        f = open(temp, 'w')
+        f.write(data)
+        f.close()
+        os.rename(temp, path)
+
+    def start_export(self, path, interval):
+        """
+        Export the metrics to path every interval seconds, until
+        stop_export() is called.
+        """
+        stop = threading.Event()
+
+        def export():
+            while not stop.wait(interval):
+                self.export(path)
+
+        thread = threading.Thread(target=export)
+        thread.daemon = True
+        thread.start()
+        self.exporter = (stop, thread, path)
+
+    def stop_export(self):
+        """
+        Stop the periodic export, writing the metrics a last time.
+        """
+        if self.exporter is not None:
+            stop, thread, path = self.exporter
+            stop.set()
+            thread.join()
+            self.exporter = None
+            self.export(path)
+
+
+def _cumulate(counts):
+    """
+    Return the cumulative counts of the histogram buckets.
+    """
+    total = 0
+    result = []
+    for count in counts[:len(LATENCY_BUCKETS)]:
+        total += count
+        result.append(total)
+    return result
+
+
+def _format_labels(key):
+    """
+    Return the Prometheus representation of (name, value) label tuples.
+    """
+    if not key:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"'))
+                             for name, value in key)
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Mount points met by a walk.
+
+The mount table is read once, from /proc/self/mountinfo, or /proc/mounts
+on older kernels. A folder can only be a mount point if its name is the
+name of one, so the walker only looks closer at those: the pseudo file
+systems (/proc, /sys, /dev...) and the remote ones are not entered by
+default, and with one_file_system no other file system than the one of
+the walked folder is.
+"""
+
+import os
+from collections import namedtuple
+
+# a mounted file system, device being its st_dev or None if unknown.
+Mount = namedtuple('Mount', 'point fstype source device')
+
+# kernel and in-memory file systems, with no user data worth scanning.
+PSEUDO_TYPES = frozenset([
+    'proc', 'sysfs', 'devtmpfs', 'devpts', 'tmpfs', 'ramfs', 'cgroup',
+    'cgroup2', 'securityfs', 'debugfs', 'tracefs', 'pstore', 'bpf',
+    'configfs', 'fusectl', 'mqueue', 'hugetlbfs', 'autofs', 'binfmt_misc',
+    'efivarfs', 'rpc_pipefs', 'nsfs', 'selinuxfs', 'nfsd', 'fuse.gvfsd-fuse',
+    'fuse.portal',
+])
+
+# network file systems, slow to walk and which may hang.
+REMOTE_TYPES = frozenset([
+    'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'ncpfs', 'afs', 'ceph',
+    'glusterfs', 'fuse.sshfs', 'fuse.rclone', 'fuse.s3fs', 'davfs',
+    'fuse.davfs2', '9p', 'lustre', 'gpfs',
+])
+
+SKIPPED_TYPES = PSEUDO_TYPES | REMOTE_TYPES
+
+
+def _unescape(field):
+    """
+    Return a field of the mount table with its octal escapes decoded.
+    """
+    if '\\' not in field:
+        return field
+    parts = field.split('\\')
+    result = [parts[0]]
+    for part in parts[1:]:
+        try:
+            result.append(chr(int(part[:3], 8)) + part[3:])
+        except ValueError:
+            result.append('\\' + part)
+    return ''.join(result)
+
+
+def read_mounts():
+    """
+    Return the Mounts of this process, in mount order, or an empty list if
+    the mount table can't be read.
+    """
+    mounts = []
+    try:
+        f = open('/proc/self/mountinfo')
+    except IOError:
+        pass
+    else:
+        for line in f:
+            fields = line.split()
+            try:
+                separator = fields.index('-', 6)
+                major, minor = fields[2].split(':')
+                mounts.append(Mount(_unescape(fields[4]),
+                                    fields[separator + 1],
+                                    _unescape(fields[separator + 2]),
+                                    os.makedev(int(major), int(minor))))
+            except (ValueError, IndexError):
+                continue
+        f.close()
+        return mounts
+    try:
+        f = open('/proc/mounts')
+    except IOError:
+        return mounts
+    for line in f:
+        fields = line.split()
+        if len(fields) >= 3:
+            mounts.append(Mount(_unescape(fields[1]), fields[2],
+                                _unescape(fields[0]), None))
+    f.close()
+    return mounts
+
+
+class MountPolicy(object):
+    """
+    Tell which mount points a walk enters.
+    """
+
+    def __init__(self, one_file_system=False, include=(),
+                 skipped_types=SKIPPED_TYPES, mounts=None):
+        """
+        one_file_system: do not leave the file system of the walked folder.
+        include: mount points always entered.
+        skipped_types: types of the file systems not entered.
+        mounts: the Mounts to use instead of reading the mount table.
+        """
+        if mounts is None:
+            mounts = read_mounts()
+        self.one_file_system = one_file_system
+        self.skipped_types = frozenset(skipped_types)
+        # the last mount on a point hides the previous ones
+        self.points = {}
+        self.devices = {}
+        for mount in mounts:
+            self.points[mount.point] = mount
+            if mount.device is not None:
+                self.devices[mount.device] = mount
+        self.names = frozenset(os.path.basename(point)
+                               for point in self.points)
+        self.include = set()
+        for point in include:
+            point = os.path.abspath(point)
+            self.include.add(point)
+            mount = self.points.get(point)
+            if mount is not None and mount.device is not None:
+                self.include.add(mount.device)
+
+    def root_device(self, top):
+        """
+        Return the device of a walked folder, or None.
+        """
+        try:
+            return os.stat(top).st_dev
+        except OSError:
+            return None
+
+    def skipped(self, mount, root_device):
+        """
+        Return True if the file system of a Mount is not to be entered.
+        """
+        if mount.point in self.include or mount.device in self.include:
+            return False
+        if mount.device is not None and mount.device == root_device:
+            return False
+        if self.one_file_system:
+            return True
+        return mount.fstype in self.skipped_types
+
+    def enter(self, path, name, root_device, st=None):
+        """
+        Return True if the walk may enter the folder at path, named name,
+        root_device being the device of the walked folder. st is the stat
+        of the folder if already known.
+        """
+        if name not in self.names:
+            # not a mount point
+            return True
+        mount = self.points.get(os.path.abspath(path))
+        if mount is not None:
+            # known without touching it, a dead remote mount would hang
+            return not self.skipped(mount, root_device)
+        # the same name as a mount point, maybe reached by another path
+        if st is None:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                return True
+        if st.st_dev == root_device:
+            return True
+        mount = self.devices.get(st.st_dev)
+        if mount is None:
+            return not self.one_file_system or st.st_dev in self.include
+        return not self.skipped(mount, root_device)
+
+
+def same_device(inode1, inode2):
+    """
+    Return True if two (device, inode) tuples are on the same device, the
+    only case where they can be hard linked.
+    """
+    return inode1[0] == inode2[0]
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Machine readable output of matches.
+
+Each writer gets the matches as soon as they are found, and writes them at
+once, so nothing is kept but the paths already written for each group: a
+group is written once as a "group" event, and its late members, found
+while streaming, as "join" events of the same group number. A group is
+only complete at the end of the output.
+Paths are bytes; in JSON, those which are not valid UTF-8 are given as
+base64 in path_b64 instead of path.
+"""
+
+import csv
+import json
+import base64
+
+
+class Writer(object):
+    """
+    Base of the output formats, writing nothing.
+    """
+
+    def __init__(self, stream, null=False):
+        """
+        Write to stream, ending records with NUL instead of a newline if
+        null is True.
+        """
+        self.stream = stream
+        self.end = '\0' if null else '\n'
+        # (group number, written paths) of each match
+        self.groups = {}
+
+    def new_files(self, group):
+        """
+        Return the event of a match, "group" if it was not written yet or
+        "join" for late members, its group number, and its (size, digest,
+        device, inode, path) files not written yet.
+        """
+        known = self.groups.get(id(group))
+        event = 'join'
+        if known is None:
+            known = self.groups[id(group)] = (len(self.groups), set())
+            event = 'group'
+        number, written = known
+        files = []
+        for filenames, size, digest, inode, mtime in group:
+            for filename in filenames:
+                if filename not in written:
+                    written.add(filename)
+                    files.append((size, digest, inode[0], inode[1], filename))
+        return event, number, files
+
+    def match(self, group):
+        """
+        Write a new match, or the new paths of a known one.
+        """
+        pass
+
+    def forget(self, filename):
+        """
+        Forget a written path, return False if it was not written.
+        """
+        found = False
+        for number, written in self.groups.itervalues():
+            if filename in written:
+                written.discard(filename)
+                found = True
+        return found
+
+    def removed(self, filename):
+        """
+        Write that a file of a match was removed.
+        """
+        self.forget(filename)
+
+    def close(self):
+        """
+        Write the end of the output.
+        """
+        self.stream.flush()
+
+
+def _path(filename):
+    """
+    Return the JSON fields of a path.
+    """
+    try:
+        return {'path': filename.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'path_b64': base64.b64encode(filename)}
+
+
+class JsonLinesWriter(Writer):
+    """
+    One JSON object per line: a group with its files, late members joining
+    a group, or a removed path.
+    """
+
+    def group_object(self, group):
+        event, number, files = self.new_files(group)
+        if not files:
+            return None
+        size, digest = files[0][:2]
+        return {'event': event, 'group': number, 'size': size,
+                'digest': digest,
+                'files': [dict(_path(filename), device=device, inode=inode)
+                          for size, digest, device, inode, filename in files]}
+
+    def removed_object(self, filename):
+        return dict(_path(filename), event='removed')
+
+    def write(self, obj):
+        self.stream.write(json.dumps(obj, sort_keys=True) + self.end)
+        self.stream.flush()
+
+    def match(self, group):
+        obj = self.group_object(group)
+        if obj is not None:
+            self.write(obj)
+
+    def removed(self, filename):
+        if self.forget(filename):
+            self.write(self.removed_object(filename))
+
+
+class JsonWriter(JsonLinesWriter):
+    """
+    A single JSON array of the objects of JsonLinesWriter, written as they
+    come. null makes no difference.
+    """
+
+    def __init__(self, stream, null=False):
+        JsonLinesWriter.__init__(self, stream, null)
+        self.stream.write('[')
+        self.separator = '\n'
+
+    def write(self, obj):
+        self.stream.write(self.separator + json.dumps(obj, sort_keys=True))
+        self.separator = ',\n'
+        self.stream.flush()
+
+    def close(self):
+        self.stream.write('\n]\n')
+        self.stream.flush()
+
+
+class CsvWriter(Writer):
+    """
+    One row per path: event, group, size, digest, device, inode, path.
+    """
+
+    def __init__(self, stream, null=False):
+        Writer.__init__(self, stream, null)
+        self.writer = csv.writer(stream, lineterminator=self.end)
+        self.writer.writerow(['event', 'group', 'size', 'digest', 'device',
+                              'inode', 'path'])
+
+    def match(self, group):
+        event, number, files = self.new_files(group)
+        for size, digest, device, inode, filename in files:
+            self.writer.writerow([event, number, size, digest, device,
+                                  inode, filename])
+        self.stream.flush()
+
+    def removed(self, filename):
+        if self.forget(filename):
+            self.writer.writerow(['removed', '', '', '', '', '', filename])
+            self.stream.flush()
+
+
+FORMATS = {
+    'json': JsonWriter,
+    'jsonl': JsonLinesWriter,
+    'csv': CsvWriter,
+    'null': Writer,
+}
@@ -0,0 +1,604 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Streaming scan: walk, size grouping, partial hashing and verification all
+run at the same time, connected by bounded queues.
+
+Instead of waiting for the whole walk, each file is sent to the next
+hashing stage as soon as another file shares its size and the digests of
+the previous stages. A group is reported as soon as it is proven, and
+reported again each time a late file joins it.
+
+Until another inode of its size is found, a file is only a row of a
+FileTable, so the index mostly grows with the candidates, not the tree.
+
+The members a full stage node has when it starts are compared in lockstep,
+like the batch finder does, and read in physical order; the members found
+later are hashed.
+"""
+
+import time
+import threading
+import Queue
+
+import finder
+from finder import STAGES, SAMPLES, get_stage_ranges, get_stage_key, \
+                   get_stage_bytes, get_file_hash, timed_file_hash, \
+                   compare_files, timed_compare_files, open_files_limit
+from hashers import DEFAULT_ALGORITHM, PARTIAL_ALGORITHM
+from hashpool import HashExecutor
+from filetable import FileTable
+from ioorder import IOScheduler
+
+# maximal number of walked files waiting to be indexed.
+QUEUE_SIZE = 10000
+
+# unused rows of a table dropped past this number and half of its rows.
+COMPACT_ROWS = 10000
+
+
+def run_task(compare, args):
+    """
+    Run a task of the hashing stream: compare_files(*args) if compare is
+    True, get_file_hash(*args) otherwise.
+    """
+    if compare:
+        return compare_files(*args)
+    return get_file_hash(*args)
+
+
+def timed_task(compare, args):
+    """
+    Run a task like run_task, with timed_compare_files or timed_file_hash.
+    """
+    if compare:
+        return timed_compare_files(*args)
+    return timed_file_hash(*args)
+
+
+class Node(object):
+    """
+    Inodes sharing their size and the digests of the first level stages.
+    """
+    __slots__ = ('level', 'digest', 'members', 'children', 'active', 'match',
+                 'comparing', 'held')
+
+    def __init__(self, level, digest=None):
+        self.level = level
+        self.digest = digest
+        # [record, filenames, match] items
+        self.members = []
+        # next level nodes, by digest
+        self.children = {}
+        # True once members are sent to the next stage
+        self.active = False
+        # reported match, for the last level
+        self.match = None
+        # True while the members are compared, and the members which are
+        # not hashed yet: found during the comparison, or different from
+        # all the compared ones
+        self.comparing = False
+        self.held = None
+
+
+class StreamingFinder(object):
+    """
+    Incremental index of the walked files, finding duplicates as they come.
+    It has the same stats as DuplicateFinder, and uses the same stages.
+    """
+
+    def __init__(self, stages=STAGES, samples=SAMPLES, cache=None,
+                 executor=None, algorithm=DEFAULT_ALGORITHM,
+                 partial_algorithm=PARTIAL_ALGORITHM, compare=True,
+                 scheduler=None, metrics=None):
+        """
+        Create the StreamingFinder object, see DuplicateFinder.
+        """
+        self.compare = compare
+        if scheduler is None:
+            scheduler = IOScheduler()
+        self.scheduler = scheduler
+        self.stages = stages
+        self.samples = samples
+        self.cache = cache
+        if executor is None:
+            executor = HashExecutor()
+        self.executor = executor
+        self.algorithm = algorithm
+        self.partial_algorithm = partial_algorithm
+        self.metrics = metrics
+        # first level nodes, or the row in self.unique of the only inode
+        # of the size, by size
+        self.sizelist = {}
+        self.unique = FileTable()
+        self.dead = 0
+        # [record, filenames, match] items of the nodes, by (device, inode)
+        self.inodes = {}
+        self.matches = []
+        self.totalsize = 0
+        self.totalfiles = 0
+        self.skippedfiles = 0
+        self.linkedfiles = 0
+        self.eliminated = dict((stage, 0) for stage in stages)
+        self.dupfiles = 0
+        self.dupsize = 0
+        # hashing tasks submitted and done
+        self.submitted = 0
+        self.hashed = 0
+        self.stream = None
+        self.progress_listener = None
+
+    def stage_algorithm(self, stage):
+        """
+        Return the hash algorithm used by the given stage.
+        """
+        if stage == 'full':
+            return self.algorithm
+        return self.partial_algorithm
+
+    def add_record(self, record):
+        """
+        Index a walked FileRecord, sending it to the hashing stages if it
+        may have a duplicate.
+        """
+        self.totalfiles += 1
+        inode = (record.device, record.inode)
+        item = self.inodes.get(inode)
+        if item is not None:
+            # another link of a known inode
+            item[1].append(record.path)
+            self.linkedfiles += 1
+            if item[2] is not None:
+                self.report(item[2])
+            return
+
+        node = self.sizelist.get(record.size)
+        if node is None:
+            # a unique size so far
+            self.totalsize += record.size
+            self.sizelist[record.size] = self.unique.append(record)
+            return
+        if not isinstance(node, Node):
+            # the second file of this size, index the first one
+            first = self.unique.record(node)
+            self.drop_row()
+            node = self.sizelist[record.size] = Node(0)
+            item = self.inodes[(first.device, first.inode)] = [
+                    first, [first.path], None]
+            node.members.append(item)
+            if (first.device, first.inode) == inode:
+                item[1].append(record.path)
+                self.linkedfiles += 1
+                return
+
+        self.totalsize += record.size
+        item = self.inodes[inode] = [record, [record.path], None]
+        self.insert(node, item)
+
+    def drop_row(self):
+        """
+        Count a row of self.unique no longer used, dropping them all when
+        they are many.
+        """
+        self.dead += 1
+        if self.dead < COMPACT_ROWS or self.dead * 2 < len(self.unique):
+            return
+        sizes = [size for size, node in self.sizelist.iteritems()
+                 if not isinstance(node, Node)]
+        self.unique = self.unique.subset([self.sizelist[size]
+                                          for size in sizes])
+        for row, size in enumerate(sizes):
+            self.sizelist[size] = row
+        self.dead = 0
+
+    def indexed(self, inode, size):
+        """
+        Return the indexed FileRecord of a (device, inode) of the given
+        size and its paths, or None.
+        """
+        item = self.inodes.get(inode)
+        if item is not None:
+            return item[0], item[1]
+        row = self.sizelist.get(size)
+        if row is None or isinstance(row, Node) or (
+                self.unique.device[row], self.unique.inode[row]) != inode:
+            return None
+        record = self.unique.record(row)
+        return record, [record.path]
+
+    def insert(self, node, item):
+        """
+        Add an inode to a node, hashing it with the next stage when the
+        node has more than one member.
+        """
+        node.members.append(item)
+        if node.level == len(self.stages):
+            if len(node.members) > 1:
+                self.prove(node, item)
+            return
+        if node.comparing:
+            node.held.append(item)
+        elif node.active:
+            if node.held:
+                # they may be identical to this one
+                for member in node.held:
+                    self.submit(node, member)
+                node.held = None
+            self.submit(node, item)
+        elif len(node.members) > 1:
+            node.active = True
+            if not self.compare_members(node):
+                for member in self.scheduler.order(node.members,
+                                                   lambda item: item[0]):
+                    self.submit(node, member)
+
+    def compare_members(self, node):
+        """
+        Compare the members of a node of the full stage in lockstep, if
+        none of them has a cached digest and they can all be opened at once.
+        Return False if they are to be hashed instead.
+        """
+        if not self.compare or self.stages[node.level] != 'full':
+            return False
+        members = tuple(node.members)
+        device = members[0][0].device
+        if len(members) > open_files_limit(self.executor.threads([device])):
+            return False
+        if self.cache is not None:
+            key = get_stage_key('full', self.algorithm)
+            for record, filenames, match in members:
+                if self.cache.peek(record, key) is not None:
+                    return False
+        node.comparing = True
+        node.held = []
+        self.submitted += 1
+        paths = [member[0].path for member in members]
+        self.stream.submit(device, (True, (paths, self.algorithm)),
+                           (node, members))
+        return True
+
+    def submit(self, node, item):
+        """
+        Hash an inode with the stage of the given node.
+        """
+        record = item[0]
+        stage = self.stages[node.level]
+        ranges = get_stage_ranges(stage, record.size, self.samples)
+        if ranges == []:
+            # nothing new to read
+            self.advance(node, item, '')
+            return
+        algorithm = self.stage_algorithm(stage)
+        if self.cache is not None:
+            digest = self.cache.get(record,
+                    get_stage_key(stage, algorithm, self.samples))
+            if self.metrics is not None:
+                self.metrics.inc('cache_misses' if digest is None
+                                 else 'cache_hits', stage=stage)
+            if digest is not None:
+                self.advance(node, item, digest)
+                return
+        self.submitted += 1
+        self.stream.submit(record.device,
+                (False, (record.path, None, None, ranges, algorithm)),
+                (node, item))
+
+    def finished(self, token, result):
+        """
+        A task of the hashing stream is finished.
+        """
+        node, item = token
+        if isinstance(item, tuple):
+            self.compared(node, item, result)
+        else:
+            self.hashed_record(token, result)
+
+    def compared(self, node, members, identical):
+        """
+        The members of a full stage node were compared.
+        """
+        self.hashed += 1
+        if self.metrics is not None:
+            identical, seconds, read = identical
+            self.metrics.observe('hash_seconds', seconds, stage='compare')
+            self.metrics.inc('open_calls', len(members))
+            self.metrics.inc('bytes_read', read, stage='full')
+        if self.progress_listener:
+            self.progress_listener(self.hashed, self.submitted)
+        node.comparing = False
+        held = node.held
+        node.held = None
+        if identical is None:
+            # out of file descriptors
+            for member in members + tuple(held):
+                self.submit(node, member)
+            return
+        left = set(range(len(members)))
+        key = get_stage_key('full', self.algorithm)
+        for digest, indexes in identical:
+            for i in indexes:
+                left.discard(i)
+                if self.cache is not None:
+                    self.cache.put(members[i][0], key, digest)
+                self.advance(node, members[i], digest)
+        left = [members[i] for i in sorted(left)]
+        if held:
+            # they may be identical to the late ones
+            for member in left + held:
+                self.submit(node, member)
+        elif left:
+            node.held = left
+
+    def hashed_record(self, token, digest):
+        """
+        A hashing task is finished.
+        """
+        node, item = token
+        self.hashed += 1
+        if self.metrics is not None:
+            digest, seconds = digest
+            stage = self.stages[node.level]
+            self.metrics.observe('hash_seconds', seconds, stage=stage)
+            self.metrics.inc('open_calls')
+            self.metrics.inc('bytes_read', get_stage_bytes(item[0].size,
+                    get_stage_ranges(stage, item[0].size, self.samples)),
+                    stage=stage)
+        if self.progress_listener:
+            self.progress_listener(self.hashed, self.submitted)
+        if self.cache is not None and digest not in ('NONE', 'ABORT'):
+            stage = self.stages[node.level]
+            self.cache.put(item[0], get_stage_key(stage,
+                    self.stage_algorithm(stage), self.samples), digest)
+        self.advance(node, item, digest)
+
+    def advance(self, node, item, digest):
+        """
+        Move an inode hashed by the stage of node to the next level.
+        """
+        if not item[1]:
+            # removed while being hashed
+            return
+        if digest == 'NONE':
+            # unreadable
+            self.eliminated[self.stages[node.level]] += len(item[1])
+            return
+        child = node.children.get(digest)
+        if child is None:
+            # an empty digest means the stage was skipped, keep the digest
+            # of the previous ones
+            child = node.children[digest] = Node(node.level + 1,
+                                                 digest or node.digest)
+        self.insert(child, item)
+
+    def prove(self, node, item):
+        """
+        A last level node has a new member: report the new match, or the
+        new member of a known one.
+        """
+        size = item[0].size
+        digest = node.digest
+        if 'full' not in self.stages or not digest:
+            digest = 'skipped'
+        if node.match is None:
+            node.match = []
+            self.matches.append(node.match)
+            members = node.members
+        else:
+            members = [item]
+        for member in members:
+            record, filenames, match = member
+            member[2] = node.match
+            node.match.append([filenames, size, digest,
+                               (record.device, record.inode), record.mtime])
+        self.report(node.match)
+
+    def remove(self, inode, size, path=None):
+        """
+        Forget a path of an indexed (device, inode) of the given size, or
+        all its paths.
+        The inode is dropped from the index once it has no path left, and
+        its match is dropped once it has a single inode left.
+        Return the match the inode was part of, or None.
+        """
+        item = self.inodes.get(inode)
+        if item is None:
+            found = self.indexed(inode, size)
+            if found is not None and path in (None, found[0].path):
+                del self.sizelist[size]
+                self.drop_row()
+            return None
+        record, filenames, match = item
+        if path is None:
+            del filenames[:]
+        elif path in filenames:
+            filenames.remove(path)
+        if filenames:
+            # the match shares the filenames list
+            return match
+        del self.inodes[inode]
+
+        # remove the inode from all the nodes of its size, pruning the
+        # nodes left empty
+        nodes = [(self.sizelist, record.size)]
+        while nodes:
+            parent, key = nodes.pop()
+            node = parent[key]
+            for i, member in enumerate(node.members):
+                if member is item:
+                    del node.members[i]
+                    break
+            else:
+                continue
+            if not node.members:
+                del parent[key]
+                continue
+            nodes.extend((node.children, digest) for digest in node.children)
+            if node.match is not None:
+                for i, duplicate in enumerate(node.match):
+                    if duplicate[3] == inode:
+                        del node.match[i]
+                        break
+                if len(node.match) < 2:
+                    for i, known in enumerate(self.matches):
+                        if known is node.match:
+                            del self.matches[i]
+                            break
+                    for member in node.members:
+                        member[2] = None
+                    node.match = None
+        return match
+
+    def poll(self, timeout=0):
+        """
+        Handle the finished hashing tasks, waiting up to timeout seconds
+        for the first one.
+        """
+        try:
+            self.finished(*self.stream.get(timeout))
+            while True:
+                self.finished(*self.stream.get(0))
+        except Queue.Empty:
+            pass
+
+    def open_stream(self):
+        """
+        Start the hashing stream of the finder.
+        """
+        self.stream = self.executor.stream(
+                run_task if self.metrics is None else timed_task)
+
+    def report(self, match):
+        """
+        Send a new or updated match to the listener.
+        """
+        if self.progress_listener:
+            self.progress_listener(self.hashed, self.submitted, match)
+
+    def finish(self):
+        """
+        Compute the final stats once everything is indexed.
+        """
+        nodes = []
+        for node in self.sizelist.itervalues():
+            if not isinstance(node, Node):
+                self.skippedfiles += 1
+            elif not node.active:
+                for record, filenames, match in node.members:
+                    self.skippedfiles += len(filenames)
+            else:
+                nodes.append(node)
+        while nodes:
+            node = nodes.pop()
+            if node.held:
+                # different from all the compared members
+                self.eliminated[self.stages[node.level]] += sum(
+                        len(member[1]) for member in node.held)
+            if node.active:
+                for child in node.children.itervalues():
+                    if len(child.members) == 1:
+                        self.eliminated[self.stages[node.level]] += len(
+                                child.members[0][1])
+                    nodes.append(child)
+        for match in self.matches:
+            self.dupfiles += 1
+            self.dupsize += match[0][1] * (len(match) - 1)
+        if self.metrics is not None:
+            self.metrics.inc('files_skipped', self.skippedfiles,
+                             reason='unique_size')
+
+    def run(self, folders, minimal_size=-1, follow_links=False,
+            add_file_callback=None, add_match_callback=None, snapshot=None,
+            walk_threads=1, walk_ordered=True, path_filter=None,
+            mounts=None):
+        """
+        Walk the given folders and find duplicates on the fly.
+        add_match_callback(scanned, to_scan, match) is called each time a
+        match is found, and again with the same match object each time a
+        file joins it.
+        The unchanged folders of an optional Snapshot are not listed again.
+        walk_threads, walk_ordered, path_filter and mounts are given to
+        finder.walk().
+        Return the list of matches, or None if aborted.
+        """
+        self.progress_listener = add_match_callback
+        records = Queue.Queue(QUEUE_SIZE)
+
+        def walk():
+            """
+            Walk the folders, in another thread.
+            """
+            start = time.time()
+            for record in finder.walk(folders, minimal_size, follow_links,
+                                      snapshot=snapshot, metrics=self.metrics,
+                                      threads=walk_threads,
+                                      ordered=walk_ordered,
+                                      path_filter=path_filter,
+                                      mounts=mounts):
+                while not finder.abort:
+                    try:
+                        records.put(record, timeout=0.1)
+                        break
+                    except Queue.Full:
+                        pass
+            if self.metrics is not None:
+                self.metrics.inc('stage_seconds', time.time() - start,
+                                 phase='walk')
+            while not finder.abort:
+                try:
+                    records.put(None, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+
+        walker = threading.Thread(target=walk)
+        walker.daemon = True
+        walker.start()
+        self.open_stream()
+
+        walking = True
+        while walking or self.stream.pending:
+            if finder.abort:
+                self.stream.cancel()
+                return
+            # hashing results first, they may prove groups
+            self.poll()
+            if not walking:
+                self.poll(0.1)
+                continue
+            try:
+                record = records.get(timeout=0.1 if not self.stream.pending else 0.01)
+            except Queue.Empty:
+                continue
+            if record is None:
+                walking = False
+                continue
+            self.add_record(record)
+            if add_file_callback:
+                add_file_callback(record.path)
+
+        self.stream.close()
+        self.finish()
+        return self.matches
+
+
+def scan(folders, minimal_size, follow_links,
+        add_file_callback=None, add_match_callback=None, finder=None,
+        snapshot=None, walk_threads=1, walk_ordered=True, path_filter=None,
+        mounts=None):
+    """
+    Find the duplicates in the given folders, reporting matches as soon
+    as they are proven.
+    An existing StreamingFinder can be given to read its stats afterwards.
+    A Snapshot is used and saved again like finder.scan does, and the walk
+    options are the same.
+    """
+    if finder is None:
+        finder = StreamingFinder(cache=snapshot)
+    matches = finder.run(folders, minimal_size, follow_links,
+                         add_file_callback, add_match_callback, snapshot,
+                         walk_threads, walk_ordered, path_filter, mounts)
+    if snapshot is not None and matches is not None:
+        snapshot.save()
+    return matches
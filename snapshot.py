@@ -0,0 +1,231 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Snapshot of a scanned tree, to rescan it incrementally.
+
+A snapshot keeps the listing of each walked folder with its modification
+time, and the digests computed for its files. On the next scan, a folder
+whose modification time did not change is not listed again: its entries
+are taken from the snapshot. The digests are reused for the files whose
+size and modification time did not change, so only new or modified
+files are read.
+
+A folder modification time only changes when entries are added, removed
+or renamed, not when a file is rewritten in place. Files of unchanged
+folders are therefore stat-ed again, unless the snapshot is trusted.
+"""
+
+import os
+import sys
+import time
+import errno
+import cPickle
+from collections import namedtuple
+
+from walker import FILE, mtime_ns
+
+VERSION = 1
+
+# folders modified less than this many seconds before the snapshot was
+# started may change again within the same timestamp, they are not reused.
+RACY_DELAY = 2
+
+# the stat data kept for a file of a folder listing.
+Stat = namedtuple('Stat', 'st_size st_ino st_dev st_mtime_ns')
+
+
+def default_snapshot_path():
+    """
+    Return the path of the default snapshot, in the user's cache folder.
+    """
+    folder = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(folder, 'jankis', 'snapshot')
+
+
+class Snapshot(object):
+    """
+    Folder listings and digests of a previous scan, and of the current one.
+    It can be used as the cache of a finder, falling back to another cache
+    for the digests it does not know.
+    """
+
+    def __init__(self, path=None, cache=None, trust=False):
+        """
+        Load the snapshot at path, if any.
+        With trust, the files of unchanged folders are not stat-ed: a
+        file rewritten in place is only seen once its folder changes.
+        """
+        if path is None:
+            path = default_snapshot_path()
+        self.path = path
+        self.cache = cache
+        self.trust = trust
+        self.started = int(time.time() - RACY_DELAY) * 1000000000
+        # folder: ((device, inode, mtime), entries) of the loaded snapshot
+        self.folders = {}
+        # (device, inode): (size, mtime, {key: digest}) of the loaded snapshot
+        self.digests = {}
+        # same, for the current scan
+        self.new_folders = {}
+        self.new_digests = {}
+        self.reused = 0
+        self.listed = 0
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        """
+        Read the snapshot file, starting from an empty one if it is
+        missing or unreadable.
+        """
+        try:
+            f = open(self.path, 'rb')
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                print >>sys.stderr, 'cannot read snapshot %s: %s' % (
+                        self.path, err)
+            return
+        try:
+            try:
+                data = cPickle.load(f)
+            except Exception, err:
+                print >>sys.stderr, 'ignoring invalid snapshot %s: %s' % (
+                        self.path, err)
+                return
+        finally:
+            f.close()
+        if data.get('version') != VERSION:
+            return
+        self.folders = data['folders']
+        self.digests = data['digests']
+
+    def save(self):
+        """
+        Write the snapshot of the current scan, replacing the loaded one.
+        The digests of the loaded snapshot are kept for the files that are
+        still there and unmodified.
+        """
+        for key, entries in self.new_folders.itervalues():
+            for name, kind, st in entries:
+                if kind != FILE:
+                    continue
+                inode = (st.st_dev, st.st_ino)
+                if inode in self.new_digests:
+                    continue
+                known = self.digests.get(inode)
+                if known is not None and known[:2] == (st.st_size, st.st_mtime_ns):
+                    self.new_digests[inode] = known
+
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        # write aside then rename, so an interrupted save keeps the old one
+        temp = self.path + '.tmp'
+        f = open(temp, 'wb')
+        try:
+            cPickle.dump({'version': VERSION, 'folders': self.new_folders,
+                          'digests': self.new_digests}, f, 2)
+        finally:
+            f.close()
+        os.rename(temp, self.path)
+        self.folders = self.new_folders
+        self.digests = self.new_digests
+        self.new_folders = {}
+        self.new_digests = {}
+
+    def list_folder(self, folder, list_dir):
+        """
+        Return the (name, kind, stat) entries of folder, from the snapshot
+        if the folder is unchanged, or using list_dir.
+        """
+        st = os.stat(folder)
+        key = (st.st_dev, st.st_ino, mtime_ns(st))
+        known = self.folders.get(folder)
+        if known is not None and known[0] == key:
+            self.reused += 1
+            entries = known[1]
+            if not self.trust:
+                entries = self.restat(folder, entries)
+        else:
+            self.listed += 1
+            entries = [(name, kind, Stat(st.st_size, st.st_ino, st.st_dev,
+                                         mtime_ns(st)) if st else None)
+                       for name, kind, st in list_dir(folder)]
+        if key[2] >= self.started:
+            # modified right now, it may change again unnoticed
+            key = None
+        self.new_folders[folder] = (key, entries)
+        return entries
+
+    def restat(self, folder, entries):
+        """
+        Return the entries of an unchanged folder with up to date file stats.
+        """
+        join = os.path.join
+        restated = []
+        for name, kind, st in entries:
+            if kind == FILE:
+                try:
+                    st = os.lstat(join(folder, name))
+                except OSError: # vanished file
+                    continue
+                st = Stat(st.st_size, st.st_ino, st.st_dev, mtime_ns(st))
+            restated.append((name, kind, st))
+        return restated
+
+    def get(self, record, key):
+        """
+        Return the known digest of a FileRecord, or None.
+        """
+        inode = (record.device, record.inode)
+        for digests in (self.new_digests, self.digests):
+            known = digests.get(inode)
+            if known is not None and known[:2] == (record.size, record.mtime) \
+                    and key in known[2]:
+                self.hits += 1
+                digest = known[2][key]
+                self.remember(record, key, digest)
+                return digest
+        self.misses += 1
+        digest = None
+        if self.cache is not None:
+            digest = self.cache.get(record, key)
+            if digest is not None:
+                self.remember(record, key, digest)
+        return digest
+
+    def peek(self, record, key):
+        """
+        Return the known digest of a FileRecord, or None, without counting
+        the lookup as a hit or a miss.
+        """
+        inode = (record.device, record.inode)
+        for digests in (self.new_digests, self.digests):
+            known = digests.get(inode)
+            if known is not None and known[:2] == (record.size, record.mtime) \
+                    and key in known[2]:
+                return known[2][key]
+        if self.cache is not None:
+            return self.cache.peek(record, key)
+        return None
+
+    def put(self, record, key, digest):
+        """
+        Store the digest of a FileRecord.
+        """
+        self.remember(record, key, digest)
+        if self.cache is not None:
+            self.cache.put(record, key, digest)
+
+    def remember(self, record, key, digest):
+        """
+        Keep a digest in the snapshot of the current scan.
+        """
+        inode = (record.device, record.inode)
+        known = self.new_digests.get(inode)
+        if known is None or known[:2] != (record.size, record.mtime):
+            known = self.new_digests[inode] = (record.size, record.mtime, {})
+        known[2][key] = digest
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Sorted runs of walked files, spilled to disk.
+
+When the walked files don't fit in the memory budget, they are written to
+temporary files as runs sorted by size. Merging the runs gives back all
+the files in size order, so the files sharing a size can be grouped one
+size at a time, without ever holding the whole tree in memory.
+"""
+
+import os
+import heapq
+import struct
+import tempfile
+
+from walker import FileRecord
+
+# size, device, inode, mtime and path length of a run entry
+ENTRY = struct.Struct('<QQQqH')
+
+# read and write buffer of each run
+RUN_BUFFER_SIZE = 1024*1024
+
+
+def write_run(records, folder=None):
+    """
+    Write FileRecords, sorted by size, to a new run file, returning its path.
+    """
+    fd, path = tempfile.mkstemp(prefix='jankis-', suffix='.run', dir=folder)
+    f = os.fdopen(fd, 'wb', RUN_BUFFER_SIZE)
+    try:
+        pack = ENTRY.pack
+        for record in records:
+            f.write(pack(record.size, record.device, record.inode,
+                         record.mtime, len(record.path)))
+            f.write(record.path)
+    except:
+        f.close()
+        os.remove(path)
+        raise
+    f.close()
+    return path
+
+
+def read_run(path):
+    """
+    Return an iterator of the (size, device, inode, mtime, path) entries of
+    a run file.
+    """
+    f = open(path, 'rb', RUN_BUFFER_SIZE)
+    try:
+        read = f.read
+        unpack = ENTRY.unpack
+        size = ENTRY.size
+        while True:
+            data = read(size)
+            if not data:
+                return
+            entry = unpack(data)
+            yield entry[:4] + (read(entry[4]),)
+    finally:
+        f.close()
+
+
+class SpilledRuns(object):
+    """
+    Temporary run files, removed once merged.
+    """
+
+    def __init__(self, folder=None):
+        """
+        folder is where runs are written, the temporary folder by default.
+        """
+        self.folder = folder
+        self.paths = []
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, records):
+        """
+        Spill FileRecords, already sorted by size, as a new run.
+        """
+        self.paths.append(write_run(records, self.folder))
+
+    def merge(self):
+        """
+        Return an iterator of all the spilled FileRecords, in size order.
+        The runs are removed once read.
+        """
+        try:
+            for size, device, inode, mtime, path in heapq.merge(
+                    *[read_run(path) for path in self.paths]):
+                yield FileRecord(path, size, inode, device, mtime)
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Remove the run files.
+        """
+        for path in self.paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.paths = []
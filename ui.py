@@ -15,6 +15,7 @@ def humanize_size(size):
         hsize = float(size) / limit
         if hsize > 0.5:
             return '%.2f %s' % (hsize, suffix)
+    return '%d B' % size
 
 
 def gtk_idle(func):
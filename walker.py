@@ -0,0 +1,325 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Directory traversal returning stat records.
+
+Entries are listed with scandir when available, so the directory/link
+status comes for free from d_type, and each file is lstat-ed only once.
+The traversal uses an explicit stack instead of nested generators.
+"""
+
+import os
+import stat
+import errno
+import threading
+import Queue
+from collections import namedtuple
+
+from filters import DEFAULT_FILTER
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# a walked file, with all the stat data needed by the finder.
+FileRecord = namedtuple('FileRecord', 'path size inode device mtime')
+
+DIR, FILE, LINK, OTHER = range(4)
+
+
+def mtime_ns(st):
+    """
+    Return the modification time of a stat result in nanoseconds.
+    """
+    ns = getattr(st, 'st_mtime_ns', None)
+    if ns is None:
+        ns = int(st.st_mtime * 1000000000)
+    return ns
+
+
+def stat_record(path, st=None):
+    """
+    Return the FileRecord of given path, using st if already known.
+    """
+    if st is None:
+        st = os.stat(path)
+    return FileRecord(path, st.st_size, st.st_ino, st.st_dev, mtime_ns(st))
+
+
+def _mode_kind(mode):
+    """
+    Return the kind of entry of a stat st_mode.
+    """
+    if stat.S_ISLNK(mode):
+        return LINK
+    if stat.S_ISDIR(mode):
+        return DIR
+    if stat.S_ISREG(mode):
+        return FILE
+    return OTHER
+
+
+def _list_dir(folder):
+    """
+    Return the (name, kind, lstat) entries of a folder.
+    lstat is only given for regular files, the other kinds don't need it.
+    """
+    entries = []
+    if scandir is not None:
+        for entry in scandir(folder):
+            if entry.is_symlink():
+                entries.append((entry.name, LINK, None))
+            elif entry.is_dir(follow_symlinks=False):
+                entries.append((entry.name, DIR, None))
+            elif entry.is_file(follow_symlinks=False):
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError: # vanished file
+                    continue
+                entries.append((entry.name, FILE, st))
+    else:
+        for name in os.listdir(folder):
+            try:
+                st = os.lstat(os.path.join(folder, name))
+            except OSError: # vanished file
+                continue
+            kind = _mode_kind(st.st_mode)
+            if kind != OTHER:
+                entries.append((name, kind, st if kind == FILE else None))
+    return entries
+
+
+def scan_folder(folder, top, follow_links=False, snapshot=None, metrics=None,
+                path_filter=None, mounts=None, root_device=None):
+    """
+    List a folder, returning its (folder, records, dirs) tuple, dirs being
+    the folders to walk next in listing order. When folder is top and a
+    file, it is returned alone in the records of its folder.
+    The folders and files rejected by a PathFilter are left out, default
+    being DEFAULT_FILTER, and the mount points a MountPolicy does not
+    enter from the root_device of top.
+    Raise OSError if the folder can't be read.
+    """
+    join = os.path.join
+    if path_filter is None:
+        path_filter = DEFAULT_FILTER
+    try:
+        if snapshot is None:
+            entries = _list_dir(folder)
+        else:
+            entries = snapshot.list_folder(folder, _list_dir)
+    except OSError, err:
+        if err.errno == errno.ENOTDIR and folder == top:
+            # top is a file
+            return os.path.dirname(top), [stat_record(top)], []
+        raise
+    if metrics is not None:
+        metrics.inc('dirs_listed')
+        if scandir is None:
+            metrics.inc('stat_calls', len(entries))
+        else:
+            metrics.inc('stat_calls', sum(1 for name, kind, st in entries
+                                          if kind == FILE))
+
+    records = []
+    dirs = []
+    filtered = 0
+    pruned = 0
+    unmounted = 0
+    for name, kind, st in entries:
+        path = join(folder, name)
+        if kind == FILE:
+            mtime = mtime_ns(st)
+            if not path_filter.accept(path, name, st.st_size, mtime):
+                filtered += 1
+                continue
+            records.append(FileRecord(path, st.st_size, st.st_ino,
+                                      st.st_dev, mtime))
+        elif kind == DIR:
+            if path_filter.prune(path, name):
+                pruned += 1
+                continue
+            if mounts is not None and not mounts.enter(path, name, root_device):
+                unmounted += 1
+                continue
+            dirs.append(path)
+        elif kind == LINK and follow_links:
+            if metrics is not None:
+                metrics.inc('stat_calls')
+            try:
+                st = os.stat(path)
+            except OSError: # broken link
+                continue
+            if stat.S_ISREG(st.st_mode):
+                if not path_filter.accept(path, name, st.st_size, mtime_ns(st)):
+                    filtered += 1
+                    continue
+                records.append(stat_record(path, st))
+            elif stat.S_ISDIR(st.st_mode):
+                if path_filter.prune(path, name):
+                    pruned += 1
+                    continue
+                if mounts is not None and not mounts.enter(path, name,
+                                                           root_device, st):
+                    unmounted += 1
+                    continue
+                # Only walk this path if it links deeper in the same tree.
+                folder_abs = os.path.abspath(folder)
+                link_abs = os.path.abspath(join(folder, os.readlink(path)))
+                if link_abs.startswith(folder_abs + os.sep):
+                    dirs.append(path)
+    if metrics is not None:
+        if filtered:
+            metrics.inc('files_skipped', filtered, reason='filter')
+        if pruned:
+            metrics.inc('dirs_pruned', pruned, reason='filter')
+        if unmounted:
+            metrics.inc('dirs_pruned', unmounted, reason='mount')
+    return folder, records, dirs
+
+
+def walk_records(top, follow_links=False, onerror=None, snapshot=None,
+                 metrics=None, threads=1, ordered=True, path_filter=None,
+                 mounts=None):
+    """
+    Return an iterator of (folder, records) tuples for top and all folders
+    below it, records being the FileRecord of the regular files of folder.
+
+    Symlinks are skipped unless follow_links is True. In that case a link
+    to a file is returned with the stat of its target, and a link to a
+    folder is only walked if it links deeper in the same tree, like
+    smartpath._walk does.
+
+    With a Snapshot, the folders unchanged since it was taken are not
+    listed again. Listings and stat calls are counted in optional Metrics.
+    The folders pruned by a PathFilter, and the mount points a MountPolicy
+    does not enter, are never listed.
+
+    With more than one thread, folders are listed concurrently, see
+    walk_records_parallel.
+    """
+    if threads > 1:
+        for result in walk_records_parallel(top, follow_links, onerror,
+                snapshot, metrics, threads, ordered, path_filter, mounts):
+            yield result
+        return
+
+    root_device = mounts.root_device(top) if mounts is not None else None
+    stack = [top]
+    while stack:
+        folder = stack.pop()
+        # We may not have read permission for folder, just carry on with
+        # the others, like os.walk does.
+        try:
+            folder, records, dirs = scan_folder(folder, top, follow_links,
+                                                snapshot, metrics, path_filter,
+                                                mounts, root_device)
+        except OSError, err:
+            if onerror is not None:
+                onerror(err)
+            continue
+
+        yield folder, records
+
+        # walk the folders in listing order
+        dirs.reverse()
+        stack.extend(dirs)
+
+
+def walk_records_parallel(top, follow_links=False, onerror=None,
+                          snapshot=None, metrics=None, threads=8, ordered=True,
+                          path_filter=None, mounts=None):
+    """
+    Like walk_records, with folders listed by a pool of threads sharing a
+    queue of folders, to keep several listings in flight on high latency
+    file systems.
+    With ordered, folders are returned in the same order as walk_records,
+    otherwise as soon as they are listed.
+    """
+    folders = Queue.Queue()
+    results = Queue.Queue()
+    root_device = mounts.root_device(top) if mounts is not None else None
+
+    def worker():
+        while True:
+            folder = folders.get()
+            if folder is None:
+                return
+            try:
+                result = scan_folder(folder, top, follow_links, snapshot,
+                                     metrics, path_filter, mounts,
+                                     root_device)
+            except Exception, err:
+                result = err
+            results.put((folder, result))
+
+    workers = []
+    for i in range(threads):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+
+    # listed folders not returned yet, when ordered
+    done = {}
+    pending = [1]
+    def receive():
+        """
+        Wait for a listed folder, queueing its subfolders.
+        """
+        folder, result = results.get()
+        pending[0] -= 1
+        if isinstance(result, Exception):
+            if not isinstance(result, EnvironmentError):
+                raise result
+        else:
+            for path in result[2]:
+                pending[0] += 1
+                folders.put(path)
+        return folder, result
+
+    try:
+        folders.put(top)
+        if not ordered:
+            while pending[0]:
+                folder, result = receive()
+                if isinstance(result, Exception):
+                    if onerror is not None:
+                        onerror(result)
+                    continue
+                yield result[:2]
+            return
+
+        stack = [top]
+        while stack:
+            folder = stack.pop()
+            while folder not in done:
+                listed, result = receive()
+                done[listed] = result
+            result = done.pop(folder)
+            if isinstance(result, Exception):
+                if onerror is not None:
+                    onerror(result)
+                continue
+            yield result[:2]
+            dirs = list(result[2])
+            dirs.reverse()
+            stack.extend(dirs)
+    finally:
+        # drop the remaining folders, and wait for the threads to stop
+        try:
+            while True:
+                folders.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in workers:
+            folders.put(None)
+        for thread in workers:
+            thread.join()
@@ -0,0 +1,426 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+
+"""
+Live duplicate index, kept up to date with inotify.
+
+The folders are scanned once with the staged StreamingFinder, watching
+each walked folder. Then created, written, moved and deleted files are
+added to or removed from its index, so a new duplicate is reported as
+soon as it is written, only reading the files of its size group.
+
+The indexed paths are kept in a FileTable, with the row of each (folder
+id, name), to find what a path was when it is rewritten or removed.
+"""
+
+import os
+import stat
+import time
+import errno
+import select
+import struct
+import sys
+import ctypes
+import ctypes.util
+
+import finder
+from pipeline import StreamingFinder, COMPACT_ROWS
+from walker import walk_records, stat_record
+from filters import DEFAULT_FILTER
+from filetable import FileTable
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+# events of the watched folders
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+             IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+
+# struct inotify_event, without its name
+EVENT = struct.Struct('iIII')
+
+READ_SIZE = 64 * 1024
+
+
+class Inotify(object):
+    """
+    Minimal inotify binding, using the libc through ctypes.
+    """
+
+    def __init__(self):
+        """
+        Create the inotify instance.
+        """
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.error()
+
+    def error(self, path=None):
+        """
+        Raise the OSError of the last failed call.
+        """
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        Watch a folder, returning its watch descriptor.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self.error(path)
+        return wd
+
+    def rm_watch(self, wd):
+        """
+        Stop watching a folder, ignoring the already removed watches.
+        """
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """
+        Return the list of (wd, mask, cookie, name) events, waiting up to
+        timeout seconds for them.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except OSError, err:
+                if err.errno == errno.EAGAIN:
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        """
+        Release the inotify instance and all its watches.
+        """
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """
+    Watch folders, reporting the duplicates found by a StreamingFinder,
+    at first and as files change.
+    """
+
+    def __init__(self, folders, minimal_size=-1, follow_links=False,
+                 finder=None, path_filter=None, mounts=None):
+        """
+        Create the watcher of the given folders, skipping what a PathFilter
+        rejects and the mount points a MountPolicy does not enter.
+        """
+        self.roots = [os.path.abspath(folder) for folder in folders]
+        self.minimal_size = minimal_size
+        self.follow_links = follow_links
+        if path_filter is None:
+            path_filter = DEFAULT_FILTER
+        self.path_filter = path_filter
+        self.mounts = mounts
+        if finder is None:
+            finder = StreamingFinder()
+        self.finder = finder
+        self.inotify = None
+        # watched folders, by watch descriptor and by path
+        self.watches = {}
+        self.folders = {}
+        # indexed paths, and their rows by (folder id, name)
+        self.files = FileTable()
+        self.rows = {}
+        self.dead = 0
+        self.removed_callback = None
+        self.full = False
+
+    def record(self, path):
+        """
+        Return the FileRecord of path if it should be indexed, or None.
+        """
+        try:
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                if not self.follow_links:
+                    return None
+                st = os.stat(path)
+        except OSError: # vanished or broken link
+            return None
+        if not stat.S_ISREG(st.st_mode) or st.st_size <= self.minimal_size:
+            return None
+        record = stat_record(path, st)
+        if not self.path_filter.accept_record(record):
+            return None
+        return record
+
+    def watch_folder(self, folder):
+        """
+        Start watching a folder.
+        """
+        try:
+            wd = self.inotify.add_watch(folder)
+        except OSError, err:
+            if err.errno == errno.ENOSPC and not self.full:
+                self.full = True
+                print >>sys.stderr, 'too many watched folders, raise' \
+                      ' /proc/sys/fs/inotify/max_user_watches'
+            return
+        # the same folder under a new path, after a move
+        known = self.watches.get(wd)
+        if known is not None and known != folder:
+            self.folders.pop(known, None)
+        self.watches[wd] = folder
+        self.folders[folder] = wd
+
+    def unwatch_folders(self, top):
+        """
+        Stop watching top and the folders below it.
+        """
+        prefix = top + os.sep
+        for folder in self.folders.keys():
+            if folder == top or folder.startswith(prefix):
+                wd = self.folders.pop(folder)
+                if self.watches.get(wd) == folder:
+                    del self.watches[wd]
+                    self.inotify.rm_watch(wd)
+
+    def find(self, path):
+        """
+        Return the row of an indexed path, or None.
+        """
+        folder, name = os.path.split(path)
+        return self.rows.get((self.files.dir_ids.get(folder), name))
+
+    def keep(self, record):
+        """
+        Store an indexed path.
+        """
+        row = self.files.append(record)
+        self.rows[(self.files.dir[row], self.files.name(row))] = row
+
+    def forget(self, row):
+        """
+        Drop an indexed path, and the unused rows when they are many.
+        """
+        del self.rows[(self.files.dir[row], self.files.name(row))]
+        self.dead += 1
+        if self.dead < COMPACT_ROWS or self.dead * 2 < len(self.files):
+            return
+        self.files = self.files.subset(sorted(self.rows.itervalues()))
+        self.rows = dict(((self.files.dir[row], self.files.name(row)), row)
+                         for row in xrange(len(self.files)))
+        self.dead = 0
+
+    def add(self, record):
+        """
+        Index a FileRecord, replacing its inode if it was modified.
+        """
+        inode = (record.device, record.inode)
+        # the finder knows an inode by its size when indexed
+        size = record.size
+        row = self.find(record.path)
+        if row is not None:
+            old = self.files.record(row)
+            size = old.size
+            if (old.device, old.inode) != inode:
+                # replaced by another file
+                self.forget(row)
+                self.finder.remove((old.device, old.inode), old.size,
+                                   record.path)
+                row = None
+                size = record.size
+        found = self.finder.indexed(inode, size)
+        if found is not None:
+            indexed, paths = found
+            if (indexed.size, indexed.mtime) != (record.size, record.mtime):
+                # rewritten: all its links changed, paths is emptied by
+                # remove()
+                paths = list(paths)
+                self.finder.remove(inode, indexed.size)
+                for path in paths:
+                    if path != record.path:
+                        link = record._replace(path=path)
+                        other = self.find(path)
+                        if other is not None:
+                            self.forget(other)
+                        self.keep(link)
+                        self.finder.add_record(link)
+            elif record.path in paths:
+                return
+        if row is not None:
+            self.forget(row)
+        self.keep(record)
+        self.finder.add_record(record)
+
+    def remove(self, path):
+        """
+        Forget an indexed path.
+        """
+        row = self.find(path)
+        if row is None:
+            return
+        inode = (self.files.device[row], self.files.inode[row])
+        size = self.files.size[row]
+        self.forget(row)
+        self.finder.remove(inode, size, path)
+        if self.removed_callback:
+            self.removed_callback(path)
+
+    def add_tree(self, top):
+        """
+        Watch and index a folder and all the folders below it, or a file.
+        """
+        isdir = os.path.isdir(top)
+        for folder, records in walk_records(top, self.follow_links,
+                                            path_filter=self.path_filter,
+                                            mounts=self.mounts):
+            if isdir:
+                self.watch_folder(folder)
+            for record in records:
+                if record.size > self.minimal_size:
+                    self.add(record)
+            self.finder.poll()
+            if finder.abort:
+                return
+
+    def remove_tree(self, top):
+        """
+        Forget all the paths below a folder.
+        """
+        self.unwatch_folders(top)
+        prefix = top + os.sep
+        paths = []
+        for (dir_id, name), row in self.rows.iteritems():
+            folder = self.files.dirs[dir_id]
+            if folder == top or folder.startswith(prefix):
+                paths.append(self.files.path(row))
+        for path in paths:
+            self.remove(path)
+
+    def resync(self):
+        """
+        Walk everything again, after events were lost.
+        """
+        known = [self.files.path(row) for row in self.rows.itervalues()]
+        for top in self.roots:
+            self.add_tree(top)
+        for path in known:
+            if not os.path.lexists(path):
+                self.remove(path)
+
+    def handle(self, events):
+        """
+        Apply a batch of inotify events to the index.
+        New paths are added before the old ones are removed, so a moved
+        file is seen as a new link of a known inode, and is not read again.
+        """
+        added = []
+        removed = []
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                print >>sys.stderr, 'inotify queue overflow, walking again'
+                self.resync()
+                continue
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                if self.folders.get(folder) == wd:
+                    del self.folders[folder]
+                continue
+            if mask & IN_DELETE_SELF:
+                removed.append((True, folder))
+                continue
+            path = os.path.join(folder, name)
+            isdir = bool(mask & IN_ISDIR)
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                removed.append((isdir, path))
+            elif mask & IN_MOVED_TO or isdir and mask & IN_CREATE:
+                added.append((isdir, path))
+            elif mask & IN_CLOSE_WRITE:
+                added.append((False, path))
+            elif mask & IN_CREATE:
+                # a new file is indexed once written, but a new hard link
+                # or symlink is complete at once
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if stat.S_ISLNK(st.st_mode) or st.st_nlink > 1:
+                    added.append((False, path))
+
+        for isdir, path in added:
+            if isdir:
+                if not self.path_filter.prune(path, os.path.basename(path)):
+                    self.add_tree(path)
+            else:
+                record = self.record(path)
+                if record is not None:
+                    self.add(record)
+                else:
+                    # now too small, or gone
+                    self.remove(path)
+        for isdir, path in removed:
+            if isdir:
+                self.remove_tree(path)
+            elif not os.path.lexists(path):
+                self.remove(path)
+
+    def run(self, add_match_callback=None, removed_callback=None,
+            timeout=None):
+        """
+        Scan the folders, then follow their changes until aborted or for
+        timeout seconds. add_match_callback is called like with
+        StreamingFinder.run, removed_callback(path) when an indexed file
+        is removed.
+        """
+        self.finder.progress_listener = add_match_callback
+        self.removed_callback = removed_callback
+        self.inotify = Inotify()
+        self.finder.open_stream()
+        end = None if timeout is None else time.time() + timeout
+        try:
+            for top in self.roots:
+                self.add_tree(top)
+            while not finder.abort and (end is None or time.time() < end):
+                self.finder.poll()
+                events = self.inotify.read(
+                        0.1 if self.finder.stream.pending else 1)
+                if events:
+                    self.handle(events)
+        finally:
+            self.finder.stream.cancel()
+            self.inotify.close()
+            self.inotify = None
+
+
+def watch(folders, minimal_size, follow_links, add_match_callback=None,
+          removed_callback=None, finder=None, path_filter=None, mounts=None):
+    """
+    Report the duplicates of the given folders, and the new ones as soon as
+    they appear, until aborted.
+    """
+    Watcher(folders, minimal_size, follow_links, finder, path_filter,
+            mounts).run(
+            add_match_callback, removed_callback)